@@ -0,0 +1,97 @@
+'''Compare reading single channels from ``channels_first`` and
+``channels_last`` HDF5 datasets with :class:`Hdf5ChannelSource`.
+
+Usage::
+
+    python benchmarks/hdf5_channels_last.py [--size 128] [--requests 100]
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+
+from neurolight.gunpowder import Hdf5ChannelSource
+
+
+def create(filename, data_format, size, num_channels, chunk):
+
+    data = np.random.randint(0, 255, size=(num_channels,) + (size,)*3, dtype=np.uint8)
+    with h5py.File(filename, 'w') as f:
+        if data_format == 'channels_first':
+            f.create_dataset('raw', data=data, chunks=(1,) + (chunk,)*3, compression='gzip')
+        else:
+            f.create_dataset(
+                'raw',
+                data=np.moveaxis(data, 0, -1),
+                chunks=(chunk,)*3 + (num_channels,),
+                compression='gzip')
+
+
+def benchmark(filename, data_format, num_channels, size, crop, num_requests, **kwargs):
+
+    keys = [ArrayKey('CHANNEL_%d' % i) for i in range(num_channels)]
+    source = Hdf5ChannelSource(
+        filename,
+        datasets={key: 'raw' for key in keys},
+        channel_ids={key: i for i, key in enumerate(keys)},
+        data_format=data_format,
+        array_specs={key: ArraySpec(voxel_size=(1, 1, 1)) for key in keys},
+        **kwargs)
+
+    rs = np.random.RandomState(0)
+    offsets = rs.randint(0, size - crop, size=(num_requests, 3))
+
+    with build(source):
+        start = time.time()
+        for offset in offsets:
+            # one request per channel, as separate branches of a pipeline do
+            for key in keys:
+                request = BatchRequest()
+                request[key] = ArraySpec(roi=Roi(tuple(offset), (crop,)*3))
+                source.request_batch(request)
+        return (time.time() - start)/num_requests
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--crop', type=int, default=48)
+    parser.add_argument('--chunk', type=int, default=32)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=100)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    filenames = {
+        data_format: os.path.join(directory, '%s.hdf' % data_format)
+        for data_format in ['channels_first', 'channels_last']}
+    for data_format, filename in filenames.items():
+        create(filename, data_format, args.size, args.channels, args.chunk)
+
+    runs = [
+        ('channels_first', {}),
+        ('channels_last', {'chunk_aligned': False}),
+        ('channels_last', {}),
+        ('channels_first', {'block_cache': 2**26}),
+        ('channels_last', {'block_cache': 2**26}),
+    ]
+
+    for data_format, kwargs in runs:
+        t = benchmark(
+            filenames[data_format],
+            data_format,
+            args.channels,
+            args.size,
+            args.crop,
+            args.requests,
+            **kwargs)
+        print("%-15s %-30s %8.2f ms per request" % (data_format, kwargs, t*1000))
+
+    for filename in filenames.values():
+        os.remove(filename)
+    os.rmdir(directory)
@@ -0,0 +1,91 @@
+'''Measure the ``setup`` time of many :class:`Hdf5ChannelSource` (one per
+sample file), without and with ``spec_cache``.
+
+On local disks, opening a file is cheap and the gain is small; the sidecars
+pay off on network storage, where every open is a round trip.
+
+Usage::
+
+    python benchmarks/hdf5_spec_cache.py [--files 500]
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+from gunpowder import ArrayKey, ArraySpec
+
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.hdf5_pool import close_hdf5
+from neurolight.gunpowder import spec_cache
+from neurolight.gunpowder.spec_cache import discover_specs
+
+
+def create(directory, num_files):
+
+    filenames = []
+    for i in range(num_files):
+        filename = os.path.join(directory, 'sample_%d.hdf' % i)
+        with h5py.File(filename, 'w') as f:
+            for name in ['raw', 'gt_instances', 'fg_mask']:
+                f.create_dataset(name, shape=(3, 64, 64, 64), dtype=np.uint8, chunks=(1, 32, 32, 32))
+                f[name].attrs['resolution'] = (1, 1, 1)
+                f[name].attrs['offset'] = (0, 0, 0)
+        filenames.append(filename)
+
+    return filenames
+
+
+def sources(filenames, **kwargs):
+
+    keys = [ArrayKey('RAW'), ArrayKey('GT_INSTANCES'), ArrayKey('FG_MASK')]
+    return [
+        Hdf5ChannelSource(
+            filename,
+            datasets=dict(zip(keys, ['raw', 'gt_instances', 'fg_mask'])),
+            array_specs={key: ArraySpec(voxel_size=(1, 1, 1)) for key in keys},
+            **kwargs)
+        for filename in filenames
+    ]
+
+
+def setup(sources):
+
+    start = time.time()
+    for source in sources:
+        source.setup()
+    return time.time() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    filenames = create(directory, args.files)
+    cache = os.path.join(directory, 'specs')
+
+    print("%-32s %8.2f s" % ("setup", setup(sources(filenames))))
+    close_hdf5()
+
+    start = time.time()
+    discover_specs(sources(filenames, spec_cache=cache), num_workers=args.workers)
+    print("%-32s %8.2f s" % ("discover_specs (no sidecars)", time.time() - start))
+    close_hdf5()
+
+    # as in a new process, only the sidecars
+    spec_cache._memo.clear()
+
+    start = time.time()
+    cached = sources(filenames, spec_cache=cache)
+    discover_specs(cached, num_workers=args.workers)
+    print("%-32s %8.2f s" % ("discover_specs (sidecars)", time.time() - start))
+    print("%-32s %8.2f s" % ("setup after discover_specs", setup(cached)))
+
+    shutil.rmtree(directory)
@@ -0,0 +1,126 @@
+'''Compare the request latency of :class:`ZarrChannelSource` (with threaded
+chunk decoding) and :class:`Hdf5ChannelSource` on the same data, compressed
+with the same codec and settings.
+
+Both formats are compared with deflate (level 4), and with Blosc/zstd if
+``hdf5plugin`` is installed to write it to HDF5. The HDF5 ``gzip`` filter
+stores zlib streams, its zarr counterpart is the ``Zlib`` codec (the
+``GZip`` codec adds gzip headers and checksums, which are slower to decode).
+Zarr with Blosc alone is listed for reference only, since it compares
+codecs, not sources.
+
+Threaded decoding only helps with several CPUs: check ``os.cpu_count()``
+when comparing numbers. On a single CPU, zarr is slower than HDF5 with the
+same codec, because of the per-chunk overhead of zarr (for 128^3 crops of
+3x256^3 ``uint8`` in 32^3 chunks: 104 to 110 ms for HDF5, 112 to 128 ms
+for zarr with or without threads, over several runs). Results on several CPUs have not been measured
+yet.
+
+Usage::
+
+    python benchmarks/zarr_channel_source.py [--size 256] [--crop 128]
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import zarr
+from numcodecs import Blosc, Zlib
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+
+from neurolight.gunpowder import Hdf5ChannelSource, ZarrChannelSource
+
+
+def create(directory, size, num_channels, chunk):
+
+    # smooth data, such that it compresses
+    data = np.cumsum(
+        np.random.randint(0, 3, size=(num_channels,) + (size,)*3, dtype=np.uint8),
+        axis=-1, dtype=np.uint8)
+    chunks = (1,) + (chunk,)*3
+
+    filenames = {
+        'hdf5 zlib': os.path.join(directory, 'raw_zlib.hdf'),
+        'zarr zlib': os.path.join(directory, 'raw_zlib.zarr'),
+        'zarr blosc': os.path.join(directory, 'raw_blosc.zarr'),
+    }
+
+    with h5py.File(filenames['hdf5 zlib'], 'w') as f:
+        f.create_dataset('raw', data=data, chunks=chunks, compression='gzip', compression_opts=4)
+    zarr.open(filenames['zarr zlib'], mode='w').create_dataset(
+        'raw', data=data, chunks=chunks, compressor=Zlib(level=4))
+    zarr.open(filenames['zarr blosc'], mode='w').create_dataset(
+        'raw', data=data, chunks=chunks, compressor=Blosc(cname='zstd', clevel=5, shuffle=Blosc.SHUFFLE))
+
+    if hdf5plugin is not None:
+        filenames['hdf5 blosc'] = os.path.join(directory, 'raw_blosc.hdf')
+        with h5py.File(filenames['hdf5 blosc'], 'w') as f:
+            f.create_dataset(
+                'raw', data=data, chunks=chunks,
+                **hdf5plugin.Blosc(cname='zstd', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+
+    return filenames
+
+
+def benchmark(source_class, filename, size, crop, num_requests, **kwargs):
+
+    raw = ArrayKey('RAW')
+    source = source_class(
+        filename,
+        datasets={raw: 'raw'},
+        array_specs={raw: ArraySpec(voxel_size=(1, 1, 1))},
+        **kwargs)
+
+    rs = np.random.RandomState(0)
+    offsets = rs.randint(0, size - crop, size=(num_requests, 3))
+
+    with build(source):
+        start = time.time()
+        for offset in offsets:
+            request = BatchRequest()
+            request[raw] = ArraySpec(roi=Roi(tuple(offset), (crop,)*3))
+            source.request_batch(request)
+        return (time.time() - start)/num_requests
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--crop', type=int, default=128)
+    parser.add_argument('--chunk', type=int, default=32)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    filenames = create(directory, args.size, args.channels, args.chunk)
+
+    runs = [
+        ('hdf5 zlib', Hdf5ChannelSource, {}),
+        ('zarr zlib', ZarrChannelSource, {'num_threads': 1}),
+        ('zarr zlib', ZarrChannelSource, {}),
+        ('hdf5 blosc', Hdf5ChannelSource, {}),
+        ('zarr blosc', ZarrChannelSource, {'num_threads': 1}),
+        ('zarr blosc', ZarrChannelSource, {}),
+    ]
+
+    print("%d CPUs" % os.cpu_count())
+    if hdf5plugin is None:
+        print("hdf5plugin not installed, zarr blosc has no HDF5 counterpart")
+
+    for name, source_class, kwargs in runs:
+        if name not in filenames:
+            continue
+        t = benchmark(source_class, filenames[name], args.size, args.crop, args.requests, **kwargs)
+        print("%-12s %-20s %8.2f ms per request" % (name, kwargs, t*1000))
+
+    shutil.rmtree(directory)
@@ -1,4 +1,6 @@
 from .hdf5_channel_source import Hdf5ChannelSource
+from .zarr_channel_source import ZarrChannelSource
+from .memmap_channel_source import MemmapChannelSource
 from .swc_source import SwcSource
 from .rasterize_skeleton import RasterizeSkeleton
 from .fusion_augment import FusionAugment
@@ -8,3 +10,10 @@ from .binarize_labels import BinarizeLabels
 from .clip import Clip
 from .remove_overlap import RemoveOverlap
 from .count_overlap import CountOverlap
+from .fused_filter import (
+    FusedFilter,
+    ClipOp,
+    HlsOp,
+    BinarizeOp,
+    CountOverlapOp,
+    RemoveOverlapOp)
@@ -1,13 +1,48 @@
 import numpy as np
 from gunpowder import *
 
+from .packed_mask import PackedMask, packed_mask_array
+
 
 class BinarizeLabels(BatchFilter):
+    '''Create a ``uint8`` mask of all labels greater than 0.
+
+    Args:
+
+        labels (:class:`ArrayKey`):
+
+            The labels to binarize.
+
+        labels_binary (:class:`ArrayKey`):
+
+            The array key to store the mask in.
+
+        packed (``bool``, optional):
+
+            Store the mask as :class:`PackedMask` with one bit per voxel,
+            which is expanded to ``uint8`` only where accessed.
+
+        in_place (``bool``, optional):
+
+            If ``labels`` is not requested and owns its memory, write the mask
+            into the memory of the labels instead of allocating a new array.
+            ``labels`` is removed from the batch in this case. Labels that are
+            views of other arrays (which might still be in the batch) are not
+            overwritten.
 
-    def __init__(self, labels, labels_binary):
+        tile_size (``int``, optional):
+
+            Number of voxels binarized at once for ``packed`` and
+            ``in_place``.
+    '''
+
+    def __init__(self, labels, labels_binary, packed=False, in_place=False, tile_size=2**16):
 
         self.labels = labels
         self.labels_binary = labels_binary
+        self.packed = packed
+        self.in_place = in_place
+        self.tile_size = tile_size
 
     def setup(self):
 
@@ -23,8 +58,39 @@ class BinarizeLabels(BatchFilter):
         spec = batch[self.labels].spec.copy()
         spec.dtype = np.uint8
 
-        binarized = Array(
-            data=(batch[self.labels].data > 0).astype(np.uint8),
-            spec=spec)
+        labels = batch[self.labels].data
+
+        if self.packed:
+            batch[self.labels_binary] = packed_mask_array(
+                PackedMask.from_labels(labels, self.tile_size),
+                spec)
+            return
+
+        if (
+                self.in_place and
+                self.labels not in request and
+                isinstance(labels, np.ndarray) and
+                labels.flags.owndata and
+                labels.flags.writeable and
+                labels.flags.c_contiguous):
+            binarized = _binarize_in_place(labels, self.tile_size)
+            del batch.arrays[self.labels]
+        else:
+            binarized = np.empty(labels.shape, dtype=np.uint8)
+            np.greater(labels, 0, out=binarized)
+
+        batch[self.labels_binary] = Array(data=binarized, spec=spec)
+
+
+def _binarize_in_place(labels, tile_size):
+
+    # the first labels.size bytes of the labels memory hold the mask, tiles
+    # are processed in order such that labels are read before overwritten
+    flat = labels.reshape(-1)
+    binarized = flat.view(np.uint8)[:flat.size]
+
+    for begin in range(0, flat.size, tile_size):
+        end = min(begin + tile_size, flat.size)
+        np.greater(flat[begin:end], 0, out=binarized[begin:end])
 
-        batch[self.labels_binary] = binarized
\ No newline at end of file
+    return binarized.reshape(labels.shape)
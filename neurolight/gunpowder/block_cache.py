@@ -0,0 +1,239 @@
+from collections import OrderedDict
+import atexit
+import hashlib
+import logging
+import os
+import threading
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class BlockCache(object):
+    '''A least recently used cache of decoded data blocks with a byte budget.
+
+    Blocks are stored under hashable keys (e.g., file, dataset, and block
+    index) and returned as read-only arrays, callers have to copy what they
+    want to modify.
+
+    Args:
+
+        max_bytes (``int``, optional):
+
+            The budget for all blocks in the cache. The least recently used
+            blocks are dropped when it is exceeded.
+
+        shared (``bool``, optional):
+
+            Store blocks in shared memory, such that other processes with a
+            shared cache of the same ``name`` (e.g., workers of
+            ``PreCache``) find them. Each process keeps its own LRU order and
+            budget over the blocks it uses, blocks are removed from shared
+            memory when the process that stored them drops them or exits.
+
+        name (``string``, optional):
+
+            Prefix of the shared memory blocks, to separate unrelated caches.
+    '''
+
+    def __init__(self, max_bytes=2**28, shared=False, name='neurolight'):
+
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.name = name
+
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+        self.__blocks = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__exit_registered = False
+
+    def get(self, key, shape=None, dtype=None):
+        '''Get the block stored under ``key``, or ``None``. ``shape`` and
+        ``dtype`` are needed to find blocks of other processes in a shared
+        cache.'''
+
+        with self.__lock:
+
+            if key in self.__blocks:
+                self.__blocks.move_to_end(key)
+                self.hits += 1
+                return self.__blocks[key].data
+
+            if self.shared and shape is not None:
+                block = _SharedBlock.attach(self.__shared_name(key), shape, dtype)
+                if block is not None:
+                    self.__insert(key, block)
+                    self.hits += 1
+                    return block.data
+
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        '''Store a copy of ``data`` under ``key``, and return the stored
+        block.'''
+
+        with self.__lock:
+
+            if key in self.__blocks:
+                self.__blocks.move_to_end(key)
+                return self.__blocks[key].data
+
+            if data.nbytes > self.max_bytes:
+                return data
+
+            if self.shared:
+                if not self.__exit_registered:
+                    atexit.register(_clear, weakref.ref(self))
+                    self.__exit_registered = True
+                block = _SharedBlock.create(self.__shared_name(key), data)
+            else:
+                block = _LocalBlock(data)
+
+            self.__insert(key, block)
+
+            return block.data
+
+    def clear(self):
+
+        with self.__lock:
+            while self.__blocks:
+                _, block = self.__blocks.popitem(last=False)
+                block.release()
+            self.nbytes = 0
+
+    def stats(self):
+        '''The number of hits and misses, and the current size of the cache
+        (of this process).'''
+
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/requests if requests else 0.0,
+            'blocks': len(self.__blocks),
+            'nbytes': self.nbytes,
+        }
+
+    def __len__(self):
+        return len(self.__blocks)
+
+    def __insert(self, key, block):
+
+        self.__blocks[key] = block
+        self.nbytes += block.data.nbytes
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.__blocks.popitem(last=False)
+            self.nbytes -= evicted.data.nbytes
+            evicted.release()
+
+    def __shared_name(self, key):
+        return '%s_%s' % (self.name, hashlib.sha1(repr(key).encode()).hexdigest()[:20])
+
+    def __getstate__(self):
+
+        # pickled for other processes: the same shared memory, but own blocks
+        state = self.__dict__.copy()
+        state['_BlockCache__blocks'] = OrderedDict()
+        state['_BlockCache__lock'] = None
+        state['_BlockCache__exit_registered'] = False
+        state['nbytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+
+class _LocalBlock(object):
+
+    def __init__(self, data):
+
+        self.data = np.array(data)
+        self.data.flags.writeable = False
+
+    def release(self):
+        pass
+
+
+class _SharedBlock(object):
+
+    # the first bytes of each segment flag that the block is complete
+    header = 64
+
+    def __init__(self, memory, shape, dtype, owner):
+
+        self.memory = memory
+        # only the creating process removes the block, not forked children
+        self.owner = os.getpid() if owner else None
+        self.data = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=self.header)
+        self.data.flags.writeable = False
+
+    @staticmethod
+    def create(name, data):
+
+        from multiprocessing import shared_memory
+
+        try:
+            memory = shared_memory.SharedMemory(
+                name=name,
+                create=True,
+                size=_SharedBlock.header + data.nbytes)
+        except FileExistsError:
+            block = _SharedBlock.attach(name, data.shape, data.dtype)
+            if block is not None:
+                return block
+            # another process is still writing this block, keep a local copy
+            return _LocalBlock(data)
+
+        np.ndarray(data.shape, dtype=data.dtype, buffer=memory.buf, offset=_SharedBlock.header)[:] = data
+        memory.buf[0] = 1
+
+        return _SharedBlock(memory, data.shape, data.dtype, owner=True)
+
+    @staticmethod
+    def attach(name, shape, dtype):
+
+        from multiprocessing import shared_memory
+
+        try:
+            memory = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        if memory.buf[0] != 1 or memory.size < _SharedBlock.header + nbytes:
+            memory.close()
+            return None
+
+        return _SharedBlock(memory, shape, dtype, owner=False)
+
+    def release(self):
+
+        # if the array is still used by a caller, the memory is unmapped when
+        # it is gone
+        self.data = None
+        if self.owner == os.getpid():
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+        try:
+            self.memory.close()
+        except BufferError:
+            pass
+
+
+def _clear(cache):
+
+    # remove the shared blocks of this process on exit
+    cache = cache()
+    if cache is not None:
+        cache.clear()
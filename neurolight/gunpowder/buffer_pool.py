@@ -0,0 +1,80 @@
+import sys
+import threading
+
+import numpy as np
+
+
+class BufferPool(object):
+    '''A pool of arrays to reuse for data of the same shape and type.
+
+    Arrays handed out by :meth:`get` stay in the pool. An array is reused
+    once nothing else references it anymore (neither the array nor a view of
+    it), i.e., once all nodes downstream released the batch it was part of.
+
+    Args:
+
+        max_buffers (``int``, optional):
+
+            The maximal number of arrays kept per shape and type. If all are
+            in use, new arrays are allocated without pooling them.
+    '''
+
+    def __init__(self, max_buffers=16):
+
+        self.max_buffers = max_buffers
+        self.allocations = 0
+        self.reuses = 0
+
+        self.__buffers = {}
+        self.__lock = threading.Lock()
+
+    def get(self, shape, dtype, allocate=np.empty):
+        '''Get an (uninitialized) array of ``shape`` and ``dtype``, and whether
+        it was reused. New arrays are created with ``allocate(shape, dtype)``
+        (e.g., :meth:`ReaderPool.allocate` for arrays in shared memory).'''
+
+        key = (tuple(shape), np.dtype(dtype))
+
+        with self.__lock:
+
+            buffers = self.__buffers.setdefault(key, [])
+            for i in range(len(buffers)):
+                if _unreferenced(buffers, i):
+                    self.reuses += 1
+                    return buffers[i], True
+
+            buffer = allocate(key[0], key[1])
+            if len(buffers) < self.max_buffers:
+                buffers.append(buffer)
+            self.allocations += 1
+
+            return buffer, False
+
+    def __getstate__(self):
+        # buffers and lock are local to each process
+        state = self.__dict__.copy()
+        state['_BufferPool__buffers'] = {}
+        del state['_BufferPool__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def clear(self):
+
+        with self.__lock:
+            self.__buffers.clear()
+
+    @property
+    def nbytes(self):
+        return sum(
+            b.nbytes
+            for buffers in self.__buffers.values()
+            for b in buffers)
+
+
+def _unreferenced(buffers, i):
+
+    # only referenced by the list and the argument of getrefcount
+    return sys.getrefcount(buffers[i]) == 2
@@ -1,31 +1,259 @@
 import numpy as np
 from gunpowder import *
+import fcntl
+import json
+import logging
+import os
+
+from .intensity_statistics import read_statistics, get_percentiles
+from .quantile_sketch import QuantileSketch
+
+logger = logging.getLogger(__name__)
 
 
 class Clip(BatchFilter):
+    '''Clip the intensities of an array.
+
+    Args:
+
+        array (:class:`ArrayKey`):
+
+            The array to clip.
+
+        min (``float``, optional):
+
+            The lower bound.
+
+        max (``float``, optional):
+
+            The upper bound.
+
+        statistics (``string``, optional):
+
+            A statistics file written by
+            :func:`neurolight.gunpowder.intensity_statistics.compute_statistics`
+            (or the HDF5 file it was computed for) to read the bounds from, if
+            ``min`` or ``max`` are not given. Bounds are read per channel, the
+            first axis of ``array`` has to be the channel axis if the
+            statistics contain more than one channel.
+
+        dataset (``string``, optional):
+
+            The dataset in ``statistics`` to use, can be omitted if there are
+            statistics of a single dataset only.
+
+        percentiles (``tuple`` of ``float``, optional):
+
+            The lower and upper percentile to use as bounds, (0.1, 99.9) by
+            default.
+
+        channels (``list`` of ``int``, optional):
 
-    def __init__(self, array, min=None, max=None):
+            The channels of the statistics contained in ``array``, e.g., the
+            ``channel_ids`` of an :class:`Hdf5ChannelSource`. All channels
+            by default.
+
+        sketch (``bool``, optional):
+
+            If set, and no ``statistics`` are given, estimate the
+            ``percentiles`` online with a :class:`QuantileSketch` per channel,
+            updated from a random subsample of each batch.
+
+        sample_size (``int``, optional):
+
+            Number of voxels per channel to sample from each batch in
+            ``sketch`` mode.
+
+        sketch_file (``string``, optional):
+
+            A JSON file to share the sketches between workers (or training
+            runs). Every ``sync_every`` batches, the samples since the last
+            synchronization are merged into the file, under a file lock, and
+            the merged sketches are used from then on.
+
+        sync_every (``int``, optional):
+
+            How often to merge the sketches with ``sketch_file``.
+
+        relative_accuracy (``float``, optional):
+
+            The relative accuracy of the sketches.
+
+        in_place (``bool``, optional):
+
+            If set, clip arrays that own their memory in place, instead of
+            into a new array. Views (e.g., of channels read together, or of
+            cropped arrays) share their memory with other arrays and are
+            never modified.
+
+    If neither bounds, statistics, nor ``sketch`` are given, the bounds are
+    taken from the first batch.
+    '''
+
+    def __init__(
+            self,
+            array,
+            min=None,
+            max=None,
+            statistics=None,
+            dataset=None,
+            percentiles=(0.1, 99.9),
+            channels=None,
+            sketch=False,
+            sample_size=4096,
+            sketch_file=None,
+            sync_every=10,
+            relative_accuracy=0.01,
+            in_place=False):
 
         self.array = array
         self.min = min
         self.max = max
+        self.statistics = statistics
+        self.dataset = dataset
+        self.percentiles = percentiles
+        self.channels = channels
+        self.sketch = sketch and statistics is None
+        self.sample_size = sample_size
+        self.sketch_file = sketch_file
+        self.sync_every = sync_every
+        self.relative_accuracy = relative_accuracy
+        self.in_place = in_place
 
-    def process(self, batch, request):
+        # current sketches and samples since the last sync, per channel
+        self.sketches = None
+        self.__unsynced = None
+        self.__num_updates = 0
 
-        np.set_printoptions(formatter={'float': lambda x: "{0:0.6f}".format(x)})
+    def setup(self):
 
-        if self.array not in batch.arrays:
+        if self.statistics is None:
+            if not self.sketch and (self.min is None or self.max is None):
+                logger.warning(
+                    "no statistics given for %s, the clipping bounds will "
+                    "depend on the first batch", self.array)
             return
 
-        array = batch.arrays[self.array]
+        statistics = read_statistics(self.statistics, self.dataset)
+        bounds = get_percentiles(statistics, self.percentiles, self.channels)
+
+        if bounds.shape[1] == 1:
+            bounds = bounds[:, 0]
 
         if self.min is None:
-            self.min = np.min(array.data)
+            self.min = bounds[0]
         if self.max is None:
-            self.max = np.max(array.data)
+            self.max = bounds[1]
+
+        logger.debug(
+            "clipping %s to [%s, %s]", self.array, self.min, self.max)
+
+    def process(self, batch, request):
+
+        if self.array not in batch.arrays:
+            return
+
+        array = batch.arrays[self.array]
+        data = array.data
+
+        if self.sketch:
+            lower, upper = self.__update_sketches(array)
+            if self.min is not None:
+                lower = self.min
+            if self.max is not None:
+                upper = self.max
+        else:
+            if self.min is None:
+                self.min = np.min(data)
+            if self.max is None:
+                self.max = np.max(data)
+            lower, upper = self.min, self.max
+
+        if self.in_place and data.flags.owndata and data.flags.writeable:
+            np.clip(
+                data,
+                _bound(lower, data),
+                _bound(upper, data),
+                out=data)
+        else:
+            array.data = np.clip(
+                data,
+                _bound(lower, data),
+                _bound(upper, data)).astype(array.spec.dtype, copy=False)
+
+    def __update_sketches(self, array):
+
+        data = array.data
+
+        # one sketch per channel, if there is a channel axis
+        if data.ndim > array.spec.roi.dims():
+            samples = data.reshape(data.shape[0], -1)
+        else:
+            samples = data.reshape(1, -1)
+
+        num_channels, num_voxels = samples.shape
+        if num_voxels > self.sample_size:
+            samples = samples[:, np.random.randint(0, num_voxels, self.sample_size)]
+
+        if self.sketches is None:
+            self.sketches = self.__create_sketches(num_channels)
+            self.__unsynced = self.__create_sketches(num_channels)
+
+        for c in range(num_channels):
+            self.sketches[c].update(samples[c])
+            self.__unsynced[c].update(samples[c])
+
+        self.__num_updates += 1
+        if self.sketch_file is not None and (self.__num_updates - 1) % self.sync_every == 0:
+            self.__sync()
+
+        bounds = np.array([
+            [s.quantile(p/100.0) for s in self.sketches]
+            for p in self.percentiles
+        ])
+        if data.ndim == array.spec.roi.dims():
+            bounds = bounds[:, 0]
+
+        return bounds[0], bounds[1]
+
+    def __create_sketches(self, num_channels):
+        return [QuantileSketch(self.relative_accuracy) for _ in range(num_channels)]
+
+    def __sync(self):
+
+        with open(self.sketch_file + '.lock', 'a') as lock:
+
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if os.path.exists(self.sketch_file):
+                with open(self.sketch_file, 'r') as f:
+                    shared = [QuantileSketch.from_dict(d) for d in json.load(f)]
+            else:
+                shared = self.__create_sketches(len(self.__unsynced))
+
+            for sketch, unsynced in zip(shared, self.__unsynced):
+                sketch.merge(unsynced)
+
+            tmp_file = '%s.%d.tmp' % (self.sketch_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump([s.to_dict() for s in shared], f)
+            os.replace(tmp_file, self.sketch_file)
+
+        self.sketches = shared
+        self.__unsynced = self.__create_sketches(len(shared))
+
+
+def _bound(bound, data):
+
+    bound = np.asarray(bound)
+    if np.issubdtype(data.dtype, np.integer):
+        # bounds outside of the range of the type would wrap around
+        info = np.iinfo(data.dtype)
+        bound = np.clip(np.round(bound), info.min, info.max)
+    bound = bound.astype(data.dtype)
 
-        for c in range(array.data.shape[0]):
-            hist = np.histogram(array.data[c], range(4096), density=True)
-            #print('histogram density at max: ', hist[0][self.max])
+    # per channel bounds along the first axis
+    if bound.ndim == 1:
+        bound = bound.reshape((-1,) + (1,)*(data.ndim - 1))
 
-        array.data = np.clip(array.data, self.min, self.max).astype(array.spec.dtype)
\ No newline at end of file
+    return bound
@@ -1,12 +1,38 @@
 import numpy as np
 from gunpowder import *
+import logging
+import os
+
+logger = logging.getLogger(__name__)
 
 
 class ConvertRgbToHls(BatchFilter):
+    """Convert an RGB array into HLS.
+
+    Args:
+
+        rgb (:class:`ArrayKey`):
+
+            The RGB array to convert, channels first. Float arrays are
+            expected to be normalized to [0, 1], integer arrays are normalized
+            by the maximum of their type.
+
+        hls (:class:`ArrayKey`):
 
-    def __init__(self, rgb, hls):
+            The array key to store the ``float32`` HLS array in.
+
+        bit_depth (``int``, optional):
+
+            If given and ``rgb`` is of an unsigned integer type, convert
+            through a lookup table over the ``bit_depth`` most significant
+            bits of each channel instead of computing each voxel, see
+            :func:`getHlsLut`.
+    """
+
+    def __init__(self, rgb, hls, bit_depth=None):
         self.rgb = rgb
         self.hls = hls
+        self.bit_depth = bit_depth
 
     def setup(self):
         spec = self.spec[self.rgb].copy()
@@ -22,16 +48,34 @@ class ConvertRgbToHls(BatchFilter):
         spec.dtype = np.float32
 
         rgb = batch[self.rgb].data
-        hls = getHls(rgb)
+        hls = getHls(rgb, bit_depth=self.bit_depth)
 
-        batch[self.hls] = Array(data=hls.astype(np.float32), spec=spec)
+        batch[self.hls] = Array(data=hls, spec=spec)
 
 
 class ConvertRgbToHlsVector(BatchFilter):
+    """Convert an RGB array into the HLS vector (s * cos(h), s * sin(h), l).
+
+    Args:
+
+        rgb (:class:`ArrayKey`):
 
-    def __init__(self, rgb, hls_vector):
+            The RGB array to convert, channels first.
+
+        hls_vector (:class:`ArrayKey`):
+
+            The array key to store the ``float32`` HLS vector in.
+
+        bit_depth (``int``, optional):
+
+            Convert unsigned integer data through a lookup table, as in
+            :class:`ConvertRgbToHls`.
+    """
+
+    def __init__(self, rgb, hls_vector, bit_depth=None):
         self.rgb = rgb
         self.hls_vector = hls_vector
+        self.bit_depth = bit_depth
 
     def setup(self):
         spec = self.spec[self.rgb].copy()
@@ -47,50 +91,332 @@ class ConvertRgbToHlsVector(BatchFilter):
         spec.dtype = np.float32
 
         rgb = batch[self.rgb].data
-        hls = getHls(rgb)
+        hls_vector = getHlsVector(rgb, bit_depth=self.bit_depth)
 
-        cos = hls[2] * np.cos(hls[0] * 2 * np.pi)
-        sin = hls[2] * np.sin(hls[0] * 2 * np.pi)
+        batch[self.hls_vector] = Array(data=hls_vector, spec=spec)
 
-        hls_vector = np.stack([cos, sin, hls[1]], axis=0)
 
-        batch[self.hls_vector] = Array(data=hls_vector.astype(np.float32), spec=spec)
+def getHls(rgb, out=None, tile_size=2**14, bit_depth=None):
+    """Convert an RGB array (c, z, y, x) to HLS.
 
+    The conversion is done in tiles of ``tile_size`` consecutive voxels (in
+    z-major order) with a fixed set of tile-sized buffers, results are
+    written directly into the ``float32`` array ``out``, which is created if
+    not given. ``out`` has to be contiguous in each channel. Intermediate
+    values are computed in the data type of ``rgb`` (``float64`` for integer
+    types, which are normalized by the maximum of their type), the result is
+    identical to converting the whole volume at once.
 
-def getHls(rgb):
+    If ``bit_depth`` is given and ``rgb`` is of an unsigned integer type, the
+    result is gathered from the lookup table of :func:`getHlsLut` instead.
+    """
 
     # c, z, y, x
-    # convert rgb to hls, assume that rgb is normalized and float [0,1]
-    maxc = np.max(rgb, axis=0)
-    minc = np.min(rgb, axis=0)
-    dst = np.zeros_like(rgb, dtype=np.float32)
+    if _use_lut(rgb, bit_depth):
+        return _convert_lut(rgb, out, tile_size, bit_depth, vector=False)
+    return _convert(rgb, out, tile_size, vector=False)
+
+
+def getHlsVector(rgb, out=None, tile_size=2**14, bit_depth=None):
+    """Convert an RGB array (c, z, y, x) to the HLS vector
+    (s * cos(h), s * sin(h), l), in tiles like :func:`getHls`."""
+
+    if _use_lut(rgb, bit_depth):
+        return _convert_lut(rgb, out, tile_size, bit_depth, vector=True)
+    return _convert(rgb, out, tile_size, vector=True)
 
-    dst[1] = (minc + maxc) / 2.0
 
-    not_white = minc != maxc
-    minus = maxc - minc
-    plus = maxc + minc
+# lookup tables by (vector, dtype, bit_depth)
+_luts = {}
+
+
+def clearHlsLuts():
+    """Release the lookup tables kept in memory by :func:`getHlsLut`. Tables
+    cached as files are not removed."""
 
-    with np.errstate(divide='ignore', invalid='ignore'):
+    _luts.clear()
+
+
+def getHlsLut(dtype, bit_depth, vector=False, cache_dir=None):
+    """Get the lookup table to convert unsigned integer RGB values of type
+    ``dtype`` to HLS (or the HLS vector, if ``vector`` is set).
+
+    Each channel is quantized to its ``bit_depth`` most significant bits,
+    the table has shape ``(2**(3*bit_depth), 3)`` (such that a lookup reads
+    a single cache line) and holds the conversion of
+    the center of each quantization bin, normalized by the maximum of
+    ``dtype``. Tables are kept in memory and cached as ``.npy`` files in
+    ``cache_dir`` (``$NEUROLIGHT_CACHE_DIR`` or ``~/.cache/neurolight`` by
+    default), from where they are memory-mapped.
+
+    Absolute errors compared to converting the normalized values directly,
+    over all 8-bit RGB values (errors of the hue vector are the maximum over
+    its components)::
 
-        dark = dst[1] < 0.5
-        idx = np.logical_and(dark, not_white)
-        dst[2, idx] = np.divide(minus[idx], plus[idx])
+        bit_depth  table size   l (max)   hue vector (median, 99%, max)
+        8          192 MiB      0         0       0       0
+        7          24 MiB       0.0020    0.0050  0.019   1.0
+        6          3 MiB        0.0059    0.011   0.044   1.0
+        5          384 KiB      0.014     0.021   0.090   1.0
+        4          48 KiB       0.029     0.043   0.18    1.0
 
-        idx = np.logical_and(np.logical_not(dark), not_white)
-        dst[2, idx] = np.divide(minus[idx], (2.0 - plus)[idx])
+    Saturation and hue are ill-conditioned for dark colors (a quantization
+    bin close to black contains gray and fully saturated colors), so their
+    maximal error is 1 for ``bit_depth < 8``. Tables of up to 6 bits fit into
+    the CPU cache and are 1.5 to 2.5 times faster than the direct conversion
+    of integer data, larger tables are not faster.
+    """
 
-        rc = np.divide((maxc - rgb[0]), minus)
-        gc = np.divide((maxc - rgb[1]), minus)
-        bc = np.divide((maxc - rgb[2]), minus)
+    dtype = np.dtype(dtype)
+    source_bits = dtype.itemsize*8
+    assert dtype.kind == 'u', "lookup tables need unsigned integer data"
+    assert 1 <= bit_depth <= min(source_bits, 8), (
+        "bit_depth has to be between 1 and %d" % min(source_bits, 8))
 
-        idx = np.logical_and(rgb[0] == maxc, not_white)
-        dst[0, idx] = bc[idx] - gc[idx]
-        idx = np.logical_and(rgb[1] == maxc, not_white)
-        dst[0, idx] = 2.0 + rc[idx] - bc[idx]
-        idx = np.logical_and(rgb[2] == maxc, not_white)
-        dst[0, idx] = (4.0 + gc - rc)[idx]
+    key = (vector, dtype.str, bit_depth)
+    if key in _luts:
+        return _luts[key]
 
-        dst[0] = (dst[0] / 6.0) % 1.0
+    if cache_dir is None:
+        cache_dir = os.environ.get(
+            'NEUROLIGHT_CACHE_DIR',
+            os.path.join(os.path.expanduser('~'), '.cache', 'neurolight'))
+    filename = os.path.join(
+        cache_dir,
+        'hls%s_lut_%s_%d.npy' % ('_vector' if vector else '', dtype.name, bit_depth))
+
+    try:
+        lut = np.load(filename, mmap_mode='r')
+        assert lut.shape == (2**(3*bit_depth), 3)
+    except Exception:
+        lut = _create_lut(dtype, bit_depth, vector)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, lut)
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            logger.warning("could not cache HLS lookup table: %s", e)
+
+    _luts[key] = lut
+    return lut
+
+
+def _use_lut(rgb, bit_depth):
+
+    if bit_depth is None:
+        return False
+    if rgb.dtype.kind != 'u':
+        logger.debug("ignoring bit_depth for data of type %s", rgb.dtype)
+        return False
+    return True
+
+
+def _create_lut(dtype, bit_depth, vector):
+
+    logger.info(
+        "creating HLS lookup table for %s with bit depth %d",
+        dtype, bit_depth)
+
+    step = 2**(dtype.itemsize*8 - bit_depth)
+    max_value = float(np.iinfo(dtype).max)
+
+    # normalized centers of each bin
+    centers = (np.arange(2**bit_depth)*step + (step - 1)/2.0)/max_value
+
+    rgb = np.empty((3, 2**(3*bit_depth)), dtype=np.float64)
+    grid = rgb.reshape((3,) + (2**bit_depth,)*3)
+    grid[0] = centers[:, None, None]
+    grid[1] = centers[None, :, None]
+    grid[2] = centers[None, None, :]
+
+    return np.ascontiguousarray(_convert(rgb, None, 2**14, vector).T)
+
+
+def _convert_lut(rgb, out, tile_size, bit_depth, vector):
+
+    lut = getHlsLut(rgb.dtype, bit_depth, vector)
+    out = _output(rgb, out)
+
+    rgb_flat = rgb.reshape(rgb.shape[0], -1)
+    out_flat = _channel_view(out)
+    num_voxels = rgb_flat.shape[1]
+
+    shift = rgb.dtype.itemsize*8 - bit_depth
+    size = max(1, min(tile_size, num_voxels))
+    index = np.empty((size,), dtype=np.intp)
+    channel = np.empty((size,), dtype=np.intp)
+    values = np.empty((size, 3), dtype=np.float32)
+
+    for begin in range(0, num_voxels, size):
+
+        end = min(begin + size, num_voxels)
+        n = end - begin
+        idx, ch, val = index[:n], channel[:n], values[:n]
+
+        # idx = (r << 2*bit_depth) | (g << bit_depth) | b, of quantized values
+        np.right_shift(rgb_flat[0, begin:end], shift, out=idx, casting='unsafe')
+        for c in (1, 2):
+            np.multiply(idx, 2**bit_depth, out=idx)
+            np.right_shift(rgb_flat[c, begin:end], shift, out=ch, casting='unsafe')
+            np.add(idx, ch, out=idx)
+
+        np.take(lut, idx, axis=0, out=val)
+        out_flat[:, begin:end] = val.T
+
+    return out
+
+
+def _convert(rgb, out, tile_size, vector):
+
+    out = _output(rgb, out)
+
+    rgb_flat = rgb.reshape(rgb.shape[0], -1)
+    out_flat = _channel_view(out)
+    num_voxels = rgb_flat.shape[1]
+
+    normalize = None
+    dtype = rgb.dtype
+    if not np.issubdtype(rgb.dtype, np.floating):
+        normalize = float(np.iinfo(rgb.dtype).max)
+        dtype = np.dtype(np.float64)
+    bits = np.dtype('u%d' % dtype.itemsize)
+
+    # reusable buffers, small enough to stay in cache
+    size = max(1, min(tile_size, num_voxels))
+    maxc, minc, minus, plus, tmp, rc, gc, bc = (
+        np.empty((size,), dtype=dtype) for _ in range(8)
+    )
+    if normalize is not None:
+        normalized = np.empty((3, size), dtype=dtype)
+    not_white, mask = (np.empty((size,), dtype=bits) for _ in range(2))
+    idx = np.empty((size,), dtype=bool)
+    angle, trig = (np.empty((size,), dtype=np.float32) for _ in range(2))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
 
-    return dst
+        for begin in range(0, num_voxels, size):
+
+            end = min(begin + size, num_voxels)
+            n = end - begin
+
+            r, g, b = (rgb_flat[c, begin:end] for c in range(3))
+            if normalize is not None:
+                r, g, b = (
+                    np.divide(v, normalize, out=normalized[c, :n])
+                    for c, v in enumerate((r, g, b)))
+            h, l, s = (out_flat[c, begin:end] for c in range(3))
+            mx, mn, mi, pl, tm = maxc[:n], minc[:n], minus[:n], plus[:n], tmp[:n]
+            rcn, gcn, bcn = rc[:n], gc[:n], bc[:n]
+            nw, msk, ix = not_white[:n], mask[:n], idx[:n]
+
+            np.maximum(r, g, out=mx)
+            np.maximum(mx, b, out=mx)
+            np.minimum(r, g, out=mn)
+            np.minimum(mn, b, out=mn)
+
+            # lightness
+            np.add(mn, mx, out=pl)
+            np.divide(pl, 2.0, out=l)
+
+            # all bits set where not white
+            np.not_equal(mn, mx, out=ix)
+            _bitmask(ix, nw)
+            np.subtract(mx, mn, out=mi)
+
+            # saturation, minus / plus if dark, else minus / (2 - plus)
+            np.divide(mi, pl, out=rcn)
+            np.subtract(2.0, pl, out=tm)
+            np.divide(mi, tm, out=gcn)
+            np.less(l, 0.5, out=ix)
+            _select(ix, rcn, gcn, tm, msk)
+            np.bitwise_and(tm.view(bits), nw, out=tm.view(bits))
+            np.copyto(s, tm, casting='same_kind')
+
+            # hue
+            np.subtract(mx, r, out=rcn)
+            np.divide(rcn, mi, out=rcn)
+            np.subtract(mx, g, out=gcn)
+            np.divide(gcn, mi, out=gcn)
+            np.subtract(mx, b, out=bcn)
+            np.divide(bcn, mi, out=bcn)
+
+            # red is max
+            np.subtract(bcn, gcn, out=tm)
+            # green is max
+            np.add(rcn, 2.0, out=pl)
+            np.subtract(pl, bcn, out=pl)
+            np.equal(g, mx, out=ix)
+            _select(ix, pl, tm, tm, msk)
+            # blue is max
+            np.add(gcn, 4.0, out=pl)
+            np.subtract(pl, rcn, out=pl)
+            np.equal(b, mx, out=ix)
+            _select(ix, pl, tm, tm, msk)
+
+            np.bitwise_and(tm.view(bits), nw, out=tm.view(bits))
+            np.copyto(h, tm, casting='same_kind')
+
+            # (h / 6) % 1, with h / 6 in [-1/6, 5/6]
+            np.divide(h, 6.0, out=h)
+            np.less(h, 0, out=ix)
+            np.add(h, ix, out=h)
+
+            if vector:
+
+                a, t = angle[:n], trig[:n]
+                np.multiply(h, 2, out=a)
+                np.multiply(a, np.pi, out=a)
+
+                # (h, l, s) -> (s * cos, s * sin, l)
+                np.cos(a, out=t)
+                np.multiply(s, t, out=h)
+                np.sin(a, out=t)
+                np.multiply(s, t, out=t)
+                np.copyto(s, l)
+                np.copyto(l, t)
+
+    return out
+
+
+def _output(rgb, out):
+
+    # the array to convert into, channels beyond the first three are zero
+    assert rgb.shape[0] >= 3, "RGB data needs at least 3 channels"
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.float32)
+    out[3:] = 0
+
+    return out
+
+
+def _channel_view(out):
+
+    # flat view of each channel, fails instead of copying
+    out_flat = out.view()
+    try:
+        out_flat.shape = (out.shape[0], -1)
+    except AttributeError:
+        raise AssertionError("out has to be contiguous in each channel")
+
+    return out_flat
+
+
+def _bitmask(condition, mask):
+    """Set all bits of ``mask`` where ``condition`` is true, clear otherwise."""
+
+    np.copyto(mask, condition)
+    np.negative(mask, out=mask)
+
+
+def _select(condition, a, b, out, mask):
+    """Bitwise ``out = where(condition, a, b)``, overwrites ``a`` and
+    ``mask``. ``out`` can be ``b``."""
+
+    _bitmask(condition, mask)
+    a_bits = a.view(mask.dtype)
+    np.bitwise_and(a_bits, mask, out=a_bits)
+    np.invert(mask, out=mask)
+    np.bitwise_and(b.view(mask.dtype), mask, out=mask)
+    np.bitwise_or(a_bits, mask, out=out.view(mask.dtype))
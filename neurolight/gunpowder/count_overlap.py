@@ -1,16 +1,43 @@
 import numpy as np
 from gunpowder import *
 
+from .overlap import compute_overlap
+
 
 class CountOverlap(BatchFilter):
+    '''Count the number of instances per voxel.
+
+    Args:
+
+        gt (:class:`ArrayKey`):
+
+            The instances, one channel per instance.
+
+        gt_overlap (:class:`ArrayKey`):
+
+            The count to provide.
+
+        maxnuminst (``int``, optional):
 
-    def __init__(self, gt, gt_overlap, maxnuminst=None):
+            Upper bound of the count.
+
+        overlap_cache (:class:`OverlapCache`, optional):
+
+            A cache shared with a :class:`RemoveOverlap` node for the same
+            ``gt``, such that the instances are read once.
+    '''
+
+    def __init__(self, gt, gt_overlap, maxnuminst=None, overlap_cache=None):
 
         self.gt = gt
         self.gt_overlap = gt_overlap
         self.maxnuminst = maxnuminst
+        self.overlap_cache = overlap_cache
         self.dims = None
 
+        if overlap_cache is not None:
+            overlap_cache.register(gt, 'count')
+
     def setup(self):
 
         self.dims = self.spec.get_total_roi().dims()
@@ -26,12 +53,22 @@ class CountOverlap(BatchFilter):
         num_channels = len(array.shape) - self.dims
         assert num_channels <= 1, 'Sorry, dont know what to do with more than one channel dimension.'
 
-        overlap = np.sum((array > 0).astype('uint16'), axis=0)
-        print('overlap: ', np.sum(overlap), np.unique(overlap))
+        if self.overlap_cache is not None:
+            count = self.overlap_cache.get(self.gt, batch[self.gt], self.dims).count
+        else:
+            count = compute_overlap(array, self.dims, cleaned=False).count
+
+        overlap = np.empty(count.shape, dtype=np.int32)
         if self.maxnuminst is not None:
-            overlap = np.clip(overlap, 0, self.maxnuminst)
+            np.minimum(count, self.maxnuminst, out=overlap)
+        else:
+            np.copyto(overlap, count)
 
         spec.dtype = np.int32
 
-        batch[self.gt_overlap] = Array(data=(overlap).astype(np.int32),
-                spec=spec)
+        batch[self.gt_overlap] = Array(data=overlap, spec=spec)
+
+    def teardown(self):
+
+        if self.overlap_cache is not None:
+            self.overlap_cache.clear()
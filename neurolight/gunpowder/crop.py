@@ -0,0 +1,24 @@
+from gunpowder import Array
+
+from .instance_stack import InstanceStack, instance_stack_array
+
+
+def crop_view(array, roi):
+    '''Crop an :class:`Array` to ``roi``, without copying the data.
+
+    The data of the returned array is a view of the data of ``array`` (or a
+    cropped :class:`InstanceStack`), modifications in place therefore affect
+    both.
+    '''
+
+    spec = array.spec.copy()
+    spec.roi = roi
+
+    slices = ((roi - array.spec.roi.get_begin())/array.spec.voxel_size).to_slices()
+    channel_slices = (slice(None),)*(array.data.ndim - roi.dims())
+    data = array.data[channel_slices + slices]
+
+    if isinstance(data, InstanceStack):
+        return instance_stack_array(data, spec)
+
+    return Array(data, spec)
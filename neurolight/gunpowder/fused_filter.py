@@ -0,0 +1,293 @@
+import numpy as np
+from gunpowder import *
+import logging
+
+from .clip import _bound
+from .convert_rgb_to_hls import getHls, getHlsVector
+from .overlap import compute_overlap
+
+logger = logging.getLogger(__name__)
+
+
+class FusedFilter(BatchFilter):
+    '''Run several elementwise operations in a single pass over the data.
+
+    Each operation reads from one array and either modifies it in place (see
+    :class:`ClipOp`) or writes into new arrays (see :class:`HlsOp`,
+    :class:`BinarizeOp`, :class:`CountOverlapOp`, and
+    :class:`RemoveOverlapOp`). All outputs are allocated once per batch, the
+    operations are then applied in order to tiles of consecutive sections
+    (along the first spatial axis), such that each tile is read from memory
+    once and intermediate results stay in the CPU cache. Operations can read
+    the outputs of previous operations.
+
+    The results are the same as chaining the corresponding nodes, e.g.::
+
+        FusedFilter([
+            ClipOp(raw, 0, 1),
+            HlsOp(raw, hls_vector, vector=True),
+            BinarizeOp(gt, gt_fg),
+            CountOverlapOp(gt, gt_overlap),
+            RemoveOverlapOp(gt, gt_cleaned)])
+
+    instead of ``Clip(raw, 0, 1) + ConvertRgbToHlsVector(raw, hls_vector) +
+    BinarizeLabels(gt, gt_fg) + ...``.
+
+    Args:
+
+        ops (``list`` of :class:`FusedOp`):
+
+            The operations to apply, in this order.
+
+        tile_size (``int``, optional):
+
+            Approximate number of voxels per tile, rounded to whole sections.
+
+        spatial_dims (``int``, optional):
+
+            The number of spatial dimensions. Leading dimensions of ROIs with
+            more dimensions are channels (e.g., of arrays merged by
+            :class:`MergeChannel`), tiles are taken along the first spatial
+            axis. By default, all dimensions of the ROIs are spatial.
+    '''
+
+    def __init__(self, ops, tile_size=2**16, spatial_dims=None):
+
+        self.ops = ops
+        self.tile_size = tile_size
+        self.spatial_dims = spatial_dims
+
+        # the overlap outputs per array, computed together
+        self.overlap_outputs = {}
+        for op in ops:
+            if op.overlap_output is not None:
+                self.overlap_outputs.setdefault(op.array, set()).add(op.overlap_output)
+
+    def setup(self):
+
+        specs = {}
+        for op in self.ops:
+
+            if op.array in specs:
+                spec = specs[op.array]
+            else:
+                spec = self.spec[op.array]
+
+            for key in op.outputs:
+                specs[key] = op.output_spec(key, spec, self.__dims(spec))
+                self.provides(key, specs[key])
+
+    def prepare(self, request):
+        pass
+
+    def process(self, batch, request):
+
+        ops = []
+        for op in self.ops:
+
+            if op.array not in batch.arrays:
+                continue
+
+            outputs = [key for key in op.outputs if key in request]
+            if op.outputs and not outputs:
+                continue
+
+            spec = batch[op.array].spec
+            dims = self.__dims(spec)
+            data = batch[op.array].data
+
+            # do not modify memory shared with other arrays (views)
+            if op.modifies_input and not (data.flags.owndata and data.flags.writeable):
+                data = batch[op.array].data = data.copy()
+
+            for key in outputs:
+                batch[key] = Array(
+                    np.empty(op.output_shape(data.shape, dims), dtype=op.outputs[key]),
+                    op.output_spec(key, spec, dims))
+
+            section_size = int(np.prod(data.shape[data.ndim - dims + 1:]))
+            tile_depth = max(1, self.tile_size//section_size)
+            depth = data.shape[data.ndim - dims]
+
+            ops.append((op, outputs, dims, tile_depth, depth))
+
+        if not ops:
+            return
+
+        num_tiles = max(-(-depth//tile_depth) for _, _, _, tile_depth, depth in ops)
+
+        for t in range(num_tiles):
+
+            # intermediate results shared by the operations of this tile
+            cache = {
+                (key, 'overlap_outputs'): outputs
+                for key, outputs in self.overlap_outputs.items()}
+
+            for op, outputs, dims, tile_depth, depth in ops:
+
+                begin = t*tile_depth
+                if begin >= depth:
+                    continue
+                end = min(begin + tile_depth, depth)
+
+                op(
+                    _tile(batch[op.array].data, dims, begin, end),
+                    [_tile(batch[key].data, dims, begin, end) for key in outputs],
+                    dims,
+                    cache)
+
+    def __dims(self, spec):
+
+        # the number of spatial dimensions of an array
+        if self.spatial_dims is None:
+            return spec.roi.dims()
+        return min(spec.roi.dims(), self.spatial_dims)
+
+
+def _tile(data, dims, begin, end):
+    return data[(slice(None),)*(data.ndim - dims) + (slice(begin, end),)]
+
+
+class FusedOp(object):
+    '''Base class for operations of a :class:`FusedFilter`.
+
+    Args:
+
+        array (:class:`ArrayKey`):
+
+            The array to read.
+
+        outputs (``dict``, :class:`ArrayKey` -> ``dtype``):
+
+            The arrays this operation writes and their data types.
+    '''
+
+    # outputs have the spatial shape of the input, without channels
+    spatial_outputs = False
+
+    # the input is modified in place
+    modifies_input = False
+
+    # the overlap output (see compute_overlap) this operation uses
+    overlap_output = None
+
+    def __init__(self, array, outputs):
+
+        self.array = array
+        self.outputs = outputs
+
+    def output_spec(self, key, spec, dims):
+
+        spec = spec.copy()
+        spec.dtype = self.outputs[key]
+        if self.spatial_outputs and spec.roi.dims() > dims:
+            # without the channel dimensions
+            spec.roi = Roi(spec.roi.get_offset()[-dims:], spec.roi.get_shape()[-dims:])
+            if spec.voxel_size is not None:
+                spec.voxel_size = Coordinate(spec.voxel_size[-dims:])
+        return spec
+
+    def output_shape(self, shape, dims):
+
+        if self.spatial_outputs:
+            return shape[-dims:]
+        return shape
+
+    def __call__(self, data, outputs, dims, cache):
+        '''Process a tile of ``data`` and write into the same tiles of the
+        ``outputs`` that are requested.'''
+        raise NotImplementedError()
+
+
+class ClipOp(FusedOp):
+    '''Clip ``array`` in place, see :class:`Clip`. ``min`` and ``max`` can be
+    scalars or contain one value per channel. Arrays that do not own their
+    memory (views of other arrays) are copied first.'''
+
+    modifies_input = True
+
+    def __init__(self, array, min, max):
+
+        super(ClipOp, self).__init__(array, {})
+        self.min = min
+        self.max = max
+
+    def __call__(self, data, outputs, dims, cache):
+
+        np.clip(data, _bound(self.min, data), _bound(self.max, data), out=data)
+
+
+class HlsOp(FusedOp):
+    '''Convert RGB to HLS (or the HLS vector, if ``vector`` is set), see
+    :class:`ConvertRgbToHls`.'''
+
+    def __init__(self, rgb, hls, vector=False, bit_depth=None):
+
+        super(HlsOp, self).__init__(rgb, {hls: np.float32})
+        self.vector = vector
+        self.bit_depth = bit_depth
+
+    def __call__(self, data, outputs, dims, cache):
+
+        convert = getHlsVector if self.vector else getHls
+        convert(data, out=outputs[0], bit_depth=self.bit_depth)
+
+
+class BinarizeOp(FusedOp):
+    '''Binarize labels, see :class:`BinarizeLabels`.'''
+
+    def __init__(self, labels, labels_binary):
+
+        super(BinarizeOp, self).__init__(labels, {labels_binary: np.uint8})
+
+    def __call__(self, data, outputs, dims, cache):
+
+        np.greater(data, 0, out=outputs[0])
+
+
+class CountOverlapOp(FusedOp):
+    '''Count the number of instances per voxel, see :class:`CountOverlap`.'''
+
+    spatial_outputs = True
+    overlap_output = 'count'
+
+    def __init__(self, gt, gt_overlap, maxnuminst=None):
+
+        super(CountOverlapOp, self).__init__(gt, {gt_overlap: np.int32})
+        self.maxnuminst = maxnuminst
+
+    def __call__(self, data, outputs, dims, cache):
+
+        overlap = outputs[0]
+        np.copyto(overlap, _overlap(self.array, data, dims, cache).count)
+        if self.maxnuminst is not None:
+            np.minimum(overlap, self.maxnuminst, out=overlap)
+
+
+class RemoveOverlapOp(FusedOp):
+    '''Merge instances into one label volume, without voxels that are part of
+    several instances, see :class:`RemoveOverlap`. Unlike the node, ``gt`` is
+    not grown to the requested size of ``gt_cleaned``.'''
+
+    spatial_outputs = True
+    overlap_output = 'cleaned'
+
+    def __init__(self, gt, gt_cleaned):
+
+        super(RemoveOverlapOp, self).__init__(gt, {gt_cleaned: np.uint16})
+
+    def __call__(self, data, outputs, dims, cache):
+
+        np.copyto(outputs[0], _overlap(self.array, data, dims, cache).cleaned)
+
+
+def _overlap(key, data, dims, cache):
+
+    if (key, 'overlap') not in cache:
+        cache[(key, 'overlap')] = compute_overlap(
+            data,
+            dims,
+            cleaned='cleaned' in cache.get((key, 'overlap_outputs'), {'cleaned'}),
+            tile_size=data.size)
+
+    return cache[(key, 'overlap')]
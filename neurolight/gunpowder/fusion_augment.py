@@ -1,14 +1,19 @@
 import numpy as np
 from gunpowder import Array, BatchFilter
 from scipy import ndimage
+from .crop import crop_view
+from .hdf5_pool import close_hdf5
+from .relabel import relabel, unique_labels
 
+import h5py
+import itertools
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class FusionAugment(BatchFilter):
-    """Combine foreground of two volumes.
+    """Combine foreground of two or more volumes.
         
         Fusion process details:
         The whole "base" volume is kept un-modified, we simply add the
@@ -26,24 +31,28 @@ class FusionAugment(BatchFilter):
         be achieved by using the "GetNeuronPair" node.
         Note: if the "base" labels overlap with the "add" labels which will often
         occur if you want the true signals to be close, the overlapping areas will
-        be given a label of -1 in the fused_labels array.
+        be given a label of -1 in the fused_labels array (which wraps around to
+        the largest representable value for unsigned label types).
+        Several "add" volumes can be given, all selected objects of those are
+        fused into the "base" volume in a single pass.
 
         Args:
             raw_base (:class:``ArrayKey``):
 
                 The intensity array for "base" volume.
 
-            raw_add (:class:``ArrayKey``):
+            raw_add (:class:``ArrayKey`` or ``list`` of :class:``ArrayKey``):
 
-                The intensity array for "add" volume.
+                The intensity array(s) for "add" volume(s).
 
             labels_base (:class:``ArrayKey``):
 
                 The labeled array for "base" volume.
 
-            labels_add (:class:``ArrayKey``):
+            labels_add (:class:``ArrayKey`` or ``list`` of :class:``ArrayKey``):
 
-                The labeled array for "add" volume.
+                The labeled array(s) for "add" volume(s), one for each array in
+                ``raw_add``.
 
             raw_fused (:class:``ArrayKey``):
 
@@ -62,6 +71,43 @@ class FusionAugment(BatchFilter):
             blend_smoothness (``float``, optional):
 
                 Set sigma for gaussian smoothing of labels mask of "add" volume.
+
+            num_blended_objects (``int``, optional):
+
+                Number of objects to randomly sample from all objects of the
+                "add" volumes. If 0 (the default), all objects are blended.
+                Otherwise, the intensities of each "add" volume are masked by
+                its sampled objects before blending, such that objects that
+                were not sampled do not appear in the fused volume.
+
+            alpha_add (:class:``ArrayKey`` or ``list`` of :class:``ArrayKey``, optional):
+
+                Precomputed smoothed labels masks of the "add" volumes, one for
+                each array in ``labels_add`` (see :func:`precompute_alpha`). If
+                given, these are cropped from the store instead of smoothing the
+                labels mask in every batch. Precomputed masks contain all
+                objects of an "add" volume and can not be combined, they are
+                therefore only used for a single "add" volume of which all
+                objects are blended. With several "add" volumes, or if
+                ``num_blended_objects`` sampled some of the objects, the mask
+                of the blended objects is smoothed in the batch instead, as
+                without ``alpha_add``. If the arrays have a
+                ``blend_smoothness`` attribute (as stored by
+                :func:`precompute_alpha` and passed on by
+                :class:`Hdf5ChannelSource`), it has to match
+                ``blend_smoothness``.
+
+            in_place (``bool``, optional):
+
+                If set, fuse the raw volumes using preallocated ``float32``
+                buffers and in-place arithmetic. Besides the fused output, only
+                single-channel ``float32`` buffers are allocated (the alpha
+                mask, one scratch channel for non-``float32`` raw data and one
+                for the sum of several "add" volumes), such that the peak
+                memory used by this node stays below twice the size of the
+                "base" raw array for multi-channel ``float32`` data. Arithmetic
+                is done in ``float32``, results can therefore differ from the
+                default mode in the last bits.
     """
 
     def __init__(
@@ -75,21 +121,38 @@ class FusionAugment(BatchFilter):
         blend_mode="labels_mask",
         blend_smoothness=3,
         num_blended_objects=0,
+        alpha_add=None,
+        in_place=False,
     ):
 
+        if not isinstance(raw_add, (list, tuple)):
+            raw_add = [raw_add]
+        if not isinstance(labels_add, (list, tuple)):
+            labels_add = [labels_add]
+        if alpha_add is not None and not isinstance(alpha_add, (list, tuple)):
+            alpha_add = [alpha_add]
+
         self.raw_base = raw_base
-        self.raw_add = raw_add
+        self.raw_add = list(raw_add)
         self.labels_base = labels_base
-        self.labels_add = labels_add
+        self.labels_add = list(labels_add)
         self.raw_fused = raw_fused
         self.labels_fused = labels_fused
         self.blend_mode = blend_mode
         self.blend_smoothness = blend_smoothness
         self.num_blended_objects = num_blended_objects
+        self.alpha_add = list(alpha_add) if alpha_add is not None else None
+        self.in_place = in_place
 
         assert self.blend_mode in ["intensity", "labels_mask"], (
             "Unknown blend mode %s." % self.blend_mode
         )
+        assert len(self.raw_add) == len(self.labels_add), (
+            "Number of raw and labels arrays for \"add\" volumes differ."
+        )
+        assert self.alpha_add is None or len(self.alpha_add) == len(self.labels_add), (
+            "Number of alpha and labels arrays for \"add\" volumes differ."
+        )
 
     def setup(self):
 
@@ -98,13 +161,19 @@ class FusionAugment(BatchFilter):
 
     def prepare(self, request):
 
-        # add "base" and "add" volume to request
+        # add "base" and "add" volumes to request
         request[self.raw_base] = request[self.raw_fused].copy()
-        request[self.raw_add] = request[self.raw_fused].copy()
+        for raw_add in self.raw_add:
+            request[raw_add] = request[self.raw_fused].copy()
 
         # enlarge roi for labels to be the same size as the raw data for mask generation
         request[self.labels_base] = request[self.raw_fused].copy()
-        request[self.labels_add] = request[self.raw_fused].copy()
+        for labels_add in self.labels_add:
+            request[labels_add] = request[self.raw_fused].copy()
+
+        if self.alpha_add is not None and self.blend_mode == "labels_mask":
+            for alpha_add in self.alpha_add:
+                request[alpha_add] = request[self.raw_fused].copy()
 
     def process(self, batch, request):
 
@@ -113,26 +182,124 @@ class FusionAugment(BatchFilter):
         labels_base_array = batch[self.labels_base].data
 
         # Get add arrays
-        raw_add_array = batch[self.raw_add].data
-        labels_add_array = batch[self.labels_add].data
+        raw_add_arrays = [batch[key].data for key in self.raw_add]
+        labels_add_arrays = [batch[key].data for key in self.labels_add]
 
         # fuse labels
-        fused_labels_array = self._relabel(labels_base_array.astype(np.int32))
+        fused_labels_array, add_mask, object_masks = self._fuse_labels(
+            labels_base_array, labels_add_arrays
+        )
+
+        # fuse raw
+        raw_fused_array = self._fuse_raw(
+            batch, raw_base_array, raw_add_arrays, add_mask, object_masks
+        )
+
+        # load specs
+        labels_base_spec = batch[self.labels_base].spec.copy()
+        labels_fused_spec = request[self.labels_fused].copy()
+        raw_base_spec = batch[self.raw_base].spec.copy()
+
+        # return raw and labels for "fused" volume
+        batch.arrays[self.raw_fused] = Array(
+            data=raw_fused_array.astype(raw_base_spec.dtype, copy=False),
+            spec=raw_base_spec,
+        )
+
+        # crop first, such that only the requested labels are converted
+        labels_base_spec.dtype = fused_labels_array.dtype
+        labels_fused_array = crop_view(
+            Array(data=fused_labels_array, spec=labels_base_spec),
+            labels_fused_spec.roi,
+        )
+        labels_dtype = labels_fused_spec.dtype or self.spec[self.labels_fused].dtype
+        labels_fused_array.spec.dtype = labels_dtype
+        labels_fused_array.data = labels_fused_array.data.astype(
+            labels_dtype, copy=False
+        )
+        batch.arrays[self.labels_fused] = labels_fused_array
+
+        return batch
+
+    def _fuse_labels(self, labels_base_array, labels_add_arrays):
+
+        fused_labels_array = relabel(labels_base_array)
         next_label_id = np.max(fused_labels_array) + 1
 
-        add_mask = np.zeros_like(fused_labels_array, dtype=bool)
-        for label in np.unique(labels_add_array):
-            if label == 0:
+        # all objects of all "add" volumes as (volume, label) pairs
+        objects = [
+            (i, label)
+            for i, labels_add_array in enumerate(labels_add_arrays)
+            for label in unique_labels(labels_add_array)
+            if label != 0
+        ]
+        sampled = 0 < self.num_blended_objects < len(objects)
+        if sampled:
+            chosen = np.random.choice(
+                len(objects), self.num_blended_objects, replace=False
+            )
+            objects = [objects[j] for j in sorted(chosen)]
+
+        claimed = fused_labels_array > 0
+        overlap = np.zeros_like(claimed)
+        add_mask = np.zeros_like(claimed)
+
+        # masks of the sampled objects of each "add" volume, None if all
+        # objects are blended
+        object_masks = None
+        if sampled:
+            object_masks = [np.zeros_like(claimed) for _ in labels_add_arrays]
+
+        # relabel the chosen objects of each "add" volume in one pass, objects
+        # that were not chosen are mapped to 0
+        for i, labels_add_array in enumerate(labels_add_arrays):
+
+            old_values = [label for j, label in objects if j == i]
+            if len(old_values) == 0:
                 continue
-            label_mask = labels_add_array == label
-            add_mask[label_mask] = True
-            fused_labels_array[label_mask] = next_label_id
-            next_label_id += 1
-            # handle overlap
-            overlap = np.logical_and(fused_labels_array, label_mask)
-            fused_labels_array[overlap] = -1
+            new_values = np.arange(
+                next_label_id, next_label_id + len(old_values), dtype=np.int32
+            )
+            next_label_id += len(old_values)
+
+            add_labels = relabel(labels_add_array, old_values, new_values)
+            object_mask = add_labels > 0
+
+            # handle overlap with "base" objects and previous "add" objects
+            overlap |= np.logical_and(object_mask, claimed)
+            claimed |= object_mask
+            add_mask |= object_mask
+            if object_masks is not None:
+                object_masks[i] = object_mask
+
+            np.copyto(fused_labels_array, add_labels, where=object_mask)
+
+        fused_labels_array[overlap] = -1
+
+        return fused_labels_array, add_mask, object_masks
+
+    def _fuse_raw(self, batch, raw_base_array, raw_add_arrays, add_mask, object_masks):
+
+        soft_mask = None
+        if self.blend_mode == "labels_mask":
+            soft_mask = self._soft_mask(batch, add_mask, object_masks)
+
+        if self.in_place:
+            return self._fuse_raw_in_place(
+                raw_base_array, raw_add_arrays, add_mask, soft_mask, object_masks
+            )
+
+        if object_masks is not None:
+            # only the sampled objects (masks broadcast over channels)
+            raw_add_arrays = [
+                np.where(object_mask, array, 0)
+                for array, object_mask in zip(raw_add_arrays, object_masks)
+            ]
+
+        raw_add_array = raw_add_arrays[0]
+        for array in raw_add_arrays[1:]:
+            raw_add_array = raw_add_array + array.astype(np.float32)
 
-        # fuse raw
         if self.blend_mode == "intensity":
 
             add_mask = raw_add_array.astype(np.float32) / np.max(raw_add_array)
@@ -140,46 +307,207 @@ class FusionAugment(BatchFilter):
 
         elif self.blend_mode == "labels_mask":
 
-            soft_mask = np.zeros_like(add_mask, dtype="float32")
+            raw_fused_array = soft_mask * raw_add_array + raw_base_array
+
+        else:
+            raise NotImplementedError("Unknown blend mode %s." % self.blend_mode)
+
+        return raw_fused_array
+
+    def _soft_mask(self, batch, add_mask, object_masks):
+
+        if self.alpha_add is not None:
+            for key in self.alpha_add:
+                smoothness = batch[key].attrs.get("blend_smoothness")
+                if smoothness is not None and smoothness != self.blend_smoothness:
+                    raise RuntimeError(
+                        "%s was smoothed with blend_smoothness %s, but "
+                        "blend_smoothness is %s" % (key, smoothness, self.blend_smoothness)
+                    )
+
+        # the smoothed mask was precomputed (see precompute_alpha()), but only
+        # for all objects of each "add" volume separately
+        if (
+            self.alpha_add is not None
+            and len(self.alpha_add) == 1
+            and object_masks is None
+        ):
+
+            soft_mask = batch[self.alpha_add[0]].data.astype(np.float32)
+
+        else:
+
+            soft_mask = add_mask.astype(np.float32)
             ndimage.gaussian_filter(
-                add_mask.astype("float32"),
-                sigma=self.blend_smoothness,
-                output=soft_mask,
-                mode="nearest",
+                soft_mask, sigma=self.blend_smoothness, output=soft_mask, mode="nearest"
             )
-            soft_mask /= np.max(soft_mask)
-            soft_mask = np.clip((soft_mask * 2), 0, 1)
 
-            raw_fused_array = soft_mask * raw_add_array + raw_base_array
+        soft_mask /= np.max(soft_mask)
+        soft_mask *= 2
+        np.clip(soft_mask, 0, 1, out=soft_mask)
+
+        return soft_mask
+
+    def _fuse_raw_in_place(
+        self, raw_base_array, raw_add_arrays, add_mask, soft_mask, object_masks
+    ):
+
+        raw_fused_array = np.empty_like(raw_base_array)
+        channels = list(np.ndindex(raw_base_array.shape[:-add_mask.ndim]))
+
+        # several or masked "add" volumes are summed up one channel at a time
+        add_sum = None
+        if len(raw_add_arrays) > 1 or object_masks is not None:
+            add_sum = np.empty(add_mask.shape, dtype=np.float32)
 
+        if self.blend_mode == "labels_mask":
+            alpha = soft_mask
         else:
-            raise NotImplementedError("Unknown blend mode %s." % self.blend_mode)
+            alpha = np.empty(add_mask.shape, dtype=np.float32)
+            max_add = max(
+                np.max(self._add_channel(raw_add_arrays, c, add_sum, object_masks))
+                for c in channels
+            )
 
-        # load specs
-        labels_add_spec = batch[self.labels_add].spec.copy()
-        labels_fused_spec = request[self.labels_fused].copy()
-        raw_base_spec = batch[self.raw_base].spec.copy()
+        # non-float32 outputs are computed in a float32 scratch channel first
+        direct = raw_fused_array.dtype == np.float32
+        if not direct:
+            scratch = np.empty(add_mask.shape, dtype=np.float32)
 
-        # return raw and labels for "fused" volume
-        batch.arrays[self.raw_fused] = Array(
-            data=raw_fused_array.astype(raw_base_spec.dtype), spec=raw_base_spec
-        )
-        batch.arrays[self.labels_fused] = Array(
-            data=labels_base_array.astype(labels_fused_spec.dtype), spec=labels_add_spec
-        ).crop(labels_fused_spec.roi)
+        # fuse one channel at a time, such that all temporaries are the size
+        # of a single channel
+        for c in channels:
+
+            base = raw_base_array[c]
+            add = self._add_channel(raw_add_arrays, c, add_sum, object_masks)
+            out = raw_fused_array[c] if direct else scratch
+
+            if self.blend_mode == "labels_mask":
+
+                # base + alpha * add
+                np.multiply(alpha, add, out=out, dtype=np.float32)
+                np.add(out, base, out=out, dtype=np.float32)
+
+            else:
+
+                # (1 - alpha) * base + alpha * add = base + alpha * (add - base),
+                # with alpha = add / max(add)
+                np.divide(add, max_add, out=alpha, dtype=np.float32)
+                np.subtract(add, base, out=out, dtype=np.float32)
+                np.multiply(out, alpha, out=out)
+                np.add(out, base, out=out, dtype=np.float32)
+
+            if not direct:
+                raw_fused_array[c] = out
+
+        return raw_fused_array
+
+    def _add_channel(self, raw_add_arrays, c, add_sum, object_masks):
+
+        if add_sum is None:
+            return raw_add_arrays[0][c]
+
+        add_sum[...] = 0
+        for i, array in enumerate(raw_add_arrays):
+            where = object_masks[i] if object_masks is not None else True
+            np.add(add_sum, array[c], out=add_sum, where=where, dtype=np.float32)
+
+        return add_sum
 
-        return batch
 
-    def _relabel(self, a):
+def precompute_alpha(
+    filename,
+    labels_dataset,
+    alpha_dataset,
+    blend_smoothness=3,
+    block_shape=None,
+    chunks=None,
+):
+    """Precompute the smoothed labels mask ("alpha") of a static "add" volume.
 
-        labels = list(np.unique(a))
-        if 0 in labels:
-            labels.remove(0)
+    The labels mask is smoothed blockwise, with a halo large enough for the
+    gaussian kernel, such that the result is the same as smoothing the whole
+    volume at once. It is stored in the chunked ``float32`` dataset
+    ``alpha_dataset`` in the same file, together with the ``resolution`` and
+    ``offset`` of the labels. Provide this dataset to :class:`FusionAugment`
+    via ``alpha_add`` to skip smoothing during training.
 
-        old_values = np.asarray(labels, dtype=np.int32)
-        new_values = np.arange(1, len(labels) + 1, dtype=np.int32)
+    Args:
 
-        values_map = np.arange(int(a.max() + 1), dtype=new_values.dtype)
-        values_map[old_values] = new_values
+        filename (``string``):
 
-        return values_map[a.copy()]
+            The HDF5 file containing the labels, the alpha dataset will be
+            written to the same file.
+
+        labels_dataset (``string``):
+
+            The labels of the "add" volume.
+
+        alpha_dataset (``string``):
+
+            The dataset to create, will be overwritten if it exists.
+
+        blend_smoothness (``float``, optional):
+
+            Sigma for gaussian smoothing, should match the ``blend_smoothness``
+            of the :class:`FusionAugment` node using the alpha.
+
+        block_shape (``tuple`` of ``int``, optional):
+
+            Shape of the blocks to process at once, 128 voxels in each
+            dimension by default.
+
+        chunks (``tuple`` of ``int``, optional):
+
+            The chunk shape of the alpha dataset, 64 voxels in each dimension
+            by default.
+    """
+
+    # radius of the gaussian kernel used by scipy (truncate=4.0)
+    radius = int(4.0 * blend_smoothness + 0.5)
+
+    # pooled read-only handles of sources would prevent opening for writing
+    close_hdf5(filename)
+
+    with h5py.File(filename, "r+") as data_file:
+
+        labels = data_file[labels_dataset]
+        shape = labels.shape
+        if block_shape is None:
+            block_shape = (128,) * len(shape)
+        if chunks is None:
+            chunks = (64,) * len(shape)
+        chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+
+        if alpha_dataset in data_file:
+            del data_file[alpha_dataset]
+        alpha = data_file.create_dataset(
+            alpha_dataset, shape=shape, dtype=np.float32, chunks=chunks
+        )
+        for key in ["resolution", "offset"]:
+            if key in labels.attrs:
+                alpha.attrs[key] = labels.attrs[key]
+        alpha.attrs["blend_smoothness"] = blend_smoothness
+
+        for begin in itertools.product(
+            *(range(0, s, b) for s, b in zip(shape, block_shape))
+        ):
+
+            block = tuple(
+                slice(b, min(b + bs, s)) for b, bs, s in zip(begin, block_shape, shape)
+            )
+            context = tuple(
+                slice(max(b.start - radius, 0), min(b.stop + radius, s))
+                for b, s in zip(block, shape)
+            )
+            inner = tuple(
+                slice(b.start - c.start, b.stop - c.start) for b, c in zip(block, context)
+            )
+
+            logger.debug("Smoothing labels mask in block %s", block)
+
+            mask = (labels[context] > 0).astype(np.float32)
+            ndimage.gaussian_filter(
+                mask, sigma=blend_smoothness, output=mask, mode="nearest"
+            )
+            alpha[block] = mask[inner]
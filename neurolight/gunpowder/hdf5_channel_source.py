@@ -1,4 +1,8 @@
 from __future__ import print_function
+from contextlib import nullcontext
+import itertools
+import logging
+import threading
 import numpy as np
 import h5py
 from gunpowder.roi import Roi
@@ -9,10 +13,25 @@ from gunpowder.array import Array
 from gunpowder.coordinate import Coordinate
 from gunpowder.array_spec import ArraySpec
 
+from .block_cache import BlockCache
+from .buffer_pool import BufferPool
+from .hdf5_pool import pooled_hdf5
+from .instance_stack import InstanceStack, instance_stack_array
+from .prefetch import Prefetcher
+from .pyramid import pyramid_levels
+from .reader_pool import ReaderPool
+from .spec_cache import load_metadata
+
+logger = logging.getLogger(__name__)
+
 
 class Hdf5ChannelSource(Hdf5LikeSource):
     '''An HDF5 data source with channels
 
+    Numeric attributes of the datasets (other than ``resolution`` and
+    ``offset``, e.g., the ``blend_smoothness`` of :func:`precompute_alpha`)
+    are passed on as ``attrs`` of the arrays.
+
     Args:
 
         filename (``string``):
@@ -23,9 +42,23 @@ class Hdf5ChannelSource(Hdf5LikeSource):
 
             Dictionary of array keys to dataset names that this source offers.
 
-        channel_ids (``dict``, :class:`ArrayKey` -> ``int``):
+            Instead of a dataset, the name can refer to a group with a
+            multiscale pyramid of datasets ``s0``, ``s1``, ... (see
+            :func:`build_pyramid`), or be a list of dataset names of the
+            levels. The array is then read from the level that has the voxel
+            size given in ``array_specs``, or from the first level if none is
+            given. Levels without ``resolution`` attribute are assumed to be
+            downsampled by 2 per level.
+
+        channel_ids (``dict``, :class:`ArrayKey` -> ``int`` or ``list``, optional):
 
             Dictionary of array keys to dataset channel index for this source.
+            Arrays without a channel index (or with ``None``) contain all
+            channels, in the first dimension. For a list of channel indices,
+            the channels are read directly into one array with the channels in
+            the first dimension, in the given order. Arrays of single channels
+            of the same dataset are read together in one read over the
+            channel range, and provided as views of it.
 
         data_format (``string``):
 
@@ -38,73 +71,542 @@ class Hdf5ChannelSource(Hdf5LikeSource):
             the array specs automatically determined from the data file. This
             is useful to set a missing ``voxel_size``, for example. Only fields
             that are not ``None`` in the given :class:`ArraySpec` will be used.
+
+        instance_stacks (``list`` of :class:`ArrayKey`, optional):
+
+            Arrays of overlapping instances (one channel per instance, all
+            channels), to provide as compact :class:`InstanceStack`. For
+            ``channels_first`` data, the channels are read one after another,
+            such that the dense stack is never in memory.
+
+        keep_open (``bool``, optional):
+
+            Keep the file open between requests, in a handle pool per
+            process (see :func:`open_hdf5`), instead of opening it for every
+            request (default). Use :func:`close_hdf5` to close it, e.g.,
+            before the file is written by other means than
+            :func:`precompute_alpha` or :func:`build_pyramid`, which close
+            pooled handles themselves.
+
+        rdcc_nbytes (``int``, optional):
+
+            The size of the HDF5 chunk cache per dataset in bytes. With
+            ``keep_open``, decompressed chunks in the cache are reused across
+            requests.
+
+        rdcc_nslots (``int``, optional):
+
+            The number of slots of the HDF5 chunk cache per dataset.
+
+        chunk_aligned (``bool``, optional):
+
+            For chunked ``channels_last`` datasets, read whole blocks of
+            chunks with all channels and extract the requested channels with
+            NumPy, instead of strided reads of single channels (default).
+
+        block_cache (:class:`BlockCache` or ``int``, optional):
+
+            A cache of decoded blocks (with all channels), or the byte budget
+            of a new one. Requests are assembled from the cached blocks, only
+            missing blocks are read (together, in one read). The same cache
+            can be shared by several sources, and across processes (see
+            :class:`BlockCache`); blocks are keyed by dataset and block shape.
+            Disabled by default.
+
+        block_shape (``tuple`` of ``int``, optional):
+
+            The spatial shape of cached blocks, in voxels. Defaults to the
+            chunk shape of the dataset, or 64 voxels per dimension for
+            datasets without chunks.
+
+        read_ahead (``int``, optional):
+
+            The number of requests to read ahead in background threads, see
+            :class:`Prefetcher`. Upcoming requests are announced with
+            :meth:`hint`, or predicted if requests follow a constant shift
+            (as in a scan). The time ``provide`` waits for data is reported
+            as ``stall`` in the profiling stats. Disabled by default.
+
+        read_ahead_threads (``int``, optional):
+
+            The number of background threads for ``read_ahead``.
+
+        buffer_pool (:class:`BufferPool` or ``int``, optional):
+
+            A pool of arrays to read into, or the number of arrays per shape
+            and type of a new one. Arrays are reused once downstream nodes
+            released them, instead of allocating new ones for each request.
+            Allocations and reuses are reported as ``allocate`` and ``reuse``
+            in the profiling stats. Disabled by default.
+
+        reader_processes (``int``, optional):
+
+            The number of dedicated reader processes, each with its own handle
+            of the file, see :class:`ReaderPool`. Reads are split among the
+            readers, which write directly into arrays in shared memory (also
+            those of ``buffer_pool``), such that they run in parallel despite
+            the global lock of the HDF5 library. Disabled by default.
+
+        spec_cache (``bool`` or ``string``, optional):
+
+            Cache the metadata read in :meth:`setup` (shapes, types, chunks,
+            and numeric attributes of the datasets) in a JSON sidecar,
+            valid as long as modification time and size of the file do not
+            change. ``True`` for a sidecar ``<filename>.specs.json`` next to
+            the file, or a directory for the sidecars (e.g., if the data is
+            read-only). Use :func:`discover_specs` to read the specs of many
+            sources concurrently. Disabled by default.
     '''
 
     def __init__(
             self,
             filename,
             datasets,
-            channel_ids,
+            channel_ids=None,
             data_format='channels_first',
-            array_specs=None):
+            array_specs=None,
+            instance_stacks=None,
+            keep_open=False,
+            rdcc_nbytes=None,
+            rdcc_nslots=None,
+            chunk_aligned=True,
+            block_cache=None,
+            block_shape=None,
+            read_ahead=0,
+            read_ahead_threads=1,
+            buffer_pool=None,
+            reader_processes=0,
+            spec_cache=None):
 
         super(Hdf5ChannelSource, self).__init__(filename, datasets, array_specs)
-        self.channel_ids = channel_ids
+        self.channel_ids = channel_ids if channel_ids is not None else {}
         self.data_format = data_format
+        self.instance_stacks = set(instance_stacks) if instance_stacks is not None else set()
+        self.keep_open = keep_open
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.chunk_aligned = chunk_aligned
+        if isinstance(block_cache, int):
+            block_cache = BlockCache(block_cache)
+        self.block_cache = block_cache
+        self.block_shape = tuple(block_shape) if block_shape is not None else None
+        if isinstance(buffer_pool, int):
+            buffer_pool = BufferPool(buffer_pool)
+        self.buffer_pool = buffer_pool
+        self.__allocations = {}
+        self.__attrs = {}
+        self.spec_cache = spec_cache
+        self.reader_pool = None
+        if reader_processes > 0:
+            self.reader_pool = ReaderPool(filename, reader_processes, rdcc_nbytes, rdcc_nslots)
+        self.prefetcher = None
+        if read_ahead > 0:
+            self.prefetcher = Prefetcher(
+                self.__provide,
+                self.__contains,
+                max_pending=read_ahead,
+                num_threads=read_ahead_threads)
+
+        for key in self.instance_stacks:
+            assert self.channel_ids.get(key) is None, (
+                "instance stack %s has to contain all channels" % key)
 
     def _open_file(self, filename):
-        return h5py.File(filename, 'r')
+        if self.keep_open:
+            return pooled_hdf5(filename, self.rdcc_nbytes, self.rdcc_nslots)
+        kwargs = {}
+        if self.rdcc_nbytes is not None:
+            kwargs['rdcc_nbytes'] = self.rdcc_nbytes
+        if self.rdcc_nslots is not None:
+            kwargs['rdcc_nslots'] = self.rdcc_nslots
+        return h5py.File(filename, 'r', **kwargs)
 
     def setup(self):
-        with self._open_file(self.filename) as data_file:
-            for (array_key, ds_name) in self.datasets.items():
+        with self.__open_metadata() as data_file:
+            for (array_key, ds_name) in list(self.datasets.items()):
 
+                ds_name = self.__pyramid_level(array_key, data_file, ds_name)
                 if ds_name not in data_file:
                     raise RuntimeError("%s not in %s" % (ds_name, self.filename))
+                self.datasets[array_key] = ds_name
                 spec = self.__read_spec(array_key, data_file, ds_name)
+                self.__attrs[array_key] = _numeric_attrs(data_file[ds_name])
 
                 self.provides(array_key, spec)
 
+    def __open_metadata(self):
+        if self.spec_cache is None:
+            return self._open_file(self.filename)
+        return nullcontext(load_metadata(self))
+
+    def __pyramid_level(self, array_key, data_file, ds_name):
+
+        # the dataset of the pyramid level with the requested voxel size
+        if isinstance(ds_name, (list, tuple)):
+            levels = list(ds_name)
+        elif ds_name in data_file and hasattr(data_file[ds_name], 'keys'):
+            levels = [ds_name.rstrip('/') + '/' + level for level in pyramid_levels(data_file[ds_name])]
+        else:
+            return ds_name
+
+        if not levels:
+            raise RuntimeError("%s in %s has no pyramid levels" % (ds_name, self.filename))
+
+        voxel_size = None
+        if array_key in self.array_specs:
+            voxel_size = self.array_specs[array_key].voxel_size
+        if voxel_size is None:
+            return levels[0]
+
+        level_voxel_sizes = []
+        for i, level in enumerate(levels):
+            if level not in data_file:
+                raise RuntimeError("%s not in %s" % (level, self.filename))
+            level_voxel_size = self._get_voxel_size(data_file[level])
+            if level_voxel_size is None:
+                level_voxel_size = Coordinate((2**i,)*len(voxel_size))
+            if level_voxel_size == voxel_size:
+                offset = self._get_offset(data_file[level])
+                if offset is not None and offset % voxel_size != Coordinate((0,)*len(voxel_size)):
+                    raise RuntimeError(
+                        "offset %s of %s in %s is not a multiple of its voxel size %s" % (
+                            offset, level, self.filename, voxel_size))
+                logger.debug("reading %s from %s", array_key, level)
+                return level
+            level_voxel_sizes.append(level_voxel_size)
+
+        raise RuntimeError(
+            "no level of %s in %s has voxel size %s (levels have %s)" % (
+                ds_name, self.filename, voxel_size, level_voxel_sizes))
+
+    def _read_selection(self, dataset, selection, out=None):
+        '''Read ``selection`` (a tuple of slices and indices) of ``dataset``,
+        into ``out`` if given.'''
+        if out is None:
+            out = self._allocate(_selection_shape(selection, dataset.shape), dataset.dtype)
+        if self.reader_pool is not None:
+            return self.reader_pool.read(dataset, selection, out=out)
+        if out.size > 0:
+            dataset.read_direct(out, source_sel=selection)
+        return out
+
+    def _allocate(self, shape, dtype):
+        '''An uninitialized array to read into, from the buffer pool if
+        enabled, in the shared memory of the reader pool if enabled.'''
+        timings = self.__allocations.get(threading.get_ident())
+        timing = None
+        if timings is not None:
+            timing = Timing(self, 'allocate')
+            timing.start()
+        allocate = np.empty
+        if self.reader_pool is not None:
+            allocate = self.reader_pool.allocate
+        if self.buffer_pool is None:
+            data = allocate(shape, dtype=dtype)
+        else:
+            data, reused = self.buffer_pool.get(shape, dtype, allocate)
+            if timing is not None and reused:
+                timing = Timing(self, 'reuse')
+        if timing is not None:
+            timing.stop()
+            timings.append(timing)
+        return data
+
     def __read(self, data_file, ds_name, roi, channel_id):
-        c = len(data_file[ds_name].shape) - self.ndims - 1
+        dataset = data_file[ds_name]
+        c = len(dataset.shape) - self.ndims - 1
+        if channel_id is None:
+            return self.__read_all(dataset, roi, c)
+        if isinstance(channel_id, (list, tuple)):
+            return self.__read_channels(dataset, roi, c, channel_id)
         if self.data_format == 'channels_first':
-            return np.asarray(data_file[ds_name][(slice(channel_id, channel_id + 1),) + (slice(None),)*c + roi.to_slices()])
+            if self.__use_blocks(dataset, c):
+                return self.__read_blocks(dataset, roi, slice(channel_id, channel_id + 1))
+            return self._read_selection(dataset, (slice(channel_id, channel_id + 1),) + (slice(None),)*c + roi.to_slices())
         if self.data_format == 'channels_last':
-            return np.reshape(np.asarray(data_file[ds_name][(slice(None),)*c + roi.to_slices() +
-                                                            (slice(channel_id, channel_id + 1),)]),roi.get_shape())
+            if self.__use_blocks(dataset, c):
+                return self.__read_blocks(dataset, roi, channel_id)
+            return self._read_selection(dataset, (slice(None),)*c + roi.to_slices() + (channel_id,))
+
+    def __read_all(self, dataset, roi, c):
+        if self.__use_blocks(dataset, c):
+            return self.__read_blocks(dataset, roi, slice(None))
+        if self.data_format == 'channels_first':
+            return self._read_selection(dataset, (slice(None),)*(c + 1) + roi.to_slices())
+        if self.data_format == 'channels_last':
+            return np.moveaxis(self._read_selection(dataset, (slice(None),)*c + roi.to_slices() + (slice(None),)), -1, 0)
+
+    def __read_channels(self, dataset, roi, c, channel_ids):
+        if self.__use_blocks(dataset, c):
+            return self.__read_blocks(dataset, roi, list(channel_ids))
+        if self.data_format == 'channels_first':
+            shape = dataset.shape[1:c + 1]
+            selections = [(i,) + (slice(None),)*c + roi.to_slices() for i in channel_ids]
+        if self.data_format == 'channels_last':
+            shape = dataset.shape[:c]
+            selections = [(slice(None),)*c + roi.to_slices() + (i,) for i in channel_ids]
+        data = self._allocate((len(channel_ids),) + shape + tuple(roi.get_shape()), dataset.dtype)
+        for channel, selection in zip(data, selections):
+            self._read_selection(dataset, selection, out=channel)
+        return data
+
+    def __read_instance_stack(self, data_file, ds_name, roi):
+        dataset = data_file[ds_name]
+        c = len(dataset.shape) - self.ndims - 1
+        assert c == 0, "instance stacks need a single channel dimension"
+        if self.data_format == 'channels_first':
+            num_channels = dataset.shape[0]
+            channels = (
+                self._read_selection(dataset, (i,) + roi.to_slices())
+                for i in range(num_channels))
+        if self.data_format == 'channels_last':
+            num_channels = dataset.shape[-1]
+            if self.__use_blocks(dataset, c):
+                data = self.__read_blocks(dataset, roi, slice(None))
+                channels = (data[i] for i in range(num_channels))
+            else:
+                data = self._read_selection(dataset, roi.to_slices() + (slice(None),))
+                channels = (data[..., i] for i in range(num_channels))
+        return InstanceStack.from_channels(channels, num_channels)
+
+    def __use_blocks(self, dataset, c):
+        # read through blocks of whole chunks or the block cache
+        if c != 0:
+            return False
+        if self.block_cache is not None:
+            return True
+        return (
+            self.data_format == 'channels_last' and
+            self.chunk_aligned and
+            dataset.chunks is not None)
+
+    def __read_blocks(self, dataset, roi, channels):
+        # the selected channels (index, slice, or list) in roi, channels first,
+        # assembled from blocks
+        num_channels = dataset.shape[0 if self.data_format == 'channels_first' else -1]
+        channel_shape = np.shape(np.arange(num_channels)[channels])
+        data = self._allocate(channel_shape + tuple(roi.get_shape()), dataset.dtype)
+
+        if self.block_cache is None:
+            chunks = dataset.chunks[:-1]
+            begin = tuple(b//s*s for b, s in zip(roi.get_begin(), chunks))
+            end = tuple(min(-(-e//s)*s, d) for e, s, d in zip(roi.get_end(), chunks, self.__spatial_shape(dataset)))
+            block = self.__read_native(dataset, begin, end)
+            self.__copy_block(data, roi, channels, block, begin)
+            return data
+
+        block_shape = self.__block_shape(dataset)
+        shape = self.__spatial_shape(dataset)
+        first = [b//s for b, s in zip(roi.get_begin(), block_shape)]
+        last = [(e - 1)//s for e, s in zip(roi.get_end(), block_shape)]
+
+        missing = []
+        for index in itertools.product(*[range(f, l + 1) for f, l in zip(first, last)]):
+            begin = tuple(i*s for i, s in zip(index, block_shape))
+            end = tuple(min(b + s, d) for b, s, d in zip(begin, block_shape, shape))
+            block = self.block_cache.get(
+                (self.filename, dataset.name, block_shape, index),
+                self.__native_shape(dataset, begin, end),
+                dataset.dtype)
+            if block is None:
+                missing.append((index, begin, end))
+            else:
+                self.__copy_block(data, roi, channels, block, begin)
+
+        if missing:
+
+            # one read over all missing blocks
+            read_begin = tuple(np.min([begin for _, begin, _ in missing], axis=0))
+            read_end = tuple(np.max([end for _, _, end in missing], axis=0))
+            read = self.__read_native(dataset, read_begin, read_end)
+
+            for index, begin, end in missing:
+                slices = tuple(
+                    slice(b - rb, e - rb)
+                    for b, e, rb in zip(begin, end, read_begin))
+                block = self.block_cache.put(
+                    (self.filename, dataset.name, block_shape, index),
+                    read[self.__native_slices(slices)])
+                self.__copy_block(data, roi, channels, block, begin)
+
+        return data
+
+    def __copy_block(self, data, roi, channels, block, block_begin):
+        # copy the part of block (in dataset layout) inside roi into data
+        block_shape = self.__spatial_shape(block)
+        begin = [max(b, bb) for b, bb in zip(roi.get_begin(), block_begin)]
+        end = [min(e, bb + s) for e, bb, s in zip(roi.get_end(), block_begin, block_shape)]
+        source = tuple(slice(b - bb, e - bb) for b, e, bb in zip(begin, end, block_begin))
+        target = tuple(slice(b - rb, e - rb) for b, e, rb in zip(begin, end, roi.get_begin()))
+        if self.data_format == 'channels_first':
+            block = block[(channels,) + source]
+        else:
+            block = block[source + (channels,)]
+            if block.ndim > len(source):
+                block = np.moveaxis(block, -1, 0)
+        data[(slice(None),)*(data.ndim - len(target)) + target] = block
+
+    def __read_native(self, dataset, begin, end):
+        slices = tuple(slice(b, e) for b, e in zip(begin, end))
+        return self._read_selection(dataset, self.__native_slices(slices))
+
+    def __native_slices(self, slices):
+        if self.data_format == 'channels_first':
+            return (slice(None),) + slices
+        return slices + (slice(None),)
+
+    def __native_shape(self, dataset, begin, end):
+        shape = tuple(e - b for b, e in zip(begin, end))
+        if self.data_format == 'channels_first':
+            return (dataset.shape[0],) + shape
+        return shape + (dataset.shape[-1],)
+
+    def __spatial_shape(self, data):
+        if self.data_format == 'channels_first':
+            return data.shape[1:]
+        return data.shape[:-1]
+
+    def __block_shape(self, dataset):
+        if self.block_shape is not None:
+            return self.block_shape
+        if dataset.chunks is not None:
+            if self.data_format == 'channels_first':
+                return dataset.chunks[1:]
+            return dataset.chunks[:-1]
+        return (64,)*self.ndims
+
+    def teardown(self):
+        if self.block_cache is not None:
+            logger.info("block cache of %s: %s", self.filename, self.block_cache.stats())
+        if self.prefetcher is not None:
+            logger.info(
+                "read ahead of %s: %d hits, %d misses",
+                self.filename, self.prefetcher.hits, self.prefetcher.misses)
+            self.prefetcher.shutdown()
+        if self.reader_pool is not None:
+            self.reader_pool.shutdown()
+        if self.buffer_pool is not None:
+            logger.info(
+                "buffer pool of %s: %d allocations, %d reuses",
+                self.filename, self.buffer_pool.allocations, self.buffer_pool.reuses)
+
+    def hint(self, request):
+        '''Announce an upcoming request, to be read in the background if
+        ``read_ahead`` is enabled.'''
+        if self.prefetcher is not None and self.__contains(request):
+            self.prefetcher.hint(request)
 
     def provide(self, request):
 
+        if self.prefetcher is None:
+            return self.__provide(request)
+
+        stall = Timing(self, 'stall')
+        stall.start()
+        batch = self.prefetcher.get(request)
+        stall.stop()
+        batch.profiling_stats.add(stall)
+
+        return batch
+
+    def __contains(self, request):
+        return all(
+            array_key in self.spec and self.spec[array_key].roi.contains(spec.roi)
+            for array_key, spec in request.array_specs.items())
+
+    def __provide(self, request):
+
         timing = Timing(self)
         timing.start()
 
         batch = Batch()
 
+        # allocations of this thread, to report in the profiling stats
+        allocations = self.__allocations[threading.get_ident()] = []
+
         with self._open_file(self.filename) as data_file:
-            for (array_key, request_spec) in request.array_specs.items():
 
-                voxel_size = self.spec[array_key].voxel_size
+            shared = self.__read_shared_channels(data_file, request)
 
-                # scale request roi to voxel units
-                dataset_roi = request_spec.roi / voxel_size
+            for (array_key, request_spec) in request.array_specs.items():
 
-                # shift request roi into dataset
-                dataset_roi = dataset_roi - self.spec[array_key].roi.get_offset() / voxel_size
+                dataset_roi = self.__dataset_roi(array_key, request_spec.roi)
 
                 # create array spec
                 array_spec = self.spec[array_key].copy()
                 array_spec.roi = request_spec.roi
 
                 # add array to batch
-                batch.arrays[array_key] = Array(
-                    self.__read(data_file, self.datasets[array_key], dataset_roi, self.channel_ids[array_key]),
-                    array_spec)
+                if array_key in shared:
+                    batch.arrays[array_key] = Array(shared[array_key], array_spec)
+                elif array_key in self.instance_stacks:
+                    batch.arrays[array_key] = instance_stack_array(
+                        self.__read_instance_stack(data_file, self.datasets[array_key], dataset_roi),
+                        array_spec)
+                else:
+                    batch.arrays[array_key] = Array(
+                        self.__read(data_file, self.datasets[array_key], dataset_roi, self.channel_ids.get(array_key)),
+                        array_spec)
+                batch.arrays[array_key].attrs.update(self.__attrs.get(array_key, {}))
+
+        del self.__allocations[threading.get_ident()]
+        for allocation in allocations:
+            batch.profiling_stats.add(allocation)
 
         timing.stop()
         batch.profiling_stats.add(timing)
 
         return batch
 
+    def __dataset_roi(self, array_key, roi):
+
+        voxel_size = self.spec[array_key].voxel_size
+
+        # scale request roi to voxel units
+        dataset_roi = roi / voxel_size
+
+        # shift request roi into dataset
+        return dataset_roi - self.spec[array_key].roi.get_offset() / voxel_size
+
+    def __read_shared_channels(self, data_file, request):
+
+        # single channels of the same dataset and roi, read together
+        groups = {}
+        for (array_key, request_spec) in request.array_specs.items():
+            channel_id = self.channel_ids.get(array_key)
+            if array_key in self.instance_stacks or not isinstance(channel_id, (int, np.integer)):
+                continue
+            dataset_roi = self.__dataset_roi(array_key, request_spec.roi)
+            group = (self.datasets[array_key], dataset_roi.get_offset(), dataset_roi.get_shape())
+            groups.setdefault(group, []).append(array_key)
+
+        shared = {}
+        for (ds_name, offset, shape), array_keys in groups.items():
+            if len(array_keys) < 2:
+                continue
+            channel_ids = [self.channel_ids[array_key] for array_key in array_keys]
+            views = self.__read_channel_range(data_file[ds_name], Roi(offset, shape), channel_ids)
+            shared.update(zip(array_keys, views))
+
+        return shared
+
+    def __read_channel_range(self, dataset, roi, channel_ids):
+        # one read over all channels from the first to the last requested,
+        # returns the requested channels as views, shaped like __read
+        c = len(dataset.shape) - self.ndims - 1
+        begin, end = min(channel_ids), max(channel_ids) + 1
+        if self.__use_blocks(dataset, c):
+            data = self.__read_blocks(dataset, roi, slice(begin, end))
+            if self.data_format == 'channels_first':
+                return [data[i - begin:i - begin + 1] for i in channel_ids]
+            return [data[i - begin] for i in channel_ids]
+        if self.data_format == 'channels_first':
+            data = self._read_selection(dataset, (slice(begin, end),) + (slice(None),)*c + roi.to_slices())
+            return [data[i - begin:i - begin + 1] for i in channel_ids]
+        if self.data_format == 'channels_last':
+            data = self._read_selection(dataset, (slice(None),)*c + roi.to_slices() + (slice(begin, end),))
+            return [data[..., i - begin] for i in channel_ids]
+
     def __read_spec(self, array_key, data_file, ds_name):
 
         dataset = data_file[ds_name]
@@ -150,4 +652,26 @@ class Hdf5ChannelSource(Hdf5LikeSource):
                 np.uint8  # assuming this is not used for labels
             ]
 
-        return spec
\ No newline at end of file
+        return spec
+
+
+def _selection_shape(selection, shape):
+
+    # the shape of a selection of slices and indices
+    selection = tuple(selection) + (slice(None),)*(len(shape) - len(selection))
+    return tuple(
+        len(range(*s.indices(size)))
+        for s, size in zip(selection, shape)
+        if isinstance(s, slice))
+
+
+def _numeric_attrs(dataset):
+
+    # numeric attributes of a dataset, except resolution and offset
+    attrs = {}
+    for key, value in dataset.attrs.items():
+        if key in ['resolution', 'offset']:
+            continue
+        if np.asarray(value).dtype.kind in 'biuf':
+            attrs[key] = value
+    return attrs
@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+import logging
+import os
+import threading
+
+import h5py
+
+logger = logging.getLogger(__name__)
+
+# open files of this process, by filename and chunk cache settings
+_files = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def open_hdf5(filename, rdcc_nbytes=None, rdcc_nslots=None):
+    '''Get a read-only handle of an HDF5 file from the pool of this process.
+
+    Files stay open between calls, such that the file metadata is parsed
+    once and decompressed chunks stay in the HDF5 chunk cache. The pool
+    belongs to the process that opened the files: After a fork (e.g., in
+    ``PreCache`` workers), the inherited handles are discarded and the files
+    are opened again.
+
+    Args:
+
+        filename (``string``):
+
+            The HDF5 file.
+
+        rdcc_nbytes (``int``, optional):
+
+            The size of the chunk cache per dataset in bytes (HDF5 default is
+            1MB).
+
+        rdcc_nslots (``int``, optional):
+
+            The number of slots of the chunk cache hash table per dataset, a
+            prime about 100 times the number of chunks fitting in the cache
+            is recommended.
+    '''
+
+    global _pid
+
+    key = (os.path.abspath(filename), rdcc_nbytes, rdcc_nslots)
+
+    with _lock:
+
+        if _pid != os.getpid():
+            # do not close the handles of the parent process
+            if _files:
+                logger.debug("discarding %d HDF5 handles after fork", len(_files))
+            _files.clear()
+            _pid = os.getpid()
+
+        data_file = _files.get(key)
+        if data_file is None or not data_file.id.valid:
+
+            kwargs = {}
+            if rdcc_nbytes is not None:
+                kwargs['rdcc_nbytes'] = rdcc_nbytes
+            if rdcc_nslots is not None:
+                kwargs['rdcc_nslots'] = rdcc_nslots
+
+            logger.debug("opening %s", filename)
+            data_file = h5py.File(filename, 'r', **kwargs)
+            _files[key] = data_file
+
+    return data_file
+
+
+@contextmanager
+def pooled_hdf5(filename, rdcc_nbytes=None, rdcc_nslots=None):
+    '''Context manager for a file handle of :func:`open_hdf5`, which keeps the
+    file open on exit (for use in place of ``with h5py.File(...)``).'''
+
+    yield open_hdf5(filename, rdcc_nbytes, rdcc_nslots)
+
+
+def close_hdf5(filename=None):
+    '''Close the pooled handles of ``filename``, or all handles, e.g., before
+    writing to a file.'''
+
+    with _lock:
+
+        if _pid != os.getpid():
+            return
+
+        for key in list(_files.keys()):
+            if filename is None or key[0] == os.path.abspath(filename):
+                data_file = _files.pop(key)
+                if data_file.id.valid:
+                    data_file.close()
@@ -0,0 +1,286 @@
+from copy import deepcopy
+
+import numpy as np
+from gunpowder import Array
+
+
+class InstanceStack(object):
+    '''A compact representation of a stack of overlapping instance labels,
+    with one channel per instance.
+
+    Instead of the dense ``(num_channels,) + shape`` array, the stack is
+    stored as a ``primary`` label volume (the label of the first instance
+    per voxel) with the channel of each primary label, and a sparse list of
+    the flat indices, channels, and labels of all further instances. Memory
+    is therefore proportional to the volume plus the number of overlapping
+    voxels, independent of the number of instances.
+
+    The stack behaves like a read-only dense array where needed: It has a
+    ``shape`` and ``dtype``, slicing with all channels (e.g., by
+    :func:`crop_view`) returns a cropped :class:`InstanceStack`, and
+    everything else converts to the dense array first (via ``np.asarray``).
+
+    Use :meth:`from_dense` or :meth:`from_channels` to create a stack, and
+    :func:`instance_stack_array` to put it in a batch.
+    '''
+
+    def __init__(
+            self,
+            num_channels,
+            primary,
+            primary_channels,
+            overlap_indices,
+            overlap_channels,
+            overlap_labels):
+
+        self.num_channels = num_channels
+        self.primary = primary
+        self.primary_channels = primary_channels
+        self.overlap_indices = overlap_indices
+        self.overlap_channels = overlap_channels
+        self.overlap_labels = overlap_labels
+
+    @staticmethod
+    def from_dense(stack):
+        '''Create an instance stack from a dense array with the channels in
+        the first dimension.'''
+
+        return InstanceStack.from_channels(stack, len(stack))
+
+    @staticmethod
+    def from_channels(channels, num_channels):
+        '''Create an instance stack from an iterable over ``num_channels``
+        label volumes, e.g., to read them one after another.'''
+
+        channel_dtype = np.uint8 if num_channels <= 2**8 else np.uint16
+
+        primary = None
+        indices, overlap_channels, labels = [], [], []
+
+        for c, channel in enumerate(channels):
+
+            channel = np.asarray(channel)
+
+            if primary is None:
+                primary = np.zeros(channel.shape, dtype=channel.dtype)
+                primary_channels = np.zeros(channel.shape, dtype=channel_dtype)
+                is_free = np.empty(channel.shape, dtype=bool)
+
+            foreground = channel != 0
+            np.equal(primary, 0, out=is_free)
+            np.logical_and(is_free, foreground, out=is_free)
+
+            np.copyto(primary, channel, where=is_free)
+            primary_channels[is_free] = c
+
+            # foreground of this channel, where there was one before
+            np.logical_xor(foreground, is_free, out=foreground)
+            overlap = np.flatnonzero(foreground)
+            if len(overlap) > 0:
+                indices.append(overlap)
+                overlap_channels.append(np.full(len(overlap), c, dtype=channel_dtype))
+                labels.append(channel.reshape(-1)[overlap])
+
+        def concatenate(arrays, dtype):
+            if arrays:
+                return np.concatenate(arrays)
+            return np.zeros((0,), dtype=dtype)
+
+        return InstanceStack(
+            num_channels,
+            primary,
+            primary_channels,
+            concatenate(indices, np.int64),
+            concatenate(overlap_channels, channel_dtype),
+            concatenate(labels, primary.dtype))
+
+    @property
+    def shape(self):
+        return (self.num_channels,) + self.primary.shape
+
+    @property
+    def dtype(self):
+        return self.primary.dtype
+
+    @property
+    def ndim(self):
+        return self.primary.ndim + 1
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [
+            self.primary,
+            self.primary_channels,
+            self.overlap_indices,
+            self.overlap_channels,
+            self.overlap_labels])
+
+    def __len__(self):
+        return self.num_channels
+
+    def count(self, dtype=None):
+        '''The number of instances per voxel.'''
+
+        if dtype is None:
+            dtype = np.uint8 if self.num_channels < 2**8 else np.uint16
+
+        count = np.not_equal(self.primary, 0).astype(dtype)
+        indices, counts = np.unique(self.overlap_indices, return_counts=True)
+        count.reshape(-1)[indices] += counts.astype(dtype)
+
+        return count
+
+    def cleaned(self, dtype=None):
+        '''The labels of voxels with exactly one instance.'''
+
+        if dtype is None:
+            dtype = self.dtype
+
+        cleaned = self.primary.astype(dtype)
+        cleaned.reshape(-1)[self.overlap_indices] = 0
+
+        return cleaned
+
+    def to_dense(self):
+        '''Convert into a dense array with one channel per instance.'''
+
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        flat = dense.reshape(self.num_channels, -1)
+
+        foreground = np.flatnonzero(self.primary)
+        flat[self.primary_channels.reshape(-1)[foreground], foreground] = \
+            self.primary.reshape(-1)[foreground]
+        flat[self.overlap_channels, self.overlap_indices] = self.overlap_labels
+
+        return dense
+
+    def copy(self):
+
+        return InstanceStack(
+            self.num_channels,
+            self.primary.copy(),
+            self.primary_channels.copy(),
+            self.overlap_indices.copy(),
+            self.overlap_channels.copy(),
+            self.overlap_labels.copy())
+
+    def astype(self, dtype, copy=True):
+
+        if np.dtype(dtype) == self.dtype and not copy:
+            return self
+        return self.to_dense().astype(dtype)
+
+    def __array__(self, dtype=None):
+
+        dense = self.to_dense()
+        if dtype is not None:
+            dense = dense.astype(dtype)
+        return dense
+
+    def __getitem__(self, item):
+
+        slices = self.__spatial_slices(item)
+        if slices is None:
+            return self.to_dense()[item]
+
+        primary = self.primary[slices]
+
+        # keep overlaps inside the slices, and index into the cropped shape
+        begin = np.array([s.start for s in slices])
+        end = np.array([s.stop for s in slices])
+        coordinates = np.array(np.unravel_index(self.overlap_indices, self.primary.shape))
+        inside = np.all(
+            (coordinates >= begin[:, None]) & (coordinates < end[:, None]),
+            axis=0)
+        indices = np.ravel_multi_index(
+            tuple(coordinates[:, inside] - begin[:, None]),
+            primary.shape).astype(np.int64)
+
+        return InstanceStack(
+            self.num_channels,
+            primary,
+            self.primary_channels[slices],
+            indices,
+            self.overlap_channels[inside],
+            self.overlap_labels[inside])
+
+    def __spatial_slices(self, item):
+
+        # the spatial slices of item, if it selects all channels and a
+        # contiguous spatial region, None otherwise
+        if not isinstance(item, tuple):
+            item = (item,)
+        if len(item) > self.ndim or not all(isinstance(i, slice) for i in item):
+            return None
+        if item[0].indices(self.num_channels) != (0, self.num_channels, 1):
+            return None
+
+        item = item[1:] + (slice(None),)*(self.ndim - len(item))
+        slices = []
+        for s, size in zip(item, self.primary.shape):
+            start, stop, step = s.indices(size)
+            if step != 1:
+                return None
+            slices.append(slice(start, max(start, stop)))
+
+        return tuple(slices)
+
+    def __repr__(self):
+        return "InstanceStack(shape=%s, dtype=%s, overlaps=%d)" % (
+            self.shape, self.dtype, len(self.overlap_indices))
+
+
+class InstanceStackArray(Array):
+    '''A :class:`gunpowder.Array` holding an :class:`InstanceStack`, created
+    by :func:`instance_stack_array`.
+
+    The stack stays compact when the array is cropped (e.g., by
+    ``Batch.crop`` after a downstream node requested a larger ROI). Merging
+    converts the stack into a dense array first.
+    '''
+
+    def crop(self, roi, copy=False):
+
+        assert self.spec.roi.contains(roi), (
+            "Requested crop ROI (%s) doesn't fit in array (%s)" %
+            (roi, self.spec.roi))
+
+        if self.spec.roi == roi and not copy:
+            return self
+
+        stack = self.data[_crop_slices(self, roi)]
+        if copy:
+            stack = stack.copy()
+
+        spec = self.spec.copy()
+        spec.roi = roi
+        cropped = instance_stack_array(stack, spec)
+        cropped.attrs = deepcopy(self.attrs)
+
+        return cropped
+
+    def merge(self, array, copy_from_self=False, copy=False):
+
+        dense = Array(np.asarray(self.data), self.spec, self.attrs)
+        return dense.merge(array, copy_from_self, copy)
+
+
+def instance_stack_array(stack, spec):
+    '''Create an :class:`InstanceStackArray` holding an
+    :class:`InstanceStack`.
+
+    ``Array`` converts its data into a dense array, the stack is therefore
+    set after the spec is validated against a placeholder without memory.
+    '''
+
+    array = InstanceStackArray(np.broadcast_to(np.zeros((), dtype=stack.dtype), stack.shape), spec)
+    array.data = stack
+
+    return array
+
+
+def _crop_slices(array, roi):
+
+    # the slices of the data of array for roi, with all channels
+    slices = ((roi - array.spec.roi.get_begin())/array.spec.voxel_size).to_slices()
+    return (slice(None),)*(len(array.data.shape) - roi.dims()) + slices
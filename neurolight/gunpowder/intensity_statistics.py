@@ -0,0 +1,335 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import logging
+import os
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def compute_statistics(
+        filename,
+        dataset,
+        data_format='channels_first',
+        percentiles=(0.1, 1, 50, 99, 99.9),
+        num_bins=4096,
+        block_shape=None,
+        num_workers=1,
+        statistics_file=None):
+    '''Compute per-channel intensity histograms and percentiles of a dataset.
+
+    The dataset is streamed once in blocks (twice for non-integer types, to
+    find the histogram range first), optionally by several processes. The
+    statistics are added to the JSON ``statistics_file`` (by default the
+    sidecar file of ``filename``, see :func:`statistics_filename`), from
+    where :class:`Clip` reads its clipping bounds.
+
+    Integer data of up to 16 bits is counted per value, such that percentiles
+    are exact. Other data is counted in ``num_bins`` bins between the minimal
+    and maximal value of each channel, percentiles are interpolated.
+
+    Args:
+
+        filename (``string``):
+
+            The HDF5 file.
+
+        dataset (``string``):
+
+            The dataset to compute statistics for.
+
+        data_format (``string``, optional):
+
+            ``channels_first`` (default) or ``channels_last``, as in
+            :class:`Hdf5ChannelSource`.
+
+        percentiles (``tuple`` of ``float``, optional):
+
+            Percentiles to store, others can be computed from the stored
+            histograms with :func:`get_percentiles`.
+
+        num_bins (``int``, optional):
+
+            Number of histogram bins for non-integer data.
+
+        block_shape (``tuple`` of ``int``, optional):
+
+            Spatial shape of the blocks to read at once. Defaults to a
+            multiple of the chunk shape of the dataset of about 128 voxels in
+            each dimension.
+
+        num_workers (``int``, optional):
+
+            Number of processes to read and count blocks.
+
+        statistics_file (``string``, optional):
+
+            The JSON file to write the statistics to.
+
+    Returns:
+
+        The statistics of ``dataset``, as stored in ``statistics_file``.
+    '''
+
+    with h5py.File(filename, 'r') as data_file:
+        ds = data_file[dataset]
+        shape = ds.shape
+        dtype = ds.dtype
+        chunks = ds.chunks
+
+    channel_axis = 0 if data_format == 'channels_first' else len(shape) - 1
+    num_channels = shape[channel_axis]
+    spatial_shape = _spatial(shape, channel_axis)
+
+    if block_shape is None:
+        if chunks is None:
+            block_shape = (128,)*len(spatial_shape)
+        else:
+            block_shape = tuple(
+                c*max(1, 128//c)
+                for c in _spatial(chunks, channel_axis))
+
+    blocks = [
+        tuple(slice(b, min(b + s, d)) for b, s, d in zip(begin, block_shape, spatial_shape))
+        for begin in itertools.product(*(
+            range(0, d, s) for d, s in zip(spatial_shape, block_shape)))
+    ]
+
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+
+        # one bin per value
+        info = np.iinfo(dtype)
+        bin_start = np.full((num_channels,), info.min, dtype=np.float64)
+        bin_width = np.ones((num_channels,), dtype=np.float64)
+        num_bins = int(info.max) - int(info.min) + 1
+        integer = True
+
+    else:
+
+        ranges = _map_blocks(
+            _block_range,
+            (filename, dataset, channel_axis),
+            blocks,
+            num_workers)
+        ranges = np.array(ranges)
+        minimum = ranges[:, 0].min(axis=0)
+        maximum = ranges[:, 1].max(axis=0)
+
+        bin_start = minimum.astype(np.float64)
+        bin_width = (maximum.astype(np.float64) - bin_start)/num_bins
+        bin_width[bin_width == 0] = 1
+        integer = False
+
+    histograms = _map_blocks(
+        _block_histogram,
+        (filename, dataset, channel_axis, bin_start, bin_width, num_bins),
+        blocks,
+        num_workers)
+    histogram = np.sum(histograms, axis=0)
+
+    channels = []
+    for c in range(num_channels):
+
+        nonzero = np.nonzero(histogram[c])[0]
+        if len(nonzero) == 0:
+            first, last = 0, 0
+        else:
+            first, last = nonzero[0], nonzero[-1] + 1
+
+        channel = {
+            'bin_start': float(bin_start[c] + first*bin_width[c]),
+            'bin_width': float(bin_width[c]),
+            'integer': integer,
+            'histogram': histogram[c, first:last].tolist(),
+        }
+        channel['min'] = channel['bin_start']
+        channel['max'] = float(bin_start[c] + (last - integer)*bin_width[c])
+        channel['percentiles'] = {
+            _percentile_key(p): float(v)
+            for p, v in zip(percentiles, _channel_percentiles(channel, percentiles))
+        }
+        channels.append(channel)
+
+    statistics = {
+        'shape': list(shape),
+        'dtype': dtype.name,
+        'data_format': data_format,
+        'channels': channels,
+    }
+
+    if statistics_file is None:
+        statistics_file = statistics_filename(filename)
+    _write_statistics(statistics_file, dataset, statistics)
+
+    return statistics
+
+
+def statistics_filename(filename):
+    '''Get the name of the statistics sidecar file of an HDF5 file.'''
+
+    return os.path.splitext(filename)[0] + '.statistics.json'
+
+
+def read_statistics(statistics_file, dataset=None):
+    '''Read statistics written by :func:`compute_statistics`.
+
+    ``statistics_file`` can also be the HDF5 file the statistics were
+    computed for. ``dataset`` can be omitted if the file contains statistics
+    of a single dataset only.
+    '''
+
+    if not statistics_file.endswith('.json'):
+        statistics_file = statistics_filename(statistics_file)
+
+    with open(statistics_file, 'r') as f:
+        statistics = json.load(f)
+
+    if dataset is None:
+        assert len(statistics) == 1, (
+            "%s contains statistics of several datasets, specify which one "
+            "to use" % statistics_file)
+        dataset = list(statistics.keys())[0]
+
+    return statistics[dataset]
+
+
+def get_percentiles(statistics, percentiles, channels=None):
+    '''Get percentiles of each channel from statistics, as an array of shape
+    ``(len(percentiles), num_channels)``.'''
+
+    if channels is None:
+        channels = range(len(statistics['channels']))
+
+    values = np.empty((len(percentiles), len(channels)), dtype=np.float64)
+    for i, c in enumerate(channels):
+        channel = statistics['channels'][c]
+        stored = channel.get('percentiles', {})
+        for j, p in enumerate(percentiles):
+            key = _percentile_key(p)
+            if key in stored:
+                values[j, i] = stored[key]
+            else:
+                values[j, i] = _channel_percentiles(channel, [p])[0]
+
+    return values
+
+
+def _percentile_key(percentile):
+    return '%g' % percentile
+
+
+def _channel_percentiles(channel, percentiles):
+
+    counts = np.asarray(channel['histogram'], dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return [channel['bin_start']]*len(percentiles)
+
+    cumulative = np.cumsum(counts)
+    values = []
+    for p in percentiles:
+
+        target = p/100.0*total
+        i = min(int(np.searchsorted(cumulative, target)), len(counts) - 1)
+        value = channel['bin_start'] + i*channel['bin_width']
+
+        if not channel['integer']:
+            before = cumulative[i - 1] if i > 0 else 0
+            fraction = (target - before)/counts[i] if counts[i] > 0 else 0
+            value += min(max(fraction, 0), 1)*channel['bin_width']
+
+        values.append(value)
+
+    return values
+
+
+def _spatial(shape, channel_axis):
+    return tuple(s for d, s in enumerate(shape) if d != channel_axis)
+
+
+def _map_blocks(function, args, blocks, num_workers):
+
+    if num_workers <= 1:
+        return function(*(args + (blocks,)))
+
+    # a few groups of blocks per worker to balance the load
+    num_groups = min(len(blocks), 4*num_workers)
+    groups = [blocks[i::num_groups] for i in range(num_groups)]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(function, *(args + (group,))) for group in groups]
+        results = []
+        for future in futures:
+            results += future.result()
+
+    return results
+
+
+def _read_blocks(filename, dataset, channel_axis, blocks):
+
+    with h5py.File(filename, 'r') as data_file:
+        ds = data_file[dataset]
+        for block in blocks:
+            if channel_axis == 0:
+                data = ds[(slice(None),) + block]
+            else:
+                data = np.moveaxis(ds[block + (slice(None),)], -1, 0)
+            yield data.reshape(data.shape[0], -1)
+
+
+def _block_range(filename, dataset, channel_axis, blocks):
+
+    return [
+        (data.min(axis=1), data.max(axis=1))
+        for data in _read_blocks(filename, dataset, channel_axis, blocks)
+    ]
+
+
+def _block_histogram(
+        filename,
+        dataset,
+        channel_axis,
+        bin_start,
+        bin_width,
+        num_bins,
+        blocks):
+
+    histogram = None
+    for data in _read_blocks(filename, dataset, channel_axis, blocks):
+
+        if histogram is None:
+            histogram = np.zeros((data.shape[0], num_bins), dtype=np.int64)
+
+        for c in range(data.shape[0]):
+
+            if data.dtype.kind in 'ui' and data.dtype.itemsize <= 2:
+                index = data[c].astype(np.int64)
+                index -= int(bin_start[c])
+            else:
+                index = (data[c].astype(np.float64) - bin_start[c])/bin_width[c]
+                index = np.clip(index, 0, num_bins - 1).astype(np.int64)
+
+            histogram[c] += np.bincount(index, minlength=num_bins)
+
+    if histogram is None:
+        return []
+    return [histogram]
+
+
+def _write_statistics(statistics_file, dataset, statistics):
+
+    content = {}
+    if os.path.exists(statistics_file):
+        with open(statistics_file, 'r') as f:
+            content = json.load(f)
+    content[dataset] = statistics
+
+    tmp_file = '%s.%d.tmp' % (statistics_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_file, statistics_file)
+
+    logger.info("wrote statistics of %s to %s", dataset, statistics_file)
@@ -0,0 +1,247 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+
+import h5py
+import numpy as np
+
+from .hdf5_channel_source import Hdf5ChannelSource
+
+logger = logging.getLogger(__name__)
+
+
+def export_memmap(
+        filename,
+        datasets,
+        directory,
+        channels=None,
+        data_format='channels_first',
+        block_depth=None):
+    '''Export HDF5 datasets to uncompressed arrays for
+    :class:`MemmapChannelSource`.
+
+    Each dataset is written to ``<directory>/<dataset>.npy`` in
+    ``channels_first`` layout, with its ``resolution`` and ``offset``
+    attributes and the exported channels in ``<directory>/<dataset>.json``.
+    The dataset is copied in blocks, such that it does not have to fit into
+    memory.
+
+    Args:
+
+        filename (``string``):
+
+            The HDF5 file.
+
+        datasets (``list`` of ``string``):
+
+            The datasets to export.
+
+        directory (``string``):
+
+            The directory to export to.
+
+        channels (``dict``, ``string`` -> ``list`` of ``int``, optional):
+
+            The channels to export per dataset, all by default.
+
+        data_format (``string``, optional):
+
+            ``channels_first`` (default) or ``channels_last``, the layout of
+            the datasets in ``filename``.
+
+        block_depth (``int``, optional):
+
+            Number of sections (along the first spatial axis) to copy at
+            once. Defaults to about 256MB per block.
+    '''
+
+    channels = channels if channels is not None else {}
+
+    with h5py.File(filename, 'r') as data_file:
+        for ds_name in datasets:
+
+            dataset = data_file[ds_name]
+            channel_axis = 0 if data_format == 'channels_first' else dataset.ndim - 1
+            ds_channels = channels.get(ds_name, list(range(dataset.shape[channel_axis])))
+            if data_format == 'channels_first':
+                spatial_shape = dataset.shape[1:]
+            else:
+                spatial_shape = dataset.shape[:-1]
+
+            path = os.path.join(directory, ds_name.strip('/'))
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            out = np.lib.format.open_memmap(
+                path + '.npy',
+                mode='w+',
+                dtype=dataset.dtype,
+                shape=(len(ds_channels),) + spatial_shape)
+
+            depth = block_depth
+            if depth is None:
+                section_size = int(np.prod(out.shape))//spatial_shape[0]*out.dtype.itemsize
+                depth = max(1, 2**28//section_size)
+
+            logger.info("exporting %s to %s.npy", ds_name, path)
+            for begin in range(0, spatial_shape[0], depth):
+                end = min(begin + depth, spatial_shape[0])
+                if data_format == 'channels_first':
+                    for i, c in enumerate(ds_channels):
+                        out[i, begin:end] = dataset[c, begin:end]
+                else:
+                    block = dataset[begin:end]
+                    for i, c in enumerate(ds_channels):
+                        out[i, begin:end] = block[..., c]
+
+            out.flush()
+            del out
+
+            attributes = {'channels': [int(c) for c in ds_channels]}
+            for attribute in ['resolution', 'offset']:
+                if attribute in dataset.attrs:
+                    attributes[attribute] = [int(x) for x in dataset.attrs[attribute]]
+            with open(path + '.json', 'w') as f:
+                json.dump(attributes, f)
+
+
+class MemmapChannelSource(Hdf5ChannelSource):
+    '''A data source for arrays exported with :func:`export_memmap`.
+
+    Requests are served by slicing memory mapped arrays, such that reuse is
+    handled by the page cache of the OS. Arrays of single channels, all
+    channels, and channels of the same dataset requested together (see
+    :class:`Hdf5ChannelSource`) are views of the memory map, without copying.
+    Each read maps the file anew and copy-on-write: Modifying arrays in place
+    (e.g., by :class:`Clip`) changes neither the files nor other arrays.
+
+    Args:
+
+        directory (``string``):
+
+            The directory the datasets were exported to.
+
+        datasets (``dict``, :class:`ArrayKey` -> ``string``):
+
+            Dictionary of array keys to dataset names, as in the original
+            file.
+
+        channel_ids (``dict``, :class:`ArrayKey` -> ``int`` or ``list``, optional):
+
+            The channels as in the original dataset, see
+            :class:`Hdf5ChannelSource`. Only exported channels can be used.
+
+        array_specs (``dict``, :class:`ArrayKey` -> :class:`ArraySpec`, optional):
+
+            Array specs to overwrite the specs determined from the exported
+            attributes.
+    '''
+
+    def __init__(
+            self,
+            directory,
+            datasets,
+            channel_ids=None,
+            array_specs=None,
+            read_ahead=0,
+            read_ahead_threads=1):
+
+        super(MemmapChannelSource, self).__init__(
+            directory,
+            datasets,
+            channel_ids=channel_ids,
+            data_format='channels_first',
+            array_specs=array_specs,
+            keep_open=False,
+            read_ahead=read_ahead,
+            read_ahead_threads=read_ahead_threads)
+
+        self.original_channel_ids = dict(self.channel_ids)
+        self.directory = None
+
+    def setup(self):
+
+        # channels of the original dataset to exported channels
+        with self._open_file(self.filename) as data_file:
+            for array_key, channel_id in self.original_channel_ids.items():
+                ds_name = self.datasets[array_key]
+                if channel_id is None or ds_name not in data_file:
+                    continue
+                exported = data_file[ds_name].attrs['channels']
+                if isinstance(channel_id, (list, tuple)):
+                    self.channel_ids[array_key] = [exported.index(c) for c in channel_id]
+                else:
+                    self.channel_ids[array_key] = exported.index(channel_id)
+
+        super(MemmapChannelSource, self).setup()
+
+    def _open_file(self, directory):
+        # the dataset headers are read once
+        if self.directory is None:
+            self.directory = _MemmapDirectory(directory)
+        return _opened(self.directory)
+
+    def _read_selection(self, dataset, selection, out=None):
+        if out is None:
+            return np.asarray(dataset[selection])
+        out[...] = dataset[selection]
+        return out
+
+
+@contextmanager
+def _opened(directory):
+    yield directory
+
+
+class _MemmapDirectory(object):
+
+    # the subset of h5py.File used by the sources
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.datasets = {}
+
+    def __contains__(self, ds_name):
+        return os.path.exists(self.__path(ds_name) + '.npy')
+
+    def __getitem__(self, ds_name):
+        if ds_name not in self.datasets:
+            self.datasets[ds_name] = _MemmapDataset(self.__path(ds_name), ds_name)
+        return self.datasets[ds_name]
+
+    def __path(self, ds_name):
+        return os.path.join(self.directory, ds_name.strip('/'))
+
+
+class _MemmapDataset(object):
+
+    chunks = None
+
+    def __init__(self, path, name):
+
+        self.path = path + '.npy'
+        self.name = name
+        with open(path + '.json', 'r') as f:
+            self.attrs = json.load(f)
+
+        with open(self.path, 'rb') as f:
+            if np.lib.format.read_magic(f) == (1, 0):
+                self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_2_0(f)
+            self.offset = f.tell()
+        assert not fortran_order, "%s is not in C order" % self.path
+
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, selection):
+        # a new copy-on-write mapping for each read, such that arrays modified
+        # in place do not affect each other
+        data = np.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode='c',
+            offset=self.offset,
+            shape=self.shape)
+        return data[selection]
@@ -3,30 +3,116 @@ from gunpowder import Roi
 import numpy as np
 
 
-#todo: list of channels to be merged
 class MergeChannel(gp.BatchFilter):
+    '''Merge several arrays into one array with one channel per array.
 
-    def __init__(self, fg, bg, raw):
-        self.fg = fg
-        self.bg = bg
-        self.raw = raw
+    The merged array is allocated once with the target data type and each
+    array is copied into its channel. If the arrays are already consecutive
+    channels of the same memory (e.g., channels of the same dataset read
+    together by :class:`Hdf5ChannelSource`) and of the target data type, the
+    merged array is a view of that memory instead.
+
+    Args:
+
+        arrays (``list`` of :class:`ArrayKey`):
+
+            The arrays to merge, in channel order. All have to have the same
+            ROI and voxel size. Arrays with a single leading channel are
+            accepted as well.
+
+        merged (:class:`ArrayKey`):
+
+            The array key to store the merged array in. Its ROI and voxel size
+            contain the channels as first dimension.
+
+        dtype (``dtype``, optional):
+
+            The data type of the merged array. Defaults to the data type of
+            the first array.
+
+    For backwards compatibility, ``MergeChannel(fg, bg, raw)`` merges ``fg``
+    and ``bg`` into ``raw``.
+    '''
+
+    def __init__(self, arrays, merged, raw=None, dtype=None):
+
+        if raw is not None:
+            arrays, merged = [arrays, merged], raw
+
+        self.arrays = list(arrays)
+        self.merged = merged
+        self.dtype = dtype
 
     def setup(self):
-        spec = self.spec[self.fg].copy()
-        spec.roi = Roi((0,) + spec.roi.get_offset(), (3,) + spec.roi.get_shape())
-        self.provides(self.raw, spec)
+
+        spec = self.spec[self.arrays[0]].copy()
+        self.provides(self.merged, self.__merged_spec(spec))
 
     def prepare(self, request):
         pass
 
     def process(self, batch, request):
 
-        spec = self.spec[self.fg].copy()
-        voxel_size = (1,) + spec.voxel_size
-        merged = np.stack([batch[self.fg].data, batch[self.bg].data], axis=0)
+        spec = self.__merged_spec(batch[self.arrays[0]].spec)
+        shape = batch[self.arrays[0]].spec.roi.get_shape()/batch[self.arrays[0]].spec.voxel_size
+
+        merged = _channel_view([batch[key].data for key in self.arrays], tuple(shape))
+        if merged is not None and merged.dtype == spec.dtype:
+            batch[self.merged] = gp.Array(data=merged, spec=spec)
+            return
+
+        merged = np.empty((len(self.arrays),) + tuple(shape), dtype=spec.dtype)
+        for channel, key in zip(merged, self.arrays):
+            data = batch[key].data
+            assert data.size == channel.size, (
+                "can not merge %s of shape %s into channel of shape %s" % (
+                    key, data.shape, channel.shape))
+            np.copyto(channel, data.reshape(channel.shape), casting='unsafe')
+
+        batch[self.merged] = gp.Array(data=merged, spec=spec)
+
+    def __merged_spec(self, spec):
+
+        dtype = self.dtype if self.dtype is not None else spec.dtype
+
+        return gp.ArraySpec(
+            dtype=dtype,
+            roi=Roi(
+                (0,) + spec.roi.get_offset(),
+                (len(self.arrays),) + spec.roi.get_shape()),
+            interpolatable=True,
+            voxel_size=(1,) + spec.voxel_size)
+
+
+def _channel_view(arrays, shape):
+
+    # a view of the memory of arrays with the arrays as channels, if they are
+    # consecutive slices of the same base array, None otherwise
+    if not all(isinstance(a, np.ndarray) for a in arrays):
+        return None
+    base = arrays[0].base
+    if not isinstance(base, np.ndarray) or any(a.base is not base for a in arrays):
+        return None
+    if any(a.size != int(np.prod(shape)) or a.dtype != base.dtype for a in arrays):
+        return None
+
+    arrays = [a.reshape(shape) for a in arrays]
+    begin = arrays[0].__array_interface__['data'][0]
+    base_begin = base.__array_interface__['data'][0]
+
+    for axis in range(base.ndim):
+
+        stride = base.strides[axis]
+        if stride == 0 or base.shape[:axis] + base.shape[axis + 1:] != shape:
+            continue
+        if (begin - base_begin) % stride != 0:
+            continue
+
+        first = (begin - base_begin)//stride
+        channels = np.moveaxis(base, axis, 0)[first:first + len(arrays)]
+        if len(channels) == len(arrays) and all(
+                c.__array_interface__ == a.__array_interface__
+                for c, a in zip(channels, arrays)):
+            return channels
 
-        batch[self.raw] = gp.Array(data=merged.astype(spec.dtype),
-                                   spec=gp.ArraySpec(dtype=spec.dtype,
-                                                     roi=Roi((0, 0, 0, 0), merged.shape) * voxel_size,
-                                                     interpolatable=True,
-                                                     voxel_size=voxel_size))
+    return None
@@ -0,0 +1,179 @@
+from collections import namedtuple
+import weakref
+
+import numpy as np
+
+from .instance_stack import InstanceStack
+
+Overlap = namedtuple('Overlap', ['count', 'cleaned'])
+
+
+def compute_overlap(
+        instances,
+        dims,
+        count=True,
+        cleaned=True,
+        dtype=np.uint16,
+        tile_size=2**16):
+    '''Count the instances per voxel and merge the instances into a single
+    label volume without overlapping voxels, in one pass.
+
+    The instance channels are accumulated tile by tile (of whole sections
+    along the first spatial axis), such that each tile is read once and the
+    count stays in the cache for the cleaning. The count is stored in the
+    narrowest unsigned type for the number of instances.
+
+    Args:
+
+        instances (``ndarray`` or :class:`InstanceStack`):
+
+            One label volume per instance, stacked in the leading (channel)
+            dimensions.
+
+        dims (``int``):
+
+            The number of spatial dimensions.
+
+        count (``bool``, optional):
+
+            Whether to return the number of instances per voxel.
+
+        cleaned (``bool``, optional):
+
+            Whether to return the merged labels, with voxels of more than one
+            instance set to 0.
+
+        dtype (``dtype``, optional):
+
+            The data type of the merged labels.
+
+    Returns:
+
+        :class:`Overlap` with ``count`` and ``cleaned`` arrays of the spatial
+        shape, or ``None`` if not requested.
+    '''
+
+    if isinstance(instances, InstanceStack):
+        return Overlap(
+            instances.count() if count else None,
+            instances.cleaned(dtype) if cleaned else None)
+
+    instances = instances.reshape((-1,) + instances.shape[-dims:])
+    num_instances, shape = instances.shape[0], instances.shape[1:]
+
+    assert num_instances < 2**16, "too many instances"
+    count_dtype = np.uint8 if num_instances < 2**8 else np.uint16
+
+    count_array = np.zeros(shape, dtype=count_dtype)
+    cleaned_array = np.zeros(shape, dtype=dtype) if cleaned else None
+
+    section_size = int(np.prod(shape[1:]))
+    tile_depth = max(1, tile_size//section_size)
+    mask = np.empty((min(tile_depth, shape[0]),) + shape[1:], dtype=bool)
+
+    for begin in range(0, shape[0], tile_depth):
+
+        end = min(begin + tile_depth, shape[0])
+        c = count_array[begin:end]
+        m = mask[:end - begin]
+
+        if cleaned:
+            l = cleaned_array[begin:end]
+
+        for instance in instances[:, begin:end]:
+            np.greater(instance, 0, out=m)
+            np.add(c, m, out=c)
+            if cleaned:
+                np.add(l, instance, out=l, casting='unsafe')
+
+        if cleaned:
+            np.greater(c, 1, out=m)
+            l[m] = 0
+
+    return Overlap(count_array if count else None, cleaned_array)
+
+
+class OverlapCache(object):
+    '''Share the :class:`Overlap` of instance arrays between the
+    :class:`CountOverlap` and :class:`RemoveOverlap` nodes of one pipeline,
+    such that the instances are read in a single pass.
+
+    Pass the same cache to the nodes that should share it. Each node
+    registers the output it needs (see :meth:`register`), and the first node
+    to process a batch computes all registered outputs. The result for the
+    last array per key is kept until the next one is computed, or until the
+    nodes are torn down.
+
+    Results are associated with the :class:`gunpowder.Array` of a batch, not
+    its data: Buffers reused for the next batch (e.g., from a
+    :class:`BufferPool`) are part of a new ``Array`` and are not mistaken for
+    the previous data.
+    '''
+
+    def __init__(self):
+
+        self.__consumers = {}
+        self.__results = {}
+
+    def register(self, key, output):
+        '''Declare that the overlap ``output`` (``'count'`` or ``'cleaned'``)
+        of array ``key`` is needed.'''
+
+        self.__consumers.setdefault(key, set()).add(output)
+
+    def outputs(self, key):
+        '''Get the registered overlap outputs of ``key``, all if none are
+        registered.'''
+
+        return self.__consumers.get(key, {'count', 'cleaned'})
+
+    def get(self, key, array, dims, dtype=np.uint16):
+        '''Get the :class:`Overlap` of the instances in ``array`` (the
+        :class:`gunpowder.Array` of ``key``).
+
+        The result is reused if called again for the same ``Array`` (whose
+        data must therefore not be modified in place in between). The
+        returned arrays are read-only.
+        '''
+
+        needed = self.outputs(key)
+
+        if key in self.__results:
+            cached, overlap = self.__results[key]
+            if (
+                    cached() is array and
+                    (overlap.count is not None or 'count' not in needed) and
+                    (overlap.cleaned is not None or 'cleaned' not in needed) and
+                    (overlap.cleaned is None or overlap.cleaned.dtype == dtype)):
+                return overlap
+
+        overlap = compute_overlap(
+            array.data,
+            dims,
+            count='count' in needed,
+            cleaned='cleaned' in needed,
+            dtype=dtype)
+        self.set(key, array, overlap)
+
+        return self.__results[key][1]
+
+    def set(self, key, array, overlap):
+        '''Store the :class:`Overlap` of the :class:`gunpowder.Array`
+        ``array`` of ``key``.'''
+
+        self.__results[key] = (
+            weakref.ref(array),
+            Overlap(*(_read_only(o) for o in overlap)))
+
+    def clear(self):
+
+        self.__results.clear()
+
+
+def _read_only(array):
+
+    if array is None:
+        return None
+    view = array.view()
+    view.flags.writeable = False
+    return view
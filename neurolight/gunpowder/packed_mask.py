@@ -0,0 +1,138 @@
+from copy import deepcopy
+
+import numpy as np
+from gunpowder import Array
+
+
+class PackedMask(object):
+    '''A binary mask stored with one bit per voxel.
+
+    The mask behaves like a read-only ``uint8`` array of zeros and ones where
+    needed: It has a ``shape`` and ``dtype``, and is expanded on access (via
+    ``np.asarray``, :meth:`unpack`, or slicing). Use :meth:`from_labels` to
+    create a mask, and :func:`packed_mask_array` to put it in a batch.
+    '''
+
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, bits, shape):
+
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @staticmethod
+    def from_labels(labels, tile_size=2**16):
+        '''Create a mask of the voxels of ``labels`` greater than 0. The
+        labels are binarized in tiles, such that only the bits are kept in
+        memory.'''
+
+        flat = labels.reshape(-1)
+        size = flat.size
+
+        # multiples of 8 voxels per tile, such that tiles start at full bytes
+        tile_size = max(8, tile_size - tile_size % 8)
+
+        bits = np.empty((-(-size//8),), dtype=np.uint8)
+        mask = np.empty((min(tile_size, size),), dtype=bool)
+
+        for begin in range(0, size, tile_size):
+            end = min(begin + tile_size, size)
+            m = mask[:end - begin]
+            np.greater(flat[begin:end], 0, out=m)
+            bits[begin//8:-(-end//8)] = np.packbits(m)
+
+        return PackedMask(bits, labels.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def unpack(self):
+        '''Expand into a ``uint8`` array of zeros and ones.'''
+
+        return np.unpackbits(self.bits, count=self.size).reshape(self.shape)
+
+    def count_nonzero(self):
+        '''The number of voxels in the mask, without expanding it.'''
+
+        return int(_popcount[self.bits].sum(dtype=np.int64))
+
+    def copy(self):
+
+        return PackedMask(self.bits.copy(), self.shape)
+
+    def astype(self, dtype, copy=True):
+
+        return self.unpack().astype(dtype, copy=False)
+
+    def __array__(self, dtype=None):
+
+        mask = self.unpack()
+        if dtype is not None:
+            mask = mask.astype(dtype, copy=False)
+        return mask
+
+    def __getitem__(self, item):
+
+        return self.unpack()[item]
+
+    def __repr__(self):
+        return "PackedMask(shape=%s)" % (self.shape,)
+
+
+# number of set bits per byte
+_popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1, dtype=np.uint8)
+
+
+class PackedMaskArray(Array):
+    '''A :class:`gunpowder.Array` holding a :class:`PackedMask`, created by
+    :func:`packed_mask_array`.
+
+    Cropping (e.g., by ``Batch.crop``) packs the cropped mask again, merging
+    converts the mask into a dense array first.
+    '''
+
+    def crop(self, roi, copy=False):
+
+        assert self.spec.roi.contains(roi), (
+            "Requested crop ROI (%s) doesn't fit in array (%s)" %
+            (roi, self.spec.roi))
+
+        if self.spec.roi == roi and not copy:
+            return self
+
+        slices = ((roi - self.spec.roi.get_begin())/self.spec.voxel_size).to_slices()
+        slices = (slice(None),)*(len(self.data.shape) - roi.dims()) + slices
+
+        spec = self.spec.copy()
+        spec.roi = roi
+        cropped = packed_mask_array(PackedMask.from_labels(self.data[slices]), spec)
+        cropped.attrs = deepcopy(self.attrs)
+
+        return cropped
+
+    def merge(self, array, copy_from_self=False, copy=False):
+
+        dense = Array(np.asarray(self.data), self.spec, self.attrs)
+        return dense.merge(array, copy_from_self, copy)
+
+
+def packed_mask_array(mask, spec):
+    '''Create a :class:`PackedMaskArray` holding a :class:`PackedMask`, see
+    :func:`instance_stack_array`.'''
+
+    array = PackedMaskArray(np.broadcast_to(np.zeros((), dtype=mask.dtype), mask.shape), spec)
+    array.data = mask
+
+    return array
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    '''Read requests ahead of time in background threads.
+
+    Upcoming requests are either given as hints (see :meth:`hint`), or
+    predicted from the requests so far: If the last two requests differ by a
+    constant shift (as in a scan), the next ``max_pending`` requests along
+    that shift are read.
+
+    Args:
+
+        read (``callable``):
+
+            Reads a :class:`BatchRequest` and returns the :class:`Batch`.
+
+        valid (``callable``):
+
+            Returns whether a (predicted) request can be read.
+
+        max_pending (``int``, optional):
+
+            The maximal number of requests read ahead (and kept until they are
+            requested), separately for hinted and predicted requests, such
+            that predictions do not drop hints. The oldest ones are dropped
+            first.
+
+        num_threads (``int``, optional):
+
+            The number of background threads.
+
+        predict (``bool``, optional):
+
+            Whether to predict requests with a constant shift.
+    '''
+
+    def __init__(self, read, valid, max_pending=4, num_threads=1, predict=True):
+
+        self.read = read
+        self.valid = valid
+        self.max_pending = max_pending
+        self.num_threads = num_threads
+        self.predict = predict
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__hinted = OrderedDict()
+        self.__predicted = OrderedDict()
+        self.__previous = None
+        self.__executor = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def hint(self, request):
+        '''Start reading ``request`` in the background, to be returned by
+        :meth:`get` later.'''
+
+        with self.__lock:
+            self.__schedule(request, self.__hinted)
+
+    def get(self, request):
+        '''Get the batch for ``request``, read ahead if it was hinted or
+        predicted, otherwise read now.'''
+
+        with self.__lock:
+            future = None
+            if self.__started():
+                signature = _signature(request)
+                future = self.__hinted.pop(signature, None)
+                if future is None:
+                    future = self.__predicted.pop(signature, None)
+            for next_request in self.__predict(request):
+                self.__schedule(next_request, self.__predicted)
+            if future is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if future is None:
+            return self.read(request)
+
+        return future.result()
+
+    def shutdown(self):
+
+        with self.__lock:
+            if self.__started():
+                for pending in (self.__hinted, self.__predicted):
+                    for future in pending.values():
+                        future.cancel()
+                self.__executor.shutdown()
+            self.__hinted.clear()
+            self.__predicted.clear()
+            self.__executor = None
+
+    def __started(self):
+
+        # threads do not survive a fork, start over in child processes
+        return self.__executor is not None and self.__pid == os.getpid()
+
+    def __schedule(self, request, pending):
+
+        if not self.__started():
+            self.__executor = ThreadPoolExecutor(self.num_threads)
+            self.__pid = os.getpid()
+            self.__hinted.clear()
+            self.__predicted.clear()
+
+        signature = _signature(request)
+        if signature in self.__hinted or signature in self.__predicted:
+            return
+
+        pending[signature] = self.__executor.submit(self.read, copy.deepcopy(request))
+
+        while len(pending) > self.max_pending:
+            _, dropped = pending.popitem(last=False)
+            dropped.cancel()
+
+    def __predict(self, request):
+
+        previous, self.__previous = self.__previous, request
+
+        if not self.predict or previous is None:
+            return []
+
+        shift = _shift(previous, request)
+        if shift is None or not any(shift):
+            return []
+
+        predicted = []
+        next_request = request
+        for _ in range(self.max_pending):
+            next_request = _shifted(next_request, shift)
+            if not self.valid(next_request):
+                break
+            predicted.append(next_request)
+
+        return predicted
+
+
+def _signature(request):
+
+    return tuple(sorted(
+        (str(key), spec.roi.get_offset(), spec.roi.get_shape())
+        for key, spec in request.array_specs.items()))
+
+
+def _shift(a, b):
+
+    # the common shift of all arrays from request a to b, or None
+    if set(a.array_specs.keys()) != set(b.array_specs.keys()):
+        return None
+
+    shift = None
+    for key, spec in b.array_specs.items():
+        if spec.roi.get_shape() != a[key].roi.get_shape():
+            return None
+        key_shift = spec.roi.get_offset() - a[key].roi.get_offset()
+        if shift is not None and key_shift != shift:
+            return None
+        shift = key_shift
+
+    return shift
+
+
+def _shifted(request, shift):
+
+    request = copy.deepcopy(request)
+    for spec in request.array_specs.values():
+        spec.roi = spec.roi.shift(shift)
+
+    return request
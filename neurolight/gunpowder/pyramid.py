@@ -0,0 +1,194 @@
+import itertools
+import logging
+import re
+
+import h5py
+import numpy as np
+
+from .hdf5_pool import close_hdf5
+
+logger = logging.getLogger(__name__)
+
+
+def pyramid_levels(group):
+    '''The names of the levels ``s0``, ``s1``, ... of a pyramid in ``group``,
+    finest first.'''
+
+    levels = [name for name in group.keys() if re.match(r'^s\d+$', name)]
+    return sorted(levels, key=lambda name: int(name[1:]))
+
+
+def build_pyramid(
+        filename,
+        group,
+        num_levels,
+        factor=2,
+        downsample='mean',
+        data_format='channels_first',
+        block_shape=None):
+    '''Build a pyramid of downsampled datasets ``s1``, ``s2``, ... from the
+    dataset ``s0`` in ``group`` of an HDF5 file, to be read by
+    :class:`Hdf5ChannelSource`.
+
+    Each level is computed from the previous one, block by block, such that
+    the datasets do not have to fit into memory. The ``resolution`` attribute
+    (1 per dimension if missing) is scaled by ``factor`` per level. Each level
+    starts at the first voxel of the previous level whose position is a
+    multiple of the new resolution, and its ``offset`` is set accordingly,
+    such that levels are on the voxel grid of their resolution. Existing
+    levels are overwritten.
+
+    Args:
+
+        filename (``string``):
+
+            The HDF5 file.
+
+        group (``string``):
+
+            The group containing the full resolution dataset ``s0``.
+
+        num_levels (``int``):
+
+            The number of levels to create, in addition to ``s0``.
+
+        factor (``int`` or ``tuple`` of ``int``, optional):
+
+            The downsampling factor per level, for each spatial dimension.
+
+        downsample (``string``, optional):
+
+            ``mean`` (default) for intensities, ``max`` for binary masks, or
+            ``nearest`` (every ``factor``-th voxel) for labels.
+
+        data_format (``string``, optional):
+
+            ``channels_first`` (default) or ``channels_last``.
+
+        block_shape (``tuple`` of ``int``, optional):
+
+            The spatial shape of the blocks to compute, in voxels of the
+            downsampled level. Defaults to 128 voxels per dimension.
+    '''
+
+    assert downsample in ['mean', 'max', 'nearest'], (
+        "unknown downsampling %s" % downsample)
+
+    # pooled read-only handles of sources would prevent opening for writing
+    close_hdf5(filename)
+
+    with h5py.File(filename, 'r+') as data_file:
+
+        previous = data_file[group]['s0']
+        dims = len(previous.attrs['resolution']) if 'resolution' in previous.attrs else previous.ndim - 1
+        if isinstance(factor, int):
+            factor = (factor,)*dims
+        factor = tuple(factor)
+        if block_shape is None:
+            block_shape = (128,)*dims
+
+        resolution = (1,)*dims
+        if 'resolution' in previous.attrs:
+            resolution = tuple(int(r) for r in previous.attrs['resolution'])
+        offset = (0,)*dims
+        if 'offset' in previous.attrs:
+            offset = tuple(int(o) for o in previous.attrs['offset'])
+        if any(o % r != 0 for o, r in zip(offset, resolution)):
+            raise RuntimeError(
+                "offset %s of %s/s0 is not a multiple of its resolution %s" % (
+                    offset, group, resolution))
+
+        for level in range(1, num_levels + 1):
+
+            name = 's%d' % level
+            if name in data_file[group]:
+                del data_file[group][name]
+
+            # skip voxels of the previous level up to the grid of the new one
+            skip = tuple((-o//r) % f for o, r, f in zip(offset, resolution, factor))
+            offset = tuple(o + s*r for o, s, r in zip(offset, skip, resolution))
+            resolution = tuple(r*f for r, f in zip(resolution, factor))
+
+            spatial_shape = _spatial(previous.shape, dims, data_format)
+            shape = tuple((s - k)//f for s, k, f in zip(spatial_shape, skip, factor))
+            assert all(s > 0 for s in shape), (
+                "%s/%s would be empty" % (group, name))
+
+            chunks = None
+            if previous.chunks is not None:
+                chunks = _with_channels(
+                    tuple(min(c, s) for c, s in zip(_spatial(previous.chunks, dims, data_format), shape)),
+                    previous.shape, dims, data_format)
+
+            dataset = data_file[group].create_dataset(
+                name,
+                shape=_with_channels(shape, previous.shape, dims, data_format),
+                dtype=previous.dtype,
+                chunks=chunks,
+                compression=previous.compression,
+                compression_opts=previous.compression_opts)
+
+            for attribute, value in previous.attrs.items():
+                dataset.attrs[attribute] = value
+            dataset.attrs['resolution'] = list(resolution)
+            dataset.attrs['offset'] = list(offset)
+
+            logger.info("downsampling %s/%s to %s", group, previous.name, name)
+            for begin in itertools.product(*[range(0, s, b) for s, b in zip(shape, block_shape)]):
+
+                end = tuple(min(b + s, d) for b, s, d in zip(begin, block_shape, shape))
+                source = tuple(slice(k + b*f, k + e*f) for b, e, k, f in zip(begin, end, skip, factor))
+                target = tuple(slice(b, e) for b, e in zip(begin, end))
+
+                block = previous[_selection(source, dims, data_format)]
+                dataset[_selection(target, dims, data_format)] = _downsample(
+                    block, factor, downsample, data_format)
+
+            previous = dataset
+
+
+def _spatial(shape, dims, data_format):
+
+    if data_format == 'channels_first':
+        return tuple(shape[-dims:])
+    return tuple(shape[:dims])
+
+
+def _with_channels(spatial_shape, shape, dims, data_format):
+
+    # spatial_shape with the channel dimensions of shape
+    if data_format == 'channels_first':
+        return tuple(shape[:-dims]) + tuple(spatial_shape)
+    return tuple(spatial_shape) + tuple(shape[dims:])
+
+
+def _selection(slices, dims, data_format):
+
+    if data_format == 'channels_first':
+        return (Ellipsis,) + slices
+    return slices + (Ellipsis,)
+
+
+def _downsample(block, factor, downsample, data_format):
+
+    dims = len(factor)
+    first = block.ndim - dims if data_format == 'channels_first' else 0
+
+    if downsample == 'nearest':
+        return block[(slice(None),)*first + tuple(slice(None, None, f) for f in factor)]
+
+    # split each spatial axis into (blocks, factor) and reduce the latter
+    shape = list(block.shape[:first])
+    for s, f in zip(block.shape[first:first + dims], factor):
+        shape += [s//f, f]
+    shape += list(block.shape[first + dims:])
+    axes = tuple(first + 2*i + 1 for i in range(dims))
+    block = block.reshape(shape)
+
+    if downsample == 'max':
+        return block.max(axis=axes)
+
+    mean = block.mean(axis=axes)
+    if np.issubdtype(block.dtype, np.integer):
+        return np.round(mean).astype(block.dtype)
+    return mean.astype(block.dtype)
@@ -0,0 +1,171 @@
+import numpy as np
+
+
+class QuantileSketch(object):
+    '''A mergeable streaming quantile sketch with relative accuracy
+    guarantees, similar to DDSketch.
+
+    Values are counted in logarithmically spaced buckets, such that each
+    quantile estimate is within a factor of ``1 +- relative_accuracy`` of a
+    value of the requested rank. Memory grows with the logarithm of the
+    dynamic range of the values only, and two sketches can be merged by
+    adding their bucket counts.
+
+    Args:
+
+        relative_accuracy (``float``, optional):
+
+            The relative accuracy of quantile estimates.
+
+        min_value (``float``, optional):
+
+            Values with a smaller magnitude are counted as zero.
+    '''
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1.0 + relative_accuracy)/(1.0 - relative_accuracy)
+        self.__log_gamma = np.log(self.gamma)
+
+        self.positive = _Store()
+        self.negative = _Store()
+        self.zero_count = 0
+
+    @property
+    def count(self):
+        return self.positive.count + self.negative.count + self.zero_count
+
+    def update(self, values):
+        '''Add an array of values to the sketch.'''
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+
+        positive = values[values >= self.min_value]
+        negative = values[values <= -self.min_value]
+
+        self.positive.add(self.__index(positive))
+        self.negative.add(self.__index(-negative))
+        self.zero_count += len(values) - len(positive) - len(negative)
+
+    def merge(self, other):
+        '''Add the counts of another sketch with the same accuracy.'''
+
+        assert other.gamma == self.gamma, (
+            "can not merge sketches of different accuracy")
+
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zero_count += other.zero_count
+
+    def quantile(self, q):
+        '''Estimate the ``q``-quantile, ``q`` in ``[0, 1]``.'''
+
+        count = self.count
+        if count == 0:
+            return None
+
+        rank = int(q*(count - 1))
+
+        if rank < self.negative.count:
+            index = self.negative.index_at_rank(self.negative.count - 1 - rank)
+            return -self.__value(index)
+
+        rank -= self.negative.count
+        if rank < self.zero_count:
+            return 0.0
+
+        index = self.positive.index_at_rank(rank - self.zero_count)
+        return self.__value(index)
+
+    def to_dict(self):
+
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'min_value': self.min_value,
+            'zero_count': int(self.zero_count),
+            'positive': self.positive.to_dict(),
+            'negative': self.negative.to_dict(),
+        }
+
+    @staticmethod
+    def from_dict(d):
+
+        sketch = QuantileSketch(d['relative_accuracy'], d['min_value'])
+        sketch.zero_count = d['zero_count']
+        sketch.positive = _Store.from_dict(d['positive'])
+        sketch.negative = _Store.from_dict(d['negative'])
+
+        return sketch
+
+    def __index(self, values):
+        return np.ceil(np.log(values)/self.__log_gamma).astype(np.int64)
+
+    def __value(self, index):
+        # the center of bucket (gamma^(i-1), gamma^i], relative to its bounds
+        return 2.0*self.gamma**index/(self.gamma + 1.0)
+
+
+class _Store(object):
+    '''Dense bucket counts, starting at bucket ``offset``.'''
+
+    def __init__(self, offset=0, counts=None):
+
+        self.offset = offset
+        if counts is None:
+            counts = np.zeros((0,), dtype=np.int64)
+        self.counts = counts
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def add(self, indices):
+
+        if len(indices) == 0:
+            return
+
+        self.__extend(indices.min(), indices.max() + 1)
+        self.counts += np.bincount(
+            indices - self.offset,
+            minlength=len(self.counts))
+
+    def merge(self, other):
+
+        if len(other.counts) == 0:
+            return
+
+        self.__extend(other.offset, other.offset + len(other.counts))
+        begin = other.offset - self.offset
+        self.counts[begin:begin + len(other.counts)] += other.counts
+
+    def index_at_rank(self, rank):
+
+        cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, rank, side='right'))
+        return self.offset + min(i, len(self.counts) - 1)
+
+    def to_dict(self):
+        return {'offset': int(self.offset), 'counts': self.counts.tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        return _Store(d['offset'], np.array(d['counts'], dtype=np.int64))
+
+    def __extend(self, begin, end):
+
+        if len(self.counts) == 0:
+            self.offset = int(begin)
+            self.counts = np.zeros((int(end - begin),), dtype=np.int64)
+            return
+
+        new_begin = min(self.offset, int(begin))
+        new_end = max(self.offset + len(self.counts), int(end))
+        if new_begin == self.offset and new_end == self.offset + len(self.counts):
+            return
+
+        counts = np.zeros((new_end - new_begin,), dtype=np.int64)
+        counts[self.offset - new_begin:self.offset - new_begin + len(self.counts)] = self.counts
+        self.offset = new_begin
+        self.counts = counts
@@ -2,6 +2,8 @@ import numpy as np
 from gunpowder import *
 from scipy.ndimage.morphology import distance_transform_edt
 
+from .crop import crop_view
+
 
 class RasterizeSkeleton(BatchFilter):
     """Draw skeleton into a binary array given a swc.
@@ -68,23 +70,33 @@ class RasterizeSkeleton(BatchFilter):
 
         # iterate through swc points
         labels = np.unique([p.label_id for p in points.data.values()])
+        binarized = np.zeros_like(array_data, dtype=bool)
         for label in labels:
-            binarized = np.zeros_like(array_data, dtype=np.bool)
+            binarized[:] = False
+            end_points = []
             for p in points.data.values():
                 if p.label_id == label:
                     if p.parent_id in points.data.keys():
                         p1 = (p.location / voxel_size - offset).astype(int)
                         p2 = (points.data[p.parent_id].location / voxel_size).astype(int) - offset
                         binarized = self._rasterize_line_segment(p1, p2, binarized)
+                        end_points += [p1, p2]
+
+            if not end_points:
+                continue
 
             if self.radius > 1:
-                dt = distance_transform_edt(np.logical_not(binarized), sampling=voxel_size)
-                binarized = dt <= self.radius
+                # distances are only needed in the bounding box of the
+                # skeleton, grown by the radius
+                margin = np.ceil(self.radius / np.array(voxel_size)).astype(int) + 1
+                begin = np.maximum(np.min(end_points, axis=0) - margin, 0)
+                end = np.minimum(np.max(end_points, axis=0) + 1 + margin, array_data.shape)
+                bbox = tuple(slice(b, e) for b, e in zip(begin, end))
+                dt = distance_transform_edt(np.logical_not(binarized[bbox]), sampling=voxel_size)
+                binarized[bbox] = dt <= self.radius
 
             array_data[binarized] = label
 
-        print('sum > 0: ', np.sum(array_data > 0), ', num points in roi: ', len(points.data.items()))
-
         array = Array(data=array_data,
                       spec=ArraySpec(
                           roi=array_roi * voxel_size,
@@ -93,8 +105,7 @@ class RasterizeSkeleton(BatchFilter):
                           dtype=self.array_spec.dtype
                       ))
 
-        array = array.crop(request[self.array].roi)
-        batch.arrays[self.array] = array
+        batch.arrays[self.array] = crop_view(array, request[self.array].roi)
 
     def _bresenhamline_nslope(self, slope):
 
@@ -128,9 +139,6 @@ class RasterizeSkeleton(BatchFilter):
 
         if line_segment_points.shape[0] > 0:
             idx = np.transpose(line_segment_points.astype(int))
-            if np.max(idx[0]) >= skeletonized.shape[0] or np.max(idx[1]) >= skeletonized.shape[1] \
-                    or np.max(idx[2]) >= skeletonized.shape[2]:
-                print(np.max(idx, axis=0), skeletonized.shape)
             skeletonized[idx[0], idx[1], idx[2]] = True
         skeletonized[point[0], point[1], point[2]] = True
 
@@ -0,0 +1,229 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+from .hdf5_pool import open_hdf5
+
+logger = logging.getLogger(__name__)
+
+# tmpfs of POSIX shared memory, where available
+_shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class ReaderPool(object):
+    '''A pool of processes to read from an HDF5 file.
+
+    Each reader process keeps its own handle of the file, such that reads are
+    not serialized by the global lock of the HDF5 library. A read is split
+    into slabs along its first non-singleton dimension (aligned to chunks),
+    which are read concurrently by the readers directly into shared memory.
+
+    Arrays to read into are allocated in shared memory with :meth:`allocate`
+    (e.g., by a :class:`BufferPool`), such that readers write into them
+    without copying. The shared memory is a file in ``/dev/shm``, removed once
+    the array is released. Reads into other arrays go through a temporary
+    shared array and are copied.
+
+    The readers are started with the first read (again in a forked child
+    process) and use :func:`open_hdf5`.
+
+    Args:
+
+        filename (``string``):
+
+            The HDF5 file.
+
+        num_readers (``int``):
+
+            The number of reader processes.
+
+        rdcc_nbytes (``int``, optional):
+
+            The size of the HDF5 chunk cache per dataset of each reader.
+
+        rdcc_nslots (``int``, optional):
+
+            The number of slots of the HDF5 chunk cache of each reader.
+    '''
+
+    def __init__(self, filename, num_readers, rdcc_nbytes=None, rdcc_nslots=None):
+
+        self.filename = os.path.abspath(filename)
+        self.num_readers = num_readers
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+
+        self.__executor = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+        # paths of the shared memory of allocated arrays, by id of the mapping
+        self.__shared = {}
+
+    def allocate(self, shape, dtype):
+        '''An uninitialized array of ``shape`` and ``dtype`` in shared memory,
+        to be passed as ``out`` to :meth:`read`.'''
+
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        if nbytes == 0:
+            return np.empty(shape, dtype=dtype)
+
+        fd, path = tempfile.mkstemp(prefix='neurolight-', dir=_shm_dir)
+        try:
+            os.ftruncate(fd, nbytes)
+            mapping = mmap.mmap(fd, nbytes)
+        except BaseException:
+            os.unlink(path)
+            raise
+        finally:
+            os.close(fd)
+
+        with self.__lock:
+            self.__shared[id(mapping)] = path
+        weakref.finalize(mapping, self.__release, id(mapping), path)
+
+        return np.frombuffer(mapping, dtype=dtype).reshape(shape)
+
+    def read(self, dataset, selection, out=None):
+        '''Read ``selection`` (a tuple of slices and indices) of ``dataset``
+        (a dataset of the file, opened in this process for its metadata),
+        into ``out`` if given.'''
+
+        parts, shape = _slabs(selection, dataset.shape, dataset.chunks, self.num_readers)
+
+        if out is None:
+            out = self.allocate(shape, dataset.dtype)
+        assert out.shape == shape, (
+            "can not read %s into an array of shape %s" % (shape, out.shape))
+        if out.size == 0:
+            return out
+
+        shared = self.__find_shared(out)
+        if shared is None:
+            logger.debug("reading into an array not allocated by the pool, copying")
+            out[...] = self.read(dataset, selection)
+            return out
+
+        path, offset = shared
+        executor = self.__readers()
+        futures = [
+            executor.submit(
+                _read,
+                self.filename,
+                self.rdcc_nbytes,
+                self.rdcc_nslots,
+                dataset.name,
+                part_selection,
+                path,
+                offset,
+                shape,
+                out.dtype,
+                target)
+            for part_selection, target in parts
+        ]
+        for future in futures:
+            future.result()
+
+        return out
+
+    def shutdown(self):
+
+        with self.__lock:
+            if self.__executor is not None and self.__pid == os.getpid():
+                self.__executor.shutdown()
+            self.__executor = None
+
+    def __find_shared(self, array):
+
+        # the path and byte offset of the shared memory of a C-contiguous
+        # array, None if it is not in memory allocated by this pool
+        if not array.flags.c_contiguous:
+            return None
+
+        base = array
+        while isinstance(base, np.ndarray) and base.base is not None:
+            base = base.base
+        if not isinstance(base, memoryview):
+            return None
+
+        with self.__lock:
+            path = self.__shared.get(id(base.obj))
+        if path is None:
+            return None
+
+        begin = np.frombuffer(base.obj, dtype=np.uint8).ctypes.data
+        return path, array.ctypes.data - begin
+
+    def __release(self, mapping_id, path):
+
+        with self.__lock:
+            self.__shared.pop(mapping_id, None)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def __readers(self):
+
+        # processes do not survive a fork, start new readers in child processes
+        with self.__lock:
+            if self.__executor is None or self.__pid != os.getpid():
+                logger.debug("starting %d readers for %s", self.num_readers, self.filename)
+                self.__executor = ProcessPoolExecutor(
+                    self.num_readers,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self.__pid = os.getpid()
+            return self.__executor
+
+
+def _read(filename, rdcc_nbytes, rdcc_nslots, ds_name, selection, path, offset, shape, dtype, target):
+
+    # in the reader process
+    dataset = open_hdf5(filename, rdcc_nbytes, rdcc_nslots)[ds_name]
+    out = np.memmap(path, dtype=dtype, mode='r+', offset=offset, shape=shape)
+    dataset.read_direct(out, source_sel=selection, dest_sel=target)
+    del out
+
+
+def _slabs(selection, shape, chunks, num_parts):
+
+    # split a selection along its first sliced dimension with more than one
+    # element (e.g., not a single channel) into up to num_parts slabs at chunk
+    # boundaries, returns the selection and the part of the output of each
+    # slab, and the output shape
+
+    selection = tuple(selection) + (slice(None),)*(len(shape) - len(selection))
+
+    ranges = [
+        (d, s.indices(size)[:2])
+        for d, (s, size) in enumerate(zip(selection, shape))
+        if isinstance(s, slice)]
+    out_shape = tuple(max(0, stop - start) for _, (start, stop) in ranges)
+
+    split = [i for i, s in enumerate(out_shape) if s > 1]
+    if not split:
+        return [(selection, None)], out_shape
+
+    i = split[0]
+    d, (start, stop) = ranges[i]
+    chunk = chunks[d] if chunks is not None else 1
+    num_chunks = -(-stop//chunk) - start//chunk
+    per_part = -(-num_chunks//num_parts)*chunk
+
+    parts = []
+    begin = start
+    while begin < stop:
+        end = min((begin//chunk)*chunk + per_part, stop)
+        part_selection = selection[:d] + (slice(begin, end),) + selection[d + 1:]
+        parts.append((part_selection, (slice(None),)*i + (slice(begin - start, end - start),)))
+        begin = end
+
+    return parts, out_shape
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+def unique_labels(labels, chunk_size=2**16):
+    '''Get the sorted unique values of a label array.
+
+    The array is processed in chunks of ``chunk_size`` values, such that the
+    memory needed is proportional to the number of unique labels instead of
+    the size of the array.
+    '''
+
+    flat = np.ascontiguousarray(labels).reshape(-1)
+
+    unique = np.zeros((0,), dtype=flat.dtype)
+    for i in range(0, flat.size, chunk_size):
+        unique = np.union1d(unique, flat[i:i + chunk_size])
+
+    return unique
+
+
+def relabel(labels, old_values=None, new_values=None, dtype=np.int32, chunk_size=2**16):
+    '''Map the ids of a label array to new ids.
+
+    Instead of a lookup table of size ``max(labels) + 1``, ids are mapped
+    through a sorted search in ``old_values``. Besides the output, memory is
+    therefore proportional to the number of unique labels and the chunk size,
+    which allows relabeling of ``uint64`` or sparse large ids.
+
+    Args:
+
+        labels (``ndarray``):
+
+            The label array to relabel.
+
+        old_values (array-like, optional):
+
+            The ids to replace. If not given, all non-zero ids are relabeled
+            consecutively, starting at 1.
+
+        new_values (array-like, optional):
+
+            The ids to replace ``old_values`` with. Ids that are not in
+            ``old_values`` are mapped to 0.
+
+        dtype (``dtype``, optional):
+
+            The data type of the relabeled array, ``int32`` by default.
+
+        chunk_size (``int``, optional):
+
+            Number of values to map at once.
+    '''
+
+    flat = np.ascontiguousarray(labels).reshape(-1)
+
+    if old_values is None:
+        old_values = unique_labels(flat, chunk_size)
+        old_values = old_values[old_values != 0]
+        new_values = np.arange(1, len(old_values) + 1)
+    else:
+        old_values = np.asarray(old_values, dtype=flat.dtype)
+        new_values = np.asarray(new_values)
+        order = np.argsort(old_values)
+        old_values = old_values[order]
+        new_values = new_values[order]
+
+    new_values = new_values.astype(dtype)
+
+    relabeled = np.zeros(labels.shape, dtype=dtype)
+    if len(old_values) == 0:
+        return relabeled
+
+    out = relabeled.reshape(-1)
+    for i in range(0, flat.size, chunk_size):
+        chunk = flat[i:i + chunk_size]
+        idx = np.searchsorted(old_values, chunk)
+        np.clip(idx, 0, len(old_values) - 1, out=idx)
+        mapped = new_values[idx]
+        mapped[old_values[idx] != chunk] = 0
+        out[i:i + chunk_size] = mapped
+
+    return relabeled
@@ -1,18 +1,44 @@
 import numpy as np
 from gunpowder import *
 
+from .crop import crop_view
+from .overlap import Overlap, compute_overlap
+
 
 class RemoveOverlap(BatchFilter):
+    '''Merge instances into one label volume, without voxels that are part of
+    several instances.
+
+    Args:
+
+        gt (:class:`ArrayKey`):
+
+            The instances, one channel per instance.
+
+        gt_cleaned (:class:`ArrayKey`):
+
+            The merged labels to provide.
 
-    def __init__(self, gt, gt_cleaned):
+        overlap_cache (:class:`OverlapCache`, optional):
+
+            A cache shared with a :class:`CountOverlap` node for the same
+            ``gt``, such that the instances are read once. ``gt_cleaned`` is
+            then a read-only view of the cached result.
+    '''
+
+    def __init__(self, gt, gt_cleaned, overlap_cache=None):
 
         self.gt = gt
         self.gt_cleaned = gt_cleaned
+        self.overlap_cache = overlap_cache
         self.dims = None
 
         self.gt_spec = None
         self.grow = None
 
+        if overlap_cache is not None:
+            overlap_cache.register(gt, 'cleaned')
+
     def setup(self):
 
         self.dims = self.spec.get_total_roi().dims()
@@ -34,19 +60,31 @@ class RemoveOverlap(BatchFilter):
 
         spec = batch[self.gt].spec.copy()
         array = batch[self.gt].data
-        print('gt', array.shape, np.sum(array), np.unique(array))
 
         num_channels = len(array.shape) - self.dims
         assert num_channels <= 1, 'Sorry, dont know what to do with more than one channel dimension.'
 
-        cleaned = np.sum(array, axis=0)
-        overlap = np.sum((array > 0).astype('uint16'), axis=0)
-        cleaned[overlap > 1] = 0
+        if self.overlap_cache is not None:
+            overlap = self.overlap_cache.get(self.gt, batch[self.gt], self.dims, dtype=np.uint16)
+        else:
+            overlap = compute_overlap(array, self.dims, count=False, dtype=np.uint16)
+
+        batch[self.gt_cleaned] = Array(data=overlap.cleaned, spec=spec)
+
+        gt = batch[self.gt]
+        if gt_spec.roi != spec.roi:
+
+            gt = crop_view(gt, gt_spec.roi)
+            batch.arrays[self.gt] = gt
 
-        batch[self.gt_cleaned] = Array(data=cleaned.astype(np.uint16), spec=spec)
+            # keep the overlap of the cropped gt for other consumers
+            if self.overlap_cache is not None:
+                slices = ((gt_spec.roi - spec.roi.get_begin())/spec.voxel_size).to_slices()
+                self.overlap_cache.set(self.gt, gt, Overlap(*(
+                    o[slices] if o is not None else None
+                    for o in overlap)))
 
-        gt = Array(data=batch[self.gt].data.copy(), spec=spec.copy())
+    def teardown(self):
 
-        gt = gt.crop(gt_spec.roi)
-        batch.arrays[self.gt] = gt
-        print(batch[self.gt].spec.roi)
+        if self.overlap_cache is not None:
+            self.overlap_cache.clear()
@@ -0,0 +1,263 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+from .pyramid import pyramid_levels
+
+logger = logging.getLogger(__name__)
+
+# metadata read in this process, by filename
+_memo = {}
+_lock = threading.Lock()
+
+# sources of discover_specs, inherited by the forked workers
+_discovering = None
+
+# version of the sidecar format, sidecars of other versions are ignored
+_version = 2
+
+
+def discover_specs(sources, num_workers=8):
+    '''Read the metadata for the ``setup`` of many sources with
+    ``spec_cache`` concurrently, e.g., before building a pipeline with one
+    source per sample.
+
+    Sidecars are read in threads. Files without a valid sidecar are opened in
+    forked worker processes (HDF5 serializes threads with a global lock),
+    and their sidecars are written. ``setup`` then does not open the files
+    anymore.
+
+    Args:
+
+        sources (``list`` of :class:`Hdf5ChannelSource`):
+
+            The sources to discover the specs of.
+
+        num_workers (``int``, optional):
+
+            The number of threads and worker processes.
+    '''
+
+    global _discovering
+
+    sources = [s for s in sources if s.spec_cache is not None]
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        cached = list(pool.map(_load_cached, sources))
+    missing = [source for source, metadata in zip(sources, cached) if metadata is None]
+
+    if not missing:
+        return
+
+    logger.info("discovering specs of %d of %d sources", len(missing), len(sources))
+
+    if 'fork' not in multiprocessing.get_all_start_methods() or num_workers <= 1:
+        for source in missing:
+            load_metadata(source)
+        return
+
+    _discovering = missing
+    try:
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            results = list(pool.map(_discover, range(len(missing))))
+    finally:
+        _discovering = None
+
+    for source, (stat, metadata) in zip(missing, results):
+        _store(source, stat, metadata)
+
+
+def load_metadata(source):
+    '''The metadata of the datasets of ``source``, from this process, the
+    sidecar, or the file (writing the sidecar), as :class:`CachedFile`.'''
+
+    metadata = _load_cached(source)
+    if metadata is None:
+        stat, metadata = _read(source)
+        _store(source, stat, metadata)
+    return CachedFile(metadata)
+
+
+class CachedFile(object):
+    '''Cached metadata of a file, used in place of an open file by
+    ``setup``.'''
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def __contains__(self, name):
+        return _normalized(name) in self.metadata
+
+    def __getitem__(self, name):
+        name = _normalized(name)
+        entry = self.metadata[name]
+        if 'levels' in entry:
+            return _CachedGroup(entry['levels'])
+        return _CachedDataset(name, entry)
+
+
+class _CachedGroup(object):
+
+    def __init__(self, levels):
+        self.levels = levels
+
+    def keys(self):
+        return list(self.levels)
+
+
+class _CachedDataset(object):
+
+    def __init__(self, name, entry):
+        self.name = '/' + name
+        self.shape = tuple(entry['shape'])
+        self.dtype = np.dtype(entry['dtype'])
+        self.chunks = tuple(entry['chunks']) if entry['chunks'] is not None else None
+        self.attrs = entry['attrs']
+        self.ndim = len(self.shape)
+
+
+def _names(source):
+
+    names = []
+    for ds_name in source.datasets.values():
+        if isinstance(ds_name, (list, tuple)):
+            names += list(ds_name)
+        else:
+            names.append(ds_name)
+    return [_normalized(name) for name in names]
+
+
+def _normalized(name):
+    return name.strip('/')
+
+
+def _stat(filename):
+
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _sidecar(source):
+
+    filename = os.path.abspath(source.filename)
+    if source.spec_cache is True:
+        return filename + '.specs.json'
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    return os.path.join(source.spec_cache, digest + '.json')
+
+
+def _complete(metadata, names):
+
+    for name in names:
+        if name not in metadata:
+            return False
+        for level in metadata[name].get('levels', []):
+            if name + '/' + level not in metadata:
+                return False
+    return True
+
+
+def _load_cached(source):
+
+    # the metadata of this process or the sidecar, if valid
+    filename = os.path.abspath(source.filename)
+    names = _names(source)
+    try:
+        stat = _stat(filename)
+    except OSError:
+        return None
+
+    with _lock:
+        cached = _memo.get(filename)
+    if cached is not None and cached[0] == stat and _complete(cached[1], names):
+        return cached[1]
+
+    try:
+        with open(_sidecar(source), 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if sidecar.get('version') != _version:
+        return None
+    if sidecar.get('filename') != filename or sidecar.get('stat') != stat:
+        return None
+    if not _complete(sidecar['datasets'], names):
+        return None
+
+    with _lock:
+        _memo[filename] = (stat, sidecar['datasets'])
+    return sidecar['datasets']
+
+
+def _discover(i):
+    # in a forked worker
+    return _read(_discovering[i])
+
+
+def _read(source):
+
+    # the metadata of the datasets of source, from the file
+    stat = _stat(source.filename)
+    metadata = {}
+
+    with source._open_file(source.filename) as data_file:
+        for name in _names(source):
+            if name not in data_file:
+                continue
+            node = data_file[name]
+            if hasattr(node, 'keys'):
+                levels = pyramid_levels(node)
+                metadata[name] = {'levels': levels}
+                for level in levels:
+                    _read_dataset(data_file[name + '/' + level], name + '/' + level, metadata)
+            else:
+                _read_dataset(node, name, metadata)
+
+    return stat, metadata
+
+
+def _read_dataset(dataset, name, metadata):
+
+    # resolution, offset, and other numeric attributes
+    attrs = {}
+    for attribute, value in dataset.attrs.items():
+        value = np.asarray(value)
+        if value.dtype.kind in 'biuf':
+            attrs[attribute] = value.tolist()
+
+    metadata[name] = {
+        'shape': [int(s) for s in dataset.shape],
+        'dtype': np.dtype(dataset.dtype).str,
+        'chunks': [int(c) for c in dataset.chunks] if dataset.chunks is not None else None,
+        'attrs': attrs,
+    }
+
+
+def _store(source, stat, metadata):
+
+    filename = os.path.abspath(source.filename)
+
+    with _lock:
+        cached = _memo.get(filename)
+        if cached is not None and cached[0] == stat:
+            # keep datasets of other sources of the same file
+            metadata = dict(cached[1], **metadata)
+        _memo[filename] = (stat, metadata)
+
+    sidecar = _sidecar(source)
+    try:
+        if os.path.dirname(sidecar):
+            os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        temp = '%s.%d.tmp' % (sidecar, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({'version': _version, 'filename': filename, 'stat': stat, 'datasets': metadata}, f)
+        os.replace(temp, sidecar)
+    except OSError as e:
+        logger.debug("can not write spec cache %s: %s", sidecar, e)
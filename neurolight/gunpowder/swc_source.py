@@ -2,6 +2,7 @@ import numpy as np
 from gunpowder import *
 from gunpowder.profiling import Timing
 import h5py
+from .relabel import relabel
 
 logger = logging.getLogger(__name__)
 
@@ -250,9 +251,11 @@ class SwcSource(BatchProvider):
             self._label_skeleton(source, label_id)
             label_id += 1
 
-        for point in self.data:
-            point_id = point[3]
-            point[5] = self.point_to_label[point_id]
+        self.data[:, 5] = relabel(
+            self.data[:, 3],
+            list(self.point_to_label.keys()),
+            list(self.point_to_label.values()),
+            dtype=self.data.dtype)
 
     def _read_points(self):
 
@@ -0,0 +1,180 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import itertools
+import logging
+import os
+
+from gunpowder.coordinate import Coordinate
+
+from .hdf5_channel_source import Hdf5ChannelSource
+
+logger = logging.getLogger(__name__)
+
+
+class ZarrChannelSource(Hdf5ChannelSource):
+    '''A zarr (or N5, for filenames ending in ``.n5``) data source with
+    channels, see :class:`Hdf5ChannelSource` for the arguments.
+
+    The chunks of each read are decoded concurrently in a thread pool (most
+    compressors release the GIL while decoding), directly into the output
+    array.
+
+    Use this source for data stored in zarr or N5, it is not a faster
+    replacement for :class:`Hdf5ChannelSource`: on a single CPU, reads are
+    slower than from HDF5 with the same codec (see
+    ``benchmarks/zarr_channel_source.py``). Gains from threaded decoding
+    depend on the number of CPUs and have not been measured yet.
+
+    Args:
+
+        num_threads (``int``, optional):
+
+            The number of threads to decode chunks with. Defaults to the
+            number of CPUs.
+
+    Voxel size and offset are read from the ``resolution`` and ``offset``
+    attributes of the datasets, in reverse order for N5.
+    '''
+
+    def __init__(
+            self,
+            filename,
+            datasets,
+            channel_ids=None,
+            data_format='channels_first',
+            array_specs=None,
+            instance_stacks=None,
+            chunk_aligned=True,
+            block_cache=None,
+            block_shape=None,
+            read_ahead=0,
+            read_ahead_threads=1,
+            buffer_pool=None,
+            num_threads=None):
+
+        super(ZarrChannelSource, self).__init__(
+            filename,
+            datasets,
+            channel_ids=channel_ids,
+            data_format=data_format,
+            array_specs=array_specs,
+            instance_stacks=instance_stacks,
+            keep_open=False,
+            chunk_aligned=chunk_aligned,
+            block_cache=block_cache,
+            block_shape=block_shape,
+            read_ahead=read_ahead,
+            read_ahead_threads=read_ahead_threads,
+            buffer_pool=buffer_pool)
+
+        self.num_threads = num_threads if num_threads is not None else os.cpu_count()
+        self.__pool = None
+        self.__pool_pid = None
+
+    def _open_file(self, filename):
+
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("ZarrChannelSource needs zarr, install it with 'pip install zarr'")
+
+        if filename.endswith('.n5'):
+            store = zarr.N5Store(filename)
+        else:
+            store = filename
+
+        return _opened(zarr.open(store, mode='r'))
+
+    def _get_voxel_size(self, dataset):
+
+        if 'resolution' not in dataset.attrs:
+            return None
+        if self.filename.endswith('.n5'):
+            return Coordinate(dataset.attrs['resolution'][::-1])
+        return Coordinate(dataset.attrs['resolution'])
+
+    def _get_offset(self, dataset):
+
+        if 'offset' not in dataset.attrs:
+            return None
+        if self.filename.endswith('.n5'):
+            return Coordinate(dataset.attrs['offset'][::-1])
+        return Coordinate(dataset.attrs['offset'])
+
+    def _read_selection(self, dataset, selection, out=None):
+
+        parts, shape = _chunk_parts(selection, dataset.shape, dataset.chunks)
+
+        if out is None:
+            out = self._allocate(shape, dataset.dtype)
+        assert out.shape == shape, (
+            "can not read selection of shape %s into %s" % (shape, out.shape))
+
+        if len(parts) <= 1 or self.num_threads <= 1:
+            dataset.get_basic_selection(selection, out=out)
+            return out
+
+        # consume the results, to raise exceptions of the threads
+        list(self.__thread_pool().map(
+            lambda part: dataset.get_basic_selection(part[0], out=out[part[1]]),
+            parts))
+
+        return out
+
+    def __thread_pool(self):
+
+        # threads do not survive a fork, start a new pool in child processes
+        if self.__pool is None or self.__pool_pid != os.getpid():
+            self.__pool = ThreadPoolExecutor(self.num_threads)
+            self.__pool_pid = os.getpid()
+        return self.__pool
+
+    def teardown(self):
+
+        super(ZarrChannelSource, self).teardown()
+        if self.__pool is not None and self.__pool_pid == os.getpid():
+            self.__pool.shutdown()
+        self.__pool = None
+
+
+@contextmanager
+def _opened(group):
+    yield group
+
+
+def _chunk_parts(selection, shape, chunks):
+
+    # split a selection of slices and indices along the chunk boundaries,
+    # returns the selection and the part of the output of each chunk, and the
+    # output shape
+
+    selection = tuple(selection) + (slice(None),)*(len(shape) - len(selection))
+
+    pieces = []
+    out_shape = []
+    for s, size, chunk in zip(selection, shape, chunks):
+
+        if not isinstance(s, slice):
+            pieces.append([(int(s), None)])
+            continue
+
+        start, stop, step = s.indices(size)
+        assert step == 1, "only contiguous selections are supported"
+        stop = max(start, stop)
+        out_shape.append(stop - start)
+
+        dim_pieces = []
+        begin = start
+        while begin < stop:
+            end = min((begin//chunk + 1)*chunk, stop)
+            dim_pieces.append((slice(begin, end), slice(begin - start, end - start)))
+            begin = end
+        pieces.append(dim_pieces)
+
+    parts = []
+    for combination in itertools.product(*pieces):
+        source = tuple(p[0] for p in combination)
+        target = tuple(p[1] for p in combination if p[1] is not None)
+        parts.append((source, target))
+
+    return parts, tuple(out_shape)
@@ -0,0 +1,81 @@
+from .provider_test import ProviderTest
+from neurolight.gunpowder import BinarizeLabels
+from neurolight.gunpowder.packed_mask import PackedMask, PackedMaskArray
+from gunpowder import ArrayKey, ArraySpec, Array, Batch, BatchRequest, Roi
+import numpy as np
+
+
+class BinarizeLabelsTest(ProviderTest):
+
+    def test_binarize(self):
+
+        labels = ArrayKey('LABELS')
+        labels_binary = ArrayKey('LABELS_BINARY')
+
+        rs = np.random.RandomState(0)
+        labels_data = rs.randint(0, 3, size=(10, 21, 33)).astype(np.uint64)
+        expected = (labels_data > 0).astype(np.uint8)
+
+        spec = ArraySpec(
+            roi=Roi((0, 0, 0), (10, 21, 33)),
+            voxel_size=(1, 1, 1),
+            dtype=np.uint64)
+
+        request = BatchRequest()
+        request[labels] = ArraySpec(roi=spec.roi)
+        request[labels_binary] = ArraySpec(roi=spec.roi)
+
+        for kwargs in [{}, {'packed': True}, {'in_place': True}]:
+
+            batch = Batch()
+            batch[labels] = Array(labels_data.copy(), spec.copy())
+
+            binarize = BinarizeLabels(labels, labels_binary, tile_size=100, **kwargs)
+            binarize.process(batch, request)
+
+            self.assertEqual(batch[labels_binary].spec.dtype, np.uint8)
+            self.assertTrue(np.array_equal(np.asarray(batch[labels_binary].data), expected))
+            self.assertTrue(np.array_equal(batch[labels].data, labels_data))
+
+        # packed
+        batch = Batch()
+        batch[labels] = Array(labels_data.copy(), spec.copy())
+        BinarizeLabels(labels, labels_binary, packed=True).process(batch, request)
+        mask = batch[labels_binary].data
+        self.assertTrue(isinstance(mask, PackedMask))
+        self.assertEqual(mask.nbytes, -(-labels_data.size//8))
+        self.assertEqual(mask.count_nonzero(), np.count_nonzero(expected))
+        self.assertTrue(np.array_equal(mask[2:5, :, 3], expected[2:5, :, 3]))
+
+        # crops stay packed
+        cropped = batch.crop(BatchRequest({labels_binary: ArraySpec(roi=Roi((2, 5, 7), (3, 4, 5)))}))
+        self.assertTrue(isinstance(cropped[labels_binary], PackedMaskArray))
+        self.assertTrue(isinstance(cropped[labels_binary].data, PackedMask))
+        self.assertTrue(np.array_equal(
+            np.asarray(cropped[labels_binary].data),
+            expected[2:5, 5:9, 7:12]))
+
+        # in place, labels are not requested
+        del request[labels]
+        batch = Batch()
+        batch[labels] = Array(labels_data.copy(), spec.copy())
+        memory = batch[labels].data
+        BinarizeLabels(labels, labels_binary, in_place=True, tile_size=100).process(batch, request)
+
+        self.assertFalse(labels in batch.arrays)
+        self.assertTrue(np.shares_memory(batch[labels_binary].data, memory))
+        self.assertTrue(np.array_equal(batch[labels_binary].data, expected))
+
+        # in place, labels are a view of another array of the batch
+        other = ArrayKey('OTHER')
+        batch = Batch()
+        batch[other] = Array(np.stack([labels_data, labels_data]), ArraySpec(
+            roi=spec.roi, voxel_size=(1, 1, 1), dtype=np.uint64))
+        batch[labels] = Array(batch[other].data[1], spec.copy())
+        BinarizeLabels(labels, labels_binary, in_place=True, tile_size=100).process(batch, request)
+
+        self.assertTrue(labels in batch.arrays)
+        self.assertFalse(np.shares_memory(batch[labels_binary].data, batch[other].data))
+        self.assertTrue(np.array_equal(batch[labels_binary].data, expected))
+        self.assertTrue(np.array_equal(batch[other].data[0], labels_data))
+        self.assertTrue(np.array_equal(batch[other].data[1], labels_data))
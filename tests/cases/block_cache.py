@@ -0,0 +1,58 @@
+from .provider_test import ProviderTest
+from neurolight.gunpowder.block_cache import BlockCache
+import multiprocessing
+import numpy as np
+
+
+def _get_shared(cache, queue):
+    block = cache.get('b', (10, 10), np.float32)
+    queue.put(None if block is None else float(block.sum()))
+    cache.put('c', np.ones((10, 10), dtype=np.float32))
+    queue.put(cache.stats())
+
+
+class BlockCacheTest(ProviderTest):
+
+    def test_lru(self):
+
+        cache = BlockCache(max_bytes=3*400)
+        blocks = {
+            key: np.full((10, 10), i, dtype=np.float32)
+            for i, key in enumerate('abcd')}
+
+        for key in 'abc':
+            self.assertTrue(cache.get(key) is None)
+            cache.put(key, blocks[key])
+
+        # a is used, b is the least recently used
+        self.assertTrue(np.array_equal(cache.get('a'), blocks['a']))
+        cache.put('d', blocks['d'])
+
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 3*400)
+        self.assertFalse(cache.get('a').flags.writeable)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 4)
+
+    def test_shared(self):
+
+        cache = BlockCache(max_bytes=2**20, shared=True, name='neurolight_test')
+        try:
+            cache.put('b', np.full((10, 10), 2, dtype=np.float32))
+
+            context = multiprocessing.get_context('spawn')
+            queue = context.Queue()
+            process = context.Process(target=_get_shared, args=(cache, queue))
+            process.start()
+            self.assertEqual(queue.get(timeout=60), 200.0)
+            stats = queue.get(timeout=60)
+            process.join()
+
+            self.assertEqual(stats['hits'], 1)
+            # the block of the other process is gone with it
+            self.assertTrue(cache.get('c', (10, 10), np.float32) is None)
+        finally:
+            cache.clear()
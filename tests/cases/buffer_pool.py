@@ -0,0 +1,93 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.buffer_pool import BufferPool
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import h5py
+import pickle
+import unittest
+
+
+class BufferPoolTest(unittest.TestCase):
+
+    def test_reuse(self):
+
+        pool = BufferPool(max_buffers=2)
+
+        a, reused = pool.get((4, 5), np.float32)
+        self.assertFalse(reused)
+        self.assertEqual(a.shape, (4, 5))
+        self.assertEqual(a.dtype, np.float32)
+
+        # still referenced through a view
+        view = a[1:]
+        del a
+        b, reused = pool.get((4, 5), np.float32)
+        self.assertFalse(reused)
+
+        del view
+        c, reused = pool.get((4, 5), np.float32)
+        self.assertTrue(reused)
+
+        # pool is full, not pooled
+        d, reused = pool.get((4, 5), np.float32)
+        self.assertFalse(reused)
+
+        self.assertEqual(pool.allocations, 3)
+        self.assertEqual(pool.reuses, 1)
+        self.assertEqual(pool.nbytes, 2*4*5*4)
+
+        copy = pickle.loads(pickle.dumps(pool))
+        self.assertEqual(copy.nbytes, 0)
+        self.assertFalse(copy.get((4, 5), np.float32)[1])
+
+
+class BufferPoolSourceTest(TestWithTempFiles):
+
+    def test_read_into_pool(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(20, 20, 20, 3), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f['raw'] = data
+
+        raw = ArrayKey('RAW')
+        all_channels = ArrayKey('ALL_CHANNELS')
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={raw: 'raw', all_channels: 'raw'},
+            channel_ids={raw: 2},
+            data_format='channels_last',
+            array_specs={
+                raw: ArraySpec(voxel_size=(1, 1, 1)),
+                all_channels: ArraySpec(voxel_size=(1, 1, 1))},
+            buffer_pool=4)
+
+        with build(source):
+
+            counts = []
+            for z in range(0, 10, 2):
+                request = BatchRequest()
+                request[raw] = ArraySpec(roi=Roi((z, 1, 2), (5, 6, 7)))
+                request[all_channels] = ArraySpec(roi=Roi((0, z, 0), (4, 4, 4)))
+                batch = source.request_batch(request)
+
+                self.assertTrue(np.array_equal(
+                    batch[raw].data,
+                    data[z:z + 5, 1:7, 2:9, 2]))
+                self.assertTrue(np.array_equal(
+                    batch[all_channels].data,
+                    np.moveaxis(data[0:4, z:z + 4, 0:4], -1, 0)))
+
+                summaries = batch.profiling_stats.get_timing_summaries()
+                counts.append(tuple(
+                    sum(s.counts() for (_, method), s in summaries.items() if method == name)
+                    for name in ['allocate', 'reuse']))
+
+                # released downstream
+                del batch
+
+        # fresh arrays for the first batch only
+        self.assertEqual(counts, [(2, 0)] + [(0, 2)]*4)
+        self.assertEqual(source.buffer_pool.allocations, 2)
+        self.assertEqual(source.buffer_pool.reuses, 8)
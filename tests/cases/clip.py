@@ -0,0 +1,212 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder.clip import Clip
+from neurolight.gunpowder.intensity_statistics import (
+    compute_statistics, read_statistics, get_percentiles)
+from neurolight.gunpowder.quantile_sketch import QuantileSketch
+from gunpowder import ArrayKey, ArraySpec, Array, Batch, Roi
+import numpy as np
+import h5py
+import json
+
+
+class ClipTest(TestWithTempFiles):
+
+    def test_statistics(self):
+
+        filename = self.path_to('data.hdf')
+
+        rs = np.random.RandomState(0)
+        raw_int = rs.randint(0, 4000, size=(3, 40, 30, 20)).astype(np.uint16)
+        raw_float = rs.randn(20, 30, 40, 2).astype(np.float32)
+
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw_int', data=raw_int, chunks=(1, 16, 16, 16))
+            f.create_dataset('raw_float', data=raw_float)
+
+        for num_workers in [1, 2]:
+            compute_statistics(
+                filename, 'raw_int',
+                block_shape=(16, 16, 16),
+                num_workers=num_workers)
+            compute_statistics(
+                filename, 'raw_float',
+                data_format='channels_last',
+                block_shape=(16, 16, 16),
+                num_workers=num_workers)
+
+            # exact for integers
+            statistics = read_statistics(filename, 'raw_int')
+            for c in range(3):
+                channel = statistics['channels'][c]
+                self.assertEqual(channel['min'], raw_int[c].min())
+                self.assertEqual(channel['max'], raw_int[c].max())
+                self.assertEqual(sum(channel['histogram']), raw_int[c].size)
+            for p in [0.1, 50, 99.9, 42]:
+                self.assertTrue(np.array_equal(
+                    get_percentiles(statistics, [p])[0],
+                    np.percentile(
+                        raw_int.reshape(3, -1), p,
+                        axis=1, method='inverted_cdf')))
+
+            # close for floats
+            statistics = read_statistics(filename, 'raw_float')
+            for p in [1, 50, 99]:
+                self.assertTrue(np.allclose(
+                    get_percentiles(statistics, [p])[0],
+                    np.percentile(raw_float.reshape(-1, 2), p, axis=0),
+                    atol=0.01))
+
+        # clip to statistics
+        raw = ArrayKey('RAW')
+        clip = Clip(
+            raw,
+            statistics=filename,
+            dataset='raw_int',
+            percentiles=(1, 99),
+            in_place=True)
+        clip.setup()
+
+        spec = ArraySpec(roi=Roi((0, 0, 0), (40, 30, 20)), dtype=np.uint16)
+        data = raw_int.copy()
+        batch = Batch()
+        batch[raw] = Array(data, spec)
+        clip.process(batch, None)
+
+        bounds = np.percentile(
+            raw_int.reshape(3, -1), [1, 99],
+            axis=1, method='inverted_cdf')
+        self.assertTrue(batch[raw].data is data)
+        self.assertTrue(np.array_equal(
+            data,
+            np.clip(raw_int, bounds[0][:, None, None, None], bounds[1][:, None, None, None])))
+
+        # single channel
+        clip = Clip(
+            raw,
+            statistics=filename,
+            dataset='raw_int',
+            percentiles=(1, 99),
+            channels=[1])
+        clip.setup()
+
+        batch = Batch()
+        batch[raw] = Array(raw_int[1:2].copy(), spec)
+        clip.process(batch, None)
+        self.assertEqual(batch[raw].data.min(), bounds[0][1])
+        self.assertEqual(batch[raw].data.max(), bounds[1][1])
+
+    def test_shared_memory(self):
+
+        raw = ArrayKey('RAW')
+        other = ArrayKey('OTHER')
+        spec = ArraySpec(roi=Roi((0, 0, 0), (10, 10, 10)), dtype=np.float32)
+
+        # two channels read together, as views of one array
+        data = np.random.randn(2, 10, 10, 10).astype(np.float32)
+        original = data.copy()
+
+        for in_place in [False, True]:
+
+            batch = Batch()
+            batch[raw] = Array(data[0:1], spec)
+            batch[other] = Array(data[1:2], spec)
+            Clip(raw, min=-0.5, max=0.5, in_place=in_place).process(batch, None)
+
+            self.assertTrue(np.array_equal(data, original))
+            self.assertTrue(np.array_equal(batch[raw].data, np.clip(original[0:1], -0.5, 0.5)))
+            self.assertEqual(batch[raw].data.dtype, np.float32)
+
+        # a new array by default
+        owned = original.copy()
+        batch = Batch()
+        batch[raw] = Array(owned, spec)
+        Clip(raw, min=-0.5, max=0.5).process(batch, None)
+        self.assertTrue(np.array_equal(owned, original))
+        self.assertFalse(batch[raw].data is owned)
+
+    def test_integer_bounds(self):
+
+        raw = ArrayKey('RAW')
+        spec = ArraySpec(roi=Roi((0, 0, 0), (4, 8, 8)), dtype=np.uint8)
+        data = np.arange(256, dtype=np.uint8).reshape(4, 8, 8)
+
+        # bounds outside of the range of uint8
+        for min, max, expected in [
+                (-10, 300, data),
+                (-10, 100.4, np.clip(data, 0, 100)),
+                (20, 1e10, np.clip(data, 20, 255))]:
+
+            batch = Batch()
+            batch[raw] = Array(data.copy(), spec)
+            Clip(raw, min=min, max=max).process(batch, None)
+
+            self.assertEqual(batch[raw].data.dtype, np.uint8)
+            self.assertTrue(np.array_equal(batch[raw].data, expected))
+
+        # per channel
+        batch = Batch()
+        batch[raw] = Array(np.stack([data, data]), spec)
+        Clip(raw, min=[-1, 3], max=[256, 7]).process(batch, None)
+        self.assertTrue(np.array_equal(batch[raw].data, np.stack([data, np.clip(data, 3, 7)])))
+
+    def test_quantile_sketch(self):
+
+        rs = np.random.RandomState(0)
+        values = np.concatenate([
+            rs.lognormal(3, 1, size=10000),
+            -rs.lognormal(0, 1, size=1000),
+            np.zeros((500,))])
+
+        # merged sketches are equal to a sketch of all values
+        parts = [QuantileSketch(0.01) for _ in range(3)]
+        for part, v in zip(parts, np.array_split(values, 3)):
+            part.update(v)
+        sketch = QuantileSketch.from_dict(parts[0].to_dict())
+        sketch.merge(parts[1])
+        sketch.merge(parts[2])
+
+        full = QuantileSketch(0.01)
+        full.update(values)
+        self.assertEqual(sketch.to_dict(), full.to_dict())
+
+        for q in [0.0, 0.001, 0.05, 0.1, 0.5, 0.9, 0.999, 1.0]:
+            exact = np.percentile(values, 100*q, method='lower')
+            estimate = sketch.quantile(q)
+            self.assertLessEqual(abs(estimate - exact), 0.01*abs(exact) + 1e-9)
+
+    def test_sketch_mode(self):
+
+        raw = ArrayKey('RAW')
+        sketch_file = self.path_to('sketch.json')
+        spec = ArraySpec(roi=Roi((0, 0, 0), (20, 20, 20)), dtype=np.float32)
+
+        rs = np.random.RandomState(0)
+        clips = [
+            Clip(
+                raw,
+                percentiles=(1, 99),
+                sketch=True,
+                sample_size=1000,
+                sketch_file=sketch_file,
+                sync_every=2,
+                in_place=True)
+            for _ in range(2)
+        ]
+
+        for i in range(10):
+            for clip in clips:
+                data = rs.randn(2, 20, 20, 20).astype(np.float32)
+                data[1] += 10
+                batch = Batch()
+                batch[raw] = Array(data, spec)
+                clip.process(batch, None)
+                self.assertTrue(batch[raw].data is data)
+
+        # samples are merged in the sketch file at batches 1, 3, ..., 9
+        with open(sketch_file) as f:
+            shared = [QuantileSketch.from_dict(d) for d in json.load(f)]
+        self.assertEqual(shared[0].count, 2*9*1000)
+
+        for c, offset in enumerate([0, 10]):
+            self.assertLess(abs(data[c].min() - (offset - 2.33)), 0.2)
+            self.assertLess(abs(data[c].max() - (offset + 2.33)), 0.2)
@@ -0,0 +1,121 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder.convert_rgb_to_hls import (
+    getHls, getHlsVector, getHlsLut, clearHlsLuts)
+import numpy as np
+import os
+
+
+def _reference_hls(rgb):
+
+    # the conversion of the whole volume at once, before tiling
+    maxc = np.max(rgb, axis=0)
+    minc = np.min(rgb, axis=0)
+    dst = np.zeros_like(rgb, dtype=np.float32)
+
+    dst[1] = (minc + maxc) / 2.0
+
+    not_white = minc != maxc
+    minus = maxc - minc
+    plus = maxc + minc
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        dark = dst[1] < 0.5
+        idx = np.logical_and(dark, not_white)
+        dst[2, idx] = np.divide(minus[idx], plus[idx])
+
+        idx = np.logical_and(np.logical_not(dark), not_white)
+        dst[2, idx] = np.divide(minus[idx], (2.0 - plus)[idx])
+
+        rc = np.divide((maxc - rgb[0]), minus)
+        gc = np.divide((maxc - rgb[1]), minus)
+        bc = np.divide((maxc - rgb[2]), minus)
+
+        idx = np.logical_and(rgb[0] == maxc, not_white)
+        dst[0, idx] = bc[idx] - gc[idx]
+        idx = np.logical_and(rgb[1] == maxc, not_white)
+        dst[0, idx] = 2.0 + rc[idx] - bc[idx]
+        idx = np.logical_and(rgb[2] == maxc, not_white)
+        dst[0, idx] = (4.0 + gc - rc)[idx]
+
+        dst[0] = (dst[0] / 6.0) % 1.0
+
+    return dst
+
+
+class ConvertRgbToHlsTest(TestWithTempFiles):
+
+    def test_reference(self):
+
+        rs = np.random.RandomState(0)
+
+        # ties between channels, grey, white, and black
+        special = np.array([
+            [1.0, 1.0, 0.2],
+            [0.3, 0.8, 0.8],
+            [0.6, 0.1, 0.6],
+            [0.7, 0.7, 0.7],
+            [0.5, 0.5, 0.5],
+            [1.0, 1.0, 1.0],
+            [0.0, 0.0, 0.0],
+            [0.0, 0.0, 1.0],
+            [0.9, 0.9, 0.9 - 1e-7],
+        ]).T
+
+        for dtype in [np.float32, np.float64]:
+
+            rgb = rs.rand(3, 7, 11, 13).astype(dtype)
+            # quantized values, such that ties are frequent
+            rgb[:, :3] = np.round(rgb[:, :3]*4)/4
+            rgb[:, 3, 0, :special.shape[1]] = special
+
+            expected = _reference_hls(rgb)
+            for tile_size in [1, 100, 2**14]:
+                hls = getHls(rgb, tile_size=tile_size)
+                self.assertEqual(hls.dtype, np.float32)
+                self.assertTrue(np.array_equal(hls, expected), dtype)
+
+        # further channels are zero
+        rgb = rs.rand(4, 5, 6).astype(np.float32)
+        out = np.full(rgb.shape, np.nan, dtype=np.float32)
+        getHls(rgb, out=out)
+        self.assertTrue(np.array_equal(out[:3], _reference_hls(rgb[:3])))
+        self.assertFalse(np.any(out[3]))
+
+    def test_lookup_table(self):
+
+        v = np.arange(0, 256, 5, dtype=np.uint8)
+        rgb = np.stack(np.meshgrid(v, v, v, indexing='ij'))
+        normalized = rgb.astype(np.float64)/255.0
+
+        # integer data is normalized without lookup table as well
+        self.assertTrue(np.array_equal(getHls(rgb), getHls(normalized)))
+        self.assertTrue(np.array_equal(getHlsVector(rgb), getHlsVector(normalized)))
+
+        cache_dir = self.path_to('cache')
+        clearHlsLuts()
+        getHlsLut(np.uint8, 5, cache_dir=cache_dir)
+        getHlsLut(np.uint8, 5, vector=True, cache_dir=cache_dir)
+        self.assertTrue(os.path.exists(
+            os.path.join(cache_dir, 'hls_lut_uint8_5.npy')))
+
+        # the conversion of the center of the quantization bin is exact
+        centers = ((rgb >> 3).astype(np.float64)*8 + 3.5)/255.0
+        self.assertTrue(np.array_equal(
+            getHls(rgb, bit_depth=5),
+            getHls(centers)))
+        self.assertTrue(np.array_equal(
+            getHlsVector(rgb, bit_depth=5),
+            getHlsVector(centers)))
+
+        # tables are loaded from the cache
+        clearHlsLuts()
+        lut = getHlsLut(np.uint8, 5, cache_dir=cache_dir)
+        self.assertTrue(isinstance(lut, np.memmap))
+        clearHlsLuts()
+
+        # lightness is quantized
+        getHlsLut(np.uint8, 4, cache_dir=cache_dir)
+        hls = getHls(rgb, bit_depth=4)
+        self.assertLess(np.abs(hls[1] - getHls(normalized)[1]).max(), 0.03)
+        clearHlsLuts()
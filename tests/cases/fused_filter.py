@@ -0,0 +1,136 @@
+from .provider_test import ProviderTest
+from neurolight.gunpowder import (
+    Clip,
+    ConvertRgbToHls,
+    ConvertRgbToHlsVector,
+    MergeChannel,
+    BinarizeLabels,
+    CountOverlap,
+    RemoveOverlap,
+    FusedFilter,
+    ClipOp,
+    HlsOp,
+    BinarizeOp,
+    CountOverlapOp,
+    RemoveOverlapOp)
+from gunpowder import ArrayKey, ArraySpec, Array, Batch, BatchRequest, Roi
+import numpy as np
+
+
+class FusedFilterTest(ProviderTest):
+
+    def test_same_as_nodes(self):
+
+        raw = ArrayKey('RAW')
+        hls = ArrayKey('HLS')
+        gt = ArrayKey('GT')
+        gt_fg = ArrayKey('GT_FG')
+        gt_overlap = ArrayKey('GT_OVERLAP')
+        gt_cleaned = ArrayKey('GT_CLEANED')
+
+        rs = np.random.RandomState(0)
+        raw_data = rs.rand(3, 20, 30, 40).astype(np.float32)*1.2 - 0.1
+
+        gt_data = np.zeros((4, 20, 30, 40), dtype=np.uint16)
+        for i in range(4):
+            gt_data[i, 2*i:2*i + 10, 5:25, 10:30] = i + 1
+
+        roi = Roi((0, 0, 0), (20, 30, 40))
+
+        def get_batch():
+            batch = Batch()
+            batch[raw] = Array(
+                raw_data.copy(),
+                ArraySpec(roi=roi, dtype=np.float32))
+            batch[gt] = Array(
+                gt_data.copy(),
+                ArraySpec(roi=roi, dtype=np.uint16))
+            return batch
+
+        request = BatchRequest()
+        for key in [raw, hls, gt, gt_fg, gt_overlap, gt_cleaned]:
+            request[key] = ArraySpec(roi=roi)
+
+        # separate nodes
+        expected = get_batch()
+        count_overlap = CountOverlap(gt, gt_overlap)
+        count_overlap.dims = 3
+        remove_overlap = RemoveOverlap(gt, gt_cleaned)
+        remove_overlap.dims = 3
+        for node in [
+                Clip(raw, 0, 1),
+                ConvertRgbToHlsVector(raw, hls),
+                BinarizeLabels(gt, gt_fg),
+                count_overlap,
+                remove_overlap]:
+            node.process(expected, request)
+
+        # fused, with tiles of less than one section and several sections
+        for tile_size in [1, 2000, 10**6]:
+
+            fused = FusedFilter(
+                [
+                    ClipOp(raw, 0, 1),
+                    HlsOp(raw, hls, vector=True),
+                    BinarizeOp(gt, gt_fg),
+                    CountOverlapOp(gt, gt_overlap),
+                    RemoveOverlapOp(gt, gt_cleaned)
+                ],
+                tile_size=tile_size)
+
+            batch = get_batch()
+            fused.process(batch, request)
+
+            for key in [raw, hls, gt, gt_fg, gt_overlap, gt_cleaned]:
+                self.assertTrue(
+                    np.array_equal(batch[key].data, expected[key].data),
+                    "%s differs" % key)
+                self.assertEqual(batch[key].data.dtype, expected[key].data.dtype)
+
+    def test_merged_channels(self):
+
+        red, green, blue = ArrayKey('RED'), ArrayKey('GREEN'), ArrayKey('BLUE')
+        raw = ArrayKey('RAW')
+        hls = ArrayKey('HLS')
+
+        rs = np.random.RandomState(0)
+        channels = rs.rand(3, 20, 30, 40).astype(np.float32)*1.2 - 0.1
+        roi = Roi((0, 0, 0), (20, 30, 40))
+
+        def get_batch():
+            batch = Batch()
+            for key, data in zip([red, green, blue], channels):
+                batch[key] = Array(
+                    data.copy(),
+                    ArraySpec(roi=roi, voxel_size=(1, 1, 1), dtype=np.float32))
+            MergeChannel([red, green, blue], raw).process(batch, BatchRequest())
+            return batch
+
+        # the ROI of the merged array has the channels as first dimension
+        request = BatchRequest()
+        merged_roi = get_batch()[raw].spec.roi
+        self.assertEqual(merged_roi.dims(), 4)
+        for key in [raw, hls]:
+            request[key] = ArraySpec(roi=merged_roi)
+
+        expected = get_batch()
+        Clip(raw, [0, 0.1, 0.2], [1, 0.9, 0.8]).process(expected, request)
+        ConvertRgbToHls(raw, hls).process(expected, request)
+
+        for tile_size in [1, 2000]:
+
+            fused = FusedFilter(
+                [
+                    ClipOp(raw, [0, 0.1, 0.2], [1, 0.9, 0.8]),
+                    HlsOp(raw, hls)
+                ],
+                tile_size=tile_size,
+                spatial_dims=3)
+
+            batch = get_batch()
+            fused.process(batch, request)
+
+            for key in [raw, hls]:
+                self.assertTrue(
+                    np.array_equal(batch[key].data, expected[key].data),
+                    "%s differs" % key)
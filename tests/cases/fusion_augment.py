@@ -1,12 +1,15 @@
 from .provider_test import TestWithTempFiles
 from neurolight.gunpowder.swc_file_source import SwcFileSource, SwcPoint
-from neurolight.gunpowder.fusion_augment import FusionAugment
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.fusion_augment import FusionAugment, precompute_alpha
 from neurolight.gunpowder.rasterize_skeleton import RasterizeSkeleton
 from gunpowder import (
     PointsKey,
     PointsSpec,
     ArrayKey,
     ArraySpec,
+    Array,
+    Batch,
     BatchRequest,
     Roi,
     build,
@@ -14,7 +17,9 @@ from gunpowder import (
     MergeProvider,
 )
 
+import h5py
 import numpy as np
+import tracemalloc
 
 try:
     from spimagine import volshow
@@ -23,6 +28,7 @@ try:
 except Exception:
     imported_volshow = False
 
+from scipy import ndimage
 from typing import Dict, List, Tuple, Optional
 from pathlib import Path
 
@@ -359,3 +365,298 @@ class FusionAugmentTest(TestWithTempFiles):
         diff = np.linalg.norm(fused_data - a_data - b_data)
         self.assertAlmostEqual(diff, 0)
 
+    def _get_fusion_batch(
+        self, shape=(64, 64, 64), num_channels=3, num_volumes=2, random_raw=True
+    ):
+        names = "ABCD"[:num_volumes]
+        raw_keys = tuple(ArrayKey("RAW_" + name) for name in names)
+        labels_keys = tuple(ArrayKey("LABELS_" + name) for name in names)
+        roi = Roi((0, 0, 0), shape)
+
+        batch = Batch()
+        for i, (raw_key, labels_key) in enumerate(zip(raw_keys, labels_keys)):
+            labels = np.zeros(shape, dtype=np.uint32)
+            labels[4 + i * 16 : 12 + i * 16, 8:-8, 8:-8] = i + 1
+            raw = np.ones((num_channels,) + shape, dtype=np.float32)
+            if random_raw:
+                raw = np.random.random(raw.shape).astype(np.float32)
+            raw *= labels > 0
+            batch[labels_key] = Array(
+                labels,
+                ArraySpec(roi=roi, voxel_size=Coordinate((1, 1, 1)), dtype=np.uint32),
+            )
+            batch[raw_key] = Array(
+                raw,
+                ArraySpec(roi=roi, voxel_size=Coordinate((1, 1, 1)), dtype=np.float32),
+            )
+
+        return batch, raw_keys, labels_keys
+
+    def test_in_place_fusion(self):
+        fused = ArrayKey("FUSED")
+        fused_labels = ArrayKey("FUSED_LABELS")
+
+        for blend_mode in ["labels_mask", "intensity"]:
+
+            results = []
+            for in_place in [False, True]:
+
+                np.random.seed(42)
+                batch, raw_keys, labels_keys = self._get_fusion_batch()
+                request = BatchRequest()
+                request[fused] = ArraySpec(roi=batch[raw_keys[0]].spec.roi)
+                request[fused_labels] = ArraySpec(
+                    roi=batch[raw_keys[0]].spec.roi, dtype=np.uint32
+                )
+
+                fusion = FusionAugment(
+                    raw_keys[0],
+                    raw_keys[1],
+                    labels_keys[0],
+                    labels_keys[1],
+                    fused,
+                    fused_labels,
+                    blend_mode=blend_mode,
+                    in_place=in_place,
+                )
+
+                raw_nbytes = batch[raw_keys[0]].data.nbytes
+                tracemalloc.start()
+                fusion.process(batch, request)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                if in_place:
+                    self.assertLessEqual(peak, 2 * raw_nbytes)
+
+                self.assertEqual(batch[fused].data.dtype, np.float32)
+                results.append(batch[fused].data)
+
+            np.testing.assert_allclose(results[0], results[1], rtol=1e-5, atol=1e-6)
+
+    def test_multiple_add_volumes(self):
+        fused = ArrayKey("FUSED")
+        fused_labels = ArrayKey("FUSED_LABELS")
+
+        for num_blended_objects, in_place in [(0, False), (1, False), (1, True)]:
+
+            batch, raw_keys, labels_keys = self._get_fusion_batch(
+                shape=(48, 32, 32), num_volumes=3, random_raw=False
+            )
+            request = BatchRequest()
+            request[fused] = ArraySpec(roi=batch[raw_keys[0]].spec.roi)
+            request[fused_labels] = ArraySpec(
+                roi=batch[raw_keys[0]].spec.roi, dtype=np.uint32
+            )
+
+            fusion = FusionAugment(
+                raw_keys[0],
+                list(raw_keys[1:]),
+                labels_keys[0],
+                list(labels_keys[1:]),
+                fused,
+                fused_labels,
+                blend_mode="intensity",
+                num_blended_objects=num_blended_objects,
+                in_place=in_place,
+            )
+            fusion.process(batch, request)
+
+            # objects don't overlap and raw is constant inside of them, only
+            # the blended objects (labels after the base object) are added
+            blended = batch[fused_labels].data > 1
+            expected = batch[raw_keys[0]].data + blended * sum(
+                batch[key].data for key in raw_keys[1:]
+            )
+            np.testing.assert_allclose(batch[fused].data, expected, rtol=1e-5)
+
+            # the base object and one new label per blended object
+            fused_ids = np.unique(batch[fused_labels].data)
+            num_objects = num_blended_objects if num_blended_objects > 0 else 2
+            np.testing.assert_array_equal(fused_ids, np.arange(num_objects + 2))
+
+    def test_large_label_ids(self):
+        fused = ArrayKey("FUSED")
+        fused_labels = ArrayKey("FUSED_LABELS")
+
+        batch, raw_keys, labels_keys = self._get_fusion_batch(shape=(32, 32, 32))
+        for key in labels_keys:
+            labels = batch[key].data.astype(np.uint64)
+            labels[labels > 0] += 2 ** 62
+            spec = batch[key].spec.copy()
+            spec.dtype = np.uint64
+            batch[key] = Array(labels, spec)
+
+        request = BatchRequest()
+        request[fused] = ArraySpec(roi=batch[raw_keys[0]].spec.roi)
+        request[fused_labels] = ArraySpec(
+            roi=batch[raw_keys[0]].spec.roi, dtype=np.uint64
+        )
+
+        FusionAugment(
+            raw_keys[0], raw_keys[1], labels_keys[0], labels_keys[1], fused, fused_labels
+        ).process(batch, request)
+
+        np.testing.assert_array_equal(np.unique(batch[fused_labels].data), [0, 1, 2])
+
+    def test_precomputed_alpha(self):
+        fused = ArrayKey("FUSED")
+        fused_labels = ArrayKey("FUSED_LABELS")
+        alpha_key = ArrayKey("ALPHA_B")
+
+        batch, raw_keys, labels_keys = self._get_fusion_batch(shape=(40, 48, 56))
+        labels = batch[labels_keys[1]].data
+
+        # blocks smaller than the volume and the kernel radius
+        filename = self.path_to("alpha.hdf")
+        with h5py.File(filename, "w") as f:
+            f["labels"] = labels
+            f["labels"].attrs["resolution"] = (1, 1, 1)
+        precompute_alpha(filename, "labels", "alpha", blend_smoothness=3, block_shape=(16, 16, 16))
+
+        with h5py.File(filename, "r") as f:
+            alpha = f["alpha"][:]
+            self.assertEqual(tuple(f["alpha"].attrs["resolution"]), (1, 1, 1))
+
+        expected = ndimage.gaussian_filter(
+            (labels > 0).astype(np.float32), sigma=3, mode="nearest"
+        )
+        np.testing.assert_allclose(alpha, expected, atol=1e-6)
+
+        results = []
+        for alpha_add in [None, alpha_key]:
+            alpha_spec = batch[labels_keys[1]].spec.copy()
+            alpha_spec.dtype = np.float32
+            batch[alpha_key] = Array(alpha, alpha_spec)
+            request = BatchRequest()
+            request[fused] = ArraySpec(roi=batch[raw_keys[0]].spec.roi)
+            request[fused_labels] = ArraySpec(
+                roi=batch[raw_keys[0]].spec.roi, dtype=np.uint32
+            )
+            FusionAugment(
+                raw_keys[0],
+                raw_keys[1],
+                labels_keys[0],
+                labels_keys[1],
+                fused,
+                fused_labels,
+                blend_smoothness=3,
+                alpha_add=alpha_add,
+            ).process(batch, request)
+            results.append(batch[fused].data)
+
+        np.testing.assert_allclose(results[0], results[1], atol=1e-5)
+
+        # in a crop through the "add" object, smoothing in the batch and the
+        # precomputed alpha agree further than the kernel radius from the
+        # border of the crop
+        crop = Roi((2, 16, 5), (36, 30, 48))
+        radius = 12
+        interior = (slice(None),) + tuple(slice(radius, s - radius) for s in crop.get_shape())
+
+        crop_request = BatchRequest()
+        for key in raw_keys + labels_keys:
+            crop_request[key] = ArraySpec(roi=crop)
+
+        results = []
+        for alpha_add in [None, alpha_key]:
+            cropped = batch.crop(crop_request)
+            alpha_spec = cropped[labels_keys[1]].spec.copy()
+            alpha_spec.dtype = np.float32
+            cropped[alpha_key] = Array(alpha[crop.to_slices()], alpha_spec)
+            request = BatchRequest()
+            request[fused] = ArraySpec(roi=crop)
+            request[fused_labels] = ArraySpec(roi=crop, dtype=np.uint32)
+            FusionAugment(
+                raw_keys[0],
+                raw_keys[1],
+                labels_keys[0],
+                labels_keys[1],
+                fused,
+                fused_labels,
+                blend_smoothness=3,
+                alpha_add=alpha_add,
+            ).process(cropped, request)
+            results.append(cropped[fused].data)
+
+        self.assertFalse(np.allclose(results[0], results[1], atol=1e-5))
+        np.testing.assert_allclose(results[0][interior], results[1][interior], atol=1e-5)
+
+        # alpha is passed on by the source, with the smoothness it was computed with
+        for spec_cache in [None, True]:
+            source = Hdf5ChannelSource(
+                filename,
+                datasets={alpha_key: "alpha"},
+                array_specs={alpha_key: ArraySpec(voxel_size=(1, 1, 1))},
+                spec_cache=spec_cache,
+            )
+            alpha_request = BatchRequest()
+            alpha_request[alpha_key] = ArraySpec(roi=crop)
+            with build(source):
+                alpha_batch = source.request_batch(alpha_request)
+            self.assertEqual(alpha_batch[alpha_key].attrs["blend_smoothness"], 3)
+
+        # a different smoothness is rejected
+        request = BatchRequest()
+        request[fused] = ArraySpec(roi=crop)
+        request[fused_labels] = ArraySpec(roi=crop, dtype=np.uint32)
+        with self.assertRaises(RuntimeError):
+            FusionAugment(
+                raw_keys[0],
+                raw_keys[1],
+                labels_keys[0],
+                labels_keys[1],
+                fused,
+                fused_labels,
+                blend_smoothness=2,
+                alpha_add=alpha_key,
+            ).process(batch.crop(crop_request).merge(alpha_batch), request)
+
+    def test_precomputed_alpha_fallback(self):
+        fused = ArrayKey("FUSED")
+        fused_labels = ArrayKey("FUSED_LABELS")
+        alpha_keys = (ArrayKey("ALPHA_B"), ArrayKey("ALPHA_C"))
+
+        batch, raw_keys, labels_keys = self._get_fusion_batch(
+            shape=(48, 32, 32), num_volumes=3
+        )
+
+        # two objects in the first "add" volume
+        labels = batch[labels_keys[1]].data
+        labels[:, :16][labels[:, :16] > 0] = 5
+
+        for key, alpha_key in zip(labels_keys[1:], alpha_keys):
+            alpha = ndimage.gaussian_filter(
+                (batch[key].data > 0).astype(np.float32), sigma=3, mode="nearest"
+            )
+            alpha_spec = batch[key].spec.copy()
+            alpha_spec.dtype = np.float32
+            batch[alpha_key] = Array(alpha, alpha_spec)
+
+        # precomputed masks would contain objects that were not sampled, or
+        # count voxels of several "add" volumes twice: smooth in the batch
+        for num_add, num_blended_objects in [(1, 1), (2, 0), (2, 2)]:
+
+            results = []
+            for alpha_add in [None, list(alpha_keys[:num_add])]:
+
+                np.random.seed(42)
+                request = BatchRequest()
+                request[fused] = ArraySpec(roi=batch[raw_keys[0]].spec.roi)
+                request[fused_labels] = ArraySpec(
+                    roi=batch[raw_keys[0]].spec.roi, dtype=np.uint32
+                )
+                FusionAugment(
+                    raw_keys[0],
+                    list(raw_keys[1 : 1 + num_add]),
+                    labels_keys[0],
+                    list(labels_keys[1 : 1 + num_add]),
+                    fused,
+                    fused_labels,
+                    blend_smoothness=3,
+                    num_blended_objects=num_blended_objects,
+                    alpha_add=alpha_add,
+                ).process(batch, request)
+                results.append(batch[fused].data)
+
+            np.testing.assert_allclose(results[0], results[1], atol=1e-5)
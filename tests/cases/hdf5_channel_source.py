@@ -0,0 +1,96 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.block_cache import BlockCache
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import h5py
+
+
+class Hdf5ChannelSourceTest(TestWithTempFiles):
+
+    def test_channels_last_blocks(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(4, 20, 30, 40), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw', data=np.moveaxis(data, 0, -1), chunks=(8, 8, 8, 4))
+
+        keys = {
+            ArrayKey('RED'): 0,
+            ArrayKey('GREEN'): 1,
+            ArrayKey('ALL'): None,
+            ArrayKey('SOME'): [3, 1],
+        }
+
+        for kwargs in [{'chunk_aligned': False}, {}, {'block_cache': 2**20}]:
+
+            source = Hdf5ChannelSource(
+                filename,
+                datasets={key: 'raw' for key in keys},
+                channel_ids=keys,
+                data_format='channels_last',
+                array_specs={key: ArraySpec(voxel_size=(1, 1, 1)) for key in keys},
+                **kwargs)
+
+            with build(source):
+
+                for offset in [(3, 5, 7), (4, 6, 8), (10, 0, 20)]:
+
+                    roi = Roi(offset, (9, 10, 11))
+                    slices = roi.to_slices()
+
+                    request = BatchRequest()
+                    for key in keys:
+                        request[key] = ArraySpec(roi=roi)
+                    batch = source.request_batch(request)
+
+                    for key, channel_id in keys.items():
+                        if channel_id is None:
+                            expected = data[(slice(None),) + slices]
+                        else:
+                            expected = data[(channel_id,) + slices]
+                        self.assertTrue(np.array_equal(batch[key].data, expected))
+
+                    # modifying the data does not affect cached blocks
+                    for key in keys:
+                        batch[key].data[:] = 0
+
+            if 'block_cache' in kwargs:
+                # three reads per request (RED and GREEN are read together),
+                # of 12, 8 (all cached), and 8 (6 new) blocks
+                stats = source.block_cache.stats()
+                self.assertEqual(stats['misses'], 12 + 6)
+                self.assertEqual(stats['hits'], 2*12 + 3*8 + 2 + 2*8)
+
+    def test_shared_block_cache(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(20, 30, 40, 2), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw', data=data, chunks=(8, 8, 8, 2))
+
+        # sources with different block shapes do not share blocks
+        raw = ArrayKey('RAW')
+        block_cache = BlockCache(2**20)
+        roi = Roi((3, 5, 7), (9, 10, 11))
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=roi)
+
+        for block_shape in [(8, 8, 8), (5, 6, 7), (8, 8, 8)]:
+
+            source = Hdf5ChannelSource(
+                filename,
+                datasets={raw: 'raw'},
+                channel_ids={raw: 1},
+                data_format='channels_last',
+                array_specs={raw: ArraySpec(voxel_size=(1, 1, 1))},
+                block_cache=block_cache,
+                block_shape=block_shape)
+
+            with build(source):
+                batch = source.request_batch(request)
+
+            self.assertTrue(np.array_equal(batch[raw].data, data[roi.to_slices() + (1,)]))
+
+        # the blocks of the first source are reused by the third
+        self.assertEqual(block_cache.stats()['hits'], 2*2*3)
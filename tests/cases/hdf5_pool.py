@@ -0,0 +1,103 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.hdf5_pool import open_hdf5, close_hdf5
+from neurolight.gunpowder.fusion_augment import precompute_alpha
+from neurolight.gunpowder.pyramid import build_pyramid
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import multiprocessing
+import numpy as np
+import h5py
+
+
+def _request_sum(source, request, queue):
+    queue.put(int(source.request_batch(request)[ArrayKey('RAW')].data.sum()))
+
+
+class Hdf5PoolTest(TestWithTempFiles):
+
+    def test_pool(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(2, 10, 20, 30), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw', data=data, chunks=(1, 5, 10, 10))
+
+        raw = ArrayKey('RAW')
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={raw: 'raw'},
+            channel_ids={raw: 1},
+            array_specs={raw: ArraySpec(voxel_size=(1, 1, 1))},
+            keep_open=True,
+            rdcc_nbytes=2**20,
+            rdcc_nslots=521)
+
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=Roi((2, 4, 6), (5, 10, 15)))
+
+        with build(source):
+
+            data_file = open_hdf5(filename, 2**20, 521)
+            for _ in range(2):
+                batch = source.request_batch(request)
+                self.assertTrue(data_file.id.valid)
+                self.assertTrue(open_hdf5(filename, 2**20, 521) is data_file)
+                self.assertTrue(np.array_equal(
+                    batch[raw].data.reshape(5, 10, 15),
+                    data[1, 2:7, 4:14, 6:21]))
+
+            # forked workers open their own handle
+            context = multiprocessing.get_context('fork')
+            queue = context.Queue()
+            process = context.Process(target=_request_sum, args=(source, request, queue))
+            process.start()
+            self.assertEqual(queue.get(timeout=60), int(data[1, 2:7, 4:14, 6:21].sum()))
+            process.join()
+            self.assertTrue(data_file.id.valid)
+
+        close_hdf5(filename)
+        self.assertFalse(data_file.id.valid)
+
+        # the file can be written again after closing
+        with h5py.File(filename, 'w') as f:
+            f['raw'] = data
+
+    def test_write_after_read(self):
+
+        filename = self.path_to('labels.hdf')
+        labels = np.zeros((8, 8, 8), dtype=np.uint64)
+        labels[2:6, 2:6, 2:6] = 1
+        with h5py.File(filename, 'w') as f:
+            f['labels/s0'] = labels
+
+        key = ArrayKey('LABELS')
+        request = BatchRequest()
+        request[key] = ArraySpec(roi=Roi((0, 0, 0), (8, 8, 8)))
+
+        # by default, the file is not kept open
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={key: 'labels/s0'},
+            array_specs={key: ArraySpec(voxel_size=(1, 1, 1))})
+        with build(source):
+            source.request_batch(request)
+        with h5py.File(filename, 'r+') as f:
+            f['labels/s0'].attrs['resolution'] = (1, 1, 1)
+
+        # pooled handles are closed by the writers
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={key: 'labels/s0'},
+            array_specs={key: ArraySpec(voxel_size=(1, 1, 1))},
+            keep_open=True)
+        with build(source):
+            source.request_batch(request)
+            precompute_alpha(filename, 'labels/s0', 'alpha', blend_smoothness=1)
+            source.request_batch(request)
+            build_pyramid(filename, 'labels', num_levels=1, downsample='nearest')
+            batch = source.request_batch(request)
+
+        self.assertTrue(np.array_equal(batch[key].data, labels))
+        with h5py.File(filename, 'r') as f:
+            self.assertEqual(f['alpha'].shape, (8, 8, 8))
+            self.assertEqual(f['labels/s1'].shape, (4, 4, 4))
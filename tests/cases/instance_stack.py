@@ -0,0 +1,158 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.instance_stack import InstanceStack, instance_stack_array
+from neurolight.gunpowder.crop import crop_view
+from neurolight.gunpowder.overlap import compute_overlap
+from gunpowder import ArrayKey, ArraySpec, BatchFilter, BatchRequest, Coordinate, Roi, build
+import numpy as np
+import h5py
+
+
+class GrowRequest(BatchFilter):
+
+    def __init__(self, key, amount):
+        self.key = key
+        self.amount = Coordinate(amount)
+
+    def prepare(self, request):
+        request[self.key].roi = request[self.key].roi.grow(self.amount, self.amount)
+        dependencies = BatchRequest()
+        dependencies[self.key] = request[self.key].copy()
+        return dependencies
+
+    def process(self, batch, request):
+        pass
+
+
+class InstanceStackTest(TestWithTempFiles):
+
+    def _get_instances(self):
+
+        rs = np.random.RandomState(0)
+        instances = (rs.rand(60, 10, 20, 30) > 0.99).astype(np.uint64)
+        instances *= np.arange(1, 61, dtype=np.uint64)[:, None, None, None]
+        instances[3] += (instances[3] > 0)*np.uint64(2**40)
+
+        return instances
+
+    def test_dense(self):
+
+        instances = self._get_instances()
+        stack = InstanceStack.from_dense(instances)
+
+        self.assertEqual(stack.shape, instances.shape)
+        self.assertEqual(stack.dtype, instances.dtype)
+        self.assertTrue(np.array_equal(np.asarray(stack), instances))
+        self.assertLess(stack.nbytes, instances.nbytes/20)
+        self.assertGreater(len(stack.overlap_indices), 0)
+
+        # crops stay compact
+        for item in [
+                (slice(None), slice(2, 8), slice(5, 15), slice(None)),
+                (slice(None), slice(None, -1)),
+                slice(None)]:
+            cropped = stack[item]
+            self.assertTrue(isinstance(cropped, InstanceStack))
+            self.assertTrue(np.array_equal(np.asarray(cropped), instances[item]))
+
+        self.assertTrue(np.array_equal(stack[5:7, 1], instances[5:7, 1]))
+
+        array = instance_stack_array(
+            stack,
+            ArraySpec(roi=Roi((0, 0, 0), (10, 20, 30)), voxel_size=(1, 1, 1)))
+        cropped = crop_view(array, Roi((1, 2, 3), (4, 5, 6)))
+        self.assertTrue(isinstance(cropped.data, InstanceStack))
+        self.assertTrue(np.array_equal(
+            np.asarray(cropped.data),
+            instances[:, 1:5, 2:7, 3:9]))
+
+        expected = compute_overlap(instances, 3, dtype=np.uint64)
+        overlap = compute_overlap(stack, 3, dtype=np.uint64)
+        self.assertTrue(np.array_equal(overlap.count, expected.count))
+        self.assertTrue(np.array_equal(overlap.cleaned, expected.cleaned))
+
+    def test_source(self):
+
+        instances = self._get_instances()
+        filename = self.path_to('instances.hdf')
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('instances', data=instances)
+            f.create_dataset('instances_last', data=np.moveaxis(instances, 0, -1))
+
+        gt = ArrayKey('GT')
+        gt_last = ArrayKey('GT_LAST')
+        gt_dense = ArrayKey('GT_DENSE')
+
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={
+                gt: 'instances',
+                gt_dense: 'instances'},
+            instance_stacks=[gt],
+            array_specs={
+                gt: ArraySpec(voxel_size=(1, 1, 1)),
+                gt_dense: ArraySpec(voxel_size=(1, 1, 1))})
+
+        roi = Roi((2, 3, 4), (5, 10, 20))
+        request = BatchRequest()
+        request[gt] = ArraySpec(roi=roi)
+        request[gt_dense] = ArraySpec(roi=roi)
+
+        with build(source):
+            batch = source.request_batch(request)
+
+        self.assertTrue(isinstance(batch[gt].data, InstanceStack))
+        self.assertTrue(isinstance(batch[gt_dense].data, np.ndarray))
+        expected = instances[(slice(None),) + roi.to_slices()]
+        self.assertTrue(np.array_equal(np.asarray(batch[gt].data), expected))
+        self.assertTrue(np.array_equal(batch[gt_dense].data, expected))
+
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={gt_last: 'instances_last'},
+            data_format='channels_last',
+            instance_stacks=[gt_last],
+            array_specs={gt_last: ArraySpec(voxel_size=(1, 1, 1))})
+        request = BatchRequest()
+        request[gt_last] = ArraySpec(roi=roi)
+
+        with build(source):
+            batch = source.request_batch(request)
+
+        self.assertTrue(isinstance(batch[gt_last].data, InstanceStack))
+        self.assertTrue(np.array_equal(np.asarray(batch[gt_last].data), expected))
+
+    def test_crop_in_pipeline(self):
+
+        instances = self._get_instances()
+        filename = self.path_to('instances.hdf')
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('instances', data=instances)
+
+        gt = ArrayKey('GT')
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={gt: 'instances'},
+            instance_stacks=[gt],
+            array_specs={gt: ArraySpec(voxel_size=(1, 1, 1))})
+
+        # the upstream batch is larger and cropped to the request
+        roi = Roi((2, 3, 4), (5, 10, 20))
+        request = BatchRequest()
+        request[gt] = ArraySpec(roi=roi)
+        pipeline = source + GrowRequest(gt, (1, 2, 3))
+
+        with build(pipeline):
+            batch = pipeline.request_batch(request)
+
+        self.assertEqual(batch[gt].spec.roi, roi)
+        self.assertTrue(isinstance(batch[gt].data, InstanceStack))
+        self.assertTrue(np.array_equal(
+            np.asarray(batch[gt].data),
+            instances[(slice(None),) + roi.to_slices()]))
+
+        cropped = batch[gt].crop(Roi((3, 5, 6), (2, 3, 4)), copy=True)
+        self.assertTrue(isinstance(cropped.data, InstanceStack))
+        self.assertTrue(np.array_equal(
+            np.asarray(cropped.data),
+            instances[:, 3:5, 5:8, 6:10]))
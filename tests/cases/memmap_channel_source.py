@@ -0,0 +1,78 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import MemmapChannelSource, MergeChannel, Clip
+from neurolight.gunpowder.memmap_channel_source import export_memmap
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import h5py
+
+
+def _is_mapped(array):
+    while array is not None and not isinstance(array, np.memmap):
+        array = array.base
+    return array is not None
+
+
+class MemmapChannelSourceTest(TestWithTempFiles):
+
+    def test_export_and_read(self):
+
+        data = np.random.randint(0, 255, size=(4, 20, 30, 40), dtype=np.uint8)
+
+        for data_format in ['channels_first', 'channels_last']:
+
+            filename = self.path_to('%s.hdf' % data_format)
+            with h5py.File(filename, 'w') as f:
+                if data_format == 'channels_first':
+                    f.create_dataset('volumes/raw', data=data, chunks=(1, 8, 8, 8), compression='gzip')
+                else:
+                    f.create_dataset('volumes/raw', data=np.moveaxis(data, 0, -1), compression='gzip')
+                f['volumes/raw'].attrs['resolution'] = (2, 1, 1)
+                f['volumes/raw'].attrs['offset'] = (10, 0, 0)
+
+            directory = self.path_to('%s_memmap' % data_format)
+            export_memmap(
+                filename,
+                ['volumes/raw'],
+                directory,
+                channels={'volumes/raw': [1, 2, 3]},
+                data_format=data_format,
+                block_depth=7)
+
+            keys = {
+                ArrayKey('GREEN'): 2,
+                ArrayKey('BLUE'): 3,
+                ArrayKey('SOME'): [3, 1],
+                ArrayKey('ALL'): None,
+            }
+            merged = ArrayKey('MERGED')
+            source = MemmapChannelSource(
+                directory,
+                datasets={key: 'volumes/raw' for key in keys},
+                channel_ids=keys)
+
+            roi = Roi((14, 5, 6), (10, 10, 15))
+            slices = (slice(2, 7), slice(5, 15), slice(6, 21))
+
+            request = BatchRequest()
+            for key in keys:
+                request[key] = ArraySpec(roi=roi)
+
+            with build(source):
+                self.assertEqual(source.spec[ArrayKey('ALL')].voxel_size, (2, 1, 1))
+                batch = source.request_batch(request)
+
+            MergeChannel([ArrayKey('GREEN'), ArrayKey('BLUE')], merged).process(batch, request)
+            Clip(ArrayKey('ALL'), 0, 100).process(batch, request)
+
+            self.assertTrue(np.array_equal(batch[ArrayKey('GREEN')].data[0], data[(2,) + slices]))
+            self.assertTrue(np.array_equal(batch[ArrayKey('SOME')].data, data[([3, 1],) + slices]))
+            self.assertTrue(np.array_equal(batch[merged].data, data[(slice(2, 4),) + slices]))
+            self.assertTrue(np.array_equal(
+                batch[ArrayKey('ALL')].data,
+                np.clip(data[(slice(1, 4),) + slices], 0, 100)))
+
+            # views of the memory map, the files are not modified
+            memory = np.load(directory + '/volumes/raw.npy', mmap_mode='r')
+            self.assertTrue(np.array_equal(memory, data[1:]))
+            self.assertTrue(_is_mapped(batch[ArrayKey('GREEN')].data))
+            self.assertTrue(_is_mapped(batch[merged].data))
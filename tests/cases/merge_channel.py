@@ -0,0 +1,116 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import MergeChannel, Hdf5ChannelSource
+from gunpowder import ArrayKey, ArraySpec, Array, Batch, BatchRequest, Roi, build
+import numpy as np
+import h5py
+
+
+class MergeChannelTest(TestWithTempFiles):
+
+    def test_merge(self):
+
+        keys = [ArrayKey('CHANNEL_%d' % i) for i in range(4)]
+        merged = ArrayKey('MERGED')
+
+        roi = Roi((10, 0, 0), (20, 30, 40))
+        batch = Batch()
+        for i, key in enumerate(keys):
+            batch[key] = Array(
+                np.full((10, 15, 20), i, dtype=np.uint8),
+                ArraySpec(roi=roi, voxel_size=(2, 2, 2), dtype=np.uint8))
+
+        merge = MergeChannel(keys, merged, dtype=np.float32)
+        merge.process(batch, BatchRequest())
+
+        self.assertEqual(batch[merged].data.shape, (4, 10, 15, 20))
+        self.assertEqual(batch[merged].data.dtype, np.float32)
+        self.assertEqual(batch[merged].spec.roi, Roi((0, 10, 0, 0), (4, 20, 30, 40)))
+        self.assertEqual(batch[merged].spec.voxel_size, (1, 2, 2, 2))
+        for i in range(4):
+            self.assertTrue(np.all(batch[merged].data[i] == i))
+
+        # fg, bg, raw
+        merge = MergeChannel(keys[1], keys[0], merged)
+        merge.process(batch, BatchRequest())
+
+        self.assertEqual(batch[merged].data.dtype, np.uint8)
+        self.assertTrue(np.all(batch[merged].data[0] == 1))
+        self.assertTrue(np.all(batch[merged].data[1] == 0))
+
+    def test_source_channels(self):
+
+        data = np.random.randint(0, 255, size=(5, 10, 20, 30), dtype=np.uint8)
+        raw = ArrayKey('RAW')
+
+        for data_format in ['channels_first', 'channels_last']:
+
+            filename = self.path_to('%s.hdf' % data_format)
+            with h5py.File(filename, 'w') as f:
+                if data_format == 'channels_first':
+                    f['raw'] = data
+                else:
+                    f['raw'] = np.moveaxis(data, 0, -1)
+
+            source = Hdf5ChannelSource(
+                filename,
+                datasets={raw: 'raw'},
+                channel_ids={raw: [3, 0, 1]},
+                data_format=data_format,
+                array_specs={raw: ArraySpec(voxel_size=(1, 1, 1))})
+
+            request = BatchRequest()
+            request[raw] = ArraySpec(roi=Roi((2, 4, 6), (5, 10, 15)))
+
+            with build(source):
+                batch = source.request_batch(request)
+
+            self.assertTrue(np.array_equal(
+                batch[raw].data,
+                data[[3, 0, 1], 2:7, 4:14, 6:21]))
+
+    def test_coalesced_channels(self):
+
+        data = np.random.randint(0, 255, size=(5, 10, 20, 30), dtype=np.uint8)
+        keys = [ArrayKey('CHANNEL_%d' % i) for i in range(3)]
+        merged = ArrayKey('MERGED')
+
+        for data_format in ['channels_first', 'channels_last']:
+
+            filename = self.path_to('%s.hdf' % data_format)
+            with h5py.File(filename, 'w') as f:
+                if data_format == 'channels_first':
+                    f['raw'] = data
+                else:
+                    f['raw'] = np.moveaxis(data, 0, -1)
+
+            source = Hdf5ChannelSource(
+                filename,
+                datasets={key: 'raw' for key in keys},
+                channel_ids={key: i + 1 for i, key in enumerate(keys)},
+                data_format=data_format,
+                array_specs={key: ArraySpec(voxel_size=(1, 1, 1)) for key in keys})
+
+            request = BatchRequest()
+            for key in keys:
+                request[key] = ArraySpec(roi=Roi((2, 4, 6), (5, 10, 15)))
+
+            with build(source):
+                batch = source.request_batch(request)
+
+            # one read, channels are views of it
+            base = batch[keys[0]].data.base
+            self.assertTrue(base is not None)
+            for i, key in enumerate(keys):
+                self.assertTrue(batch[key].data.base is base)
+                self.assertTrue(np.array_equal(
+                    batch[key].data.reshape(5, 10, 15),
+                    data[i + 1, 2:7, 4:14, 6:21]))
+
+            MergeChannel(keys, merged).process(batch, BatchRequest())
+            self.assertTrue(batch[merged].data.base is base)
+            self.assertTrue(np.array_equal(batch[merged].data, data[1:4, 2:7, 4:14, 6:21]))
+
+            # not in channel order, copied
+            MergeChannel(keys[::-1], merged).process(batch, BatchRequest())
+            self.assertFalse(np.shares_memory(batch[merged].data, base))
+            self.assertTrue(np.array_equal(batch[merged].data, data[3:0:-1, 2:7, 4:14, 6:21]))
@@ -0,0 +1,158 @@
+from .provider_test import ProviderTest
+from neurolight.gunpowder import CountOverlap, RemoveOverlap, Hdf5ChannelSource
+from neurolight.gunpowder.buffer_pool import BufferPool
+from neurolight.gunpowder.overlap import OverlapCache
+import neurolight.gunpowder.overlap
+from gunpowder import ArrayKey, ArraySpec, Array, Batch, BatchRequest, Roi, build
+import h5py
+import numpy as np
+
+
+class OverlapTest(ProviderTest):
+
+    def test_count_and_remove(self):
+
+        gt = ArrayKey('GT')
+        gt_overlap = ArrayKey('GT_OVERLAP')
+        gt_cleaned = ArrayKey('GT_CLEANED')
+
+        rs = np.random.RandomState(0)
+        gt_data = (rs.rand(5, 20, 30, 40) > 0.6).astype(np.uint16)
+        gt_data *= np.arange(1, 6, dtype=np.uint16)[:, None, None, None]
+
+        overlap_cache = OverlapCache()
+        count_overlap = CountOverlap(gt, gt_overlap, maxnuminst=3, overlap_cache=overlap_cache)
+        count_overlap.dims = 3
+        remove_overlap = RemoveOverlap(gt, gt_cleaned, overlap_cache=overlap_cache)
+        remove_overlap.dims = 3
+
+        roi = Roi((0, 0, 0), (20, 30, 40))
+        request = BatchRequest()
+        request[gt] = ArraySpec(roi=roi.grow((-2, -2, -2), (-2, -2, -2)))
+        request[gt_overlap] = ArraySpec(roi=request[gt].roi)
+        request[gt_cleaned] = ArraySpec(roi=roi)
+
+        # count the passes over the instances
+        calls = []
+        compute_overlap = neurolight.gunpowder.overlap.compute_overlap
+
+        def counting_compute_overlap(*args, **kwargs):
+            calls.append(kwargs)
+            return compute_overlap(*args, **kwargs)
+
+        neurolight.gunpowder.overlap.compute_overlap = counting_compute_overlap
+
+        try:
+
+            for nodes in [
+                    [count_overlap, remove_overlap],
+                    [remove_overlap, count_overlap]]:
+
+                calls.clear()
+                batch = Batch()
+                batch[gt] = Array(
+                    gt_data.copy(),
+                    ArraySpec(roi=roi, voxel_size=(1, 1, 1), dtype=np.uint16))
+
+                for node in nodes:
+                    node.process(batch, request)
+
+                self.assertEqual(len(calls), 1)
+                self.assertTrue(calls[0]['count'] and calls[0]['cleaned'])
+
+                count = np.sum(gt_data > 0, axis=0)
+                cleaned = np.sum(gt_data, axis=0)
+                cleaned[count > 1] = 0
+
+                # the count is computed on the cropped gt, if cropped before
+                overlap = batch[gt_overlap]
+                expected = count[overlap.spec.roi.to_slices()]
+                self.assertEqual(overlap.data.dtype, np.int32)
+                self.assertTrue(np.array_equal(overlap.data, np.minimum(expected, 3)))
+
+                self.assertEqual(batch[gt_cleaned].data.dtype, np.uint16)
+                self.assertTrue(np.array_equal(batch[gt_cleaned].data, cleaned))
+
+                self.assertEqual(batch[gt].spec.roi, request[gt].roi)
+
+                # the cached result is not handed out writable
+                self.assertFalse(batch[gt_cleaned].data.flags.writeable)
+
+        finally:
+            neurolight.gunpowder.overlap.compute_overlap = compute_overlap
+
+    def test_separate_caches(self):
+
+        gt = ArrayKey('GT')
+        gt_cleaned = ArrayKey('GT_CLEANED')
+        other_cleaned = ArrayKey('OTHER_CLEANED')
+
+        roi = Roi((0, 0, 0), (10, 10, 10))
+        request = BatchRequest()
+        request[gt] = ArraySpec(roi=roi)
+
+        # two pipelines with the same key do not share results
+        nodes = [RemoveOverlap(gt, key) for key in [gt_cleaned, other_cleaned]]
+        for node in nodes:
+            node.dims = 3
+
+        for i, node in enumerate(nodes):
+            gt_data = np.zeros((2, 10, 10, 10), dtype=np.uint16)
+            gt_data[0, :5] = 1 + i
+            batch = Batch()
+            batch[gt] = Array(gt_data, ArraySpec(roi=roi, voxel_size=(1, 1, 1), dtype=np.uint16))
+            node.process(batch, request)
+
+            cleaned = batch[node.gt_cleaned].data
+            self.assertEqual(cleaned.max(), 1 + i)
+            self.assertTrue(cleaned.flags.writeable)
+
+        # results are released on teardown
+        overlap_cache = OverlapCache()
+        node = RemoveOverlap(gt, gt_cleaned, overlap_cache=overlap_cache)
+        node.dims = 3
+        batch = Batch()
+        batch[gt] = Array(gt_data, ArraySpec(roi=roi, voxel_size=(1, 1, 1), dtype=np.uint16))
+        node.process(batch, request)
+        cleaned = overlap_cache.get(gt, batch[gt], 3)
+        node.teardown()
+        self.assertFalse(overlap_cache.get(gt, batch[gt], 3) is cleaned)
+
+    def test_buffer_pool(self):
+
+        # buffers refilled for the next batch do not get the previous overlap
+        gt = ArrayKey('GT')
+        gt_overlap = ArrayKey('GT_OVERLAP')
+
+        gt_data = np.zeros((2, 4, 4, 8), dtype=np.uint16)
+        gt_data[0] = 1
+        gt_data[1, :, :, :4] = 2
+
+        filename = self.path_to('gt.hdf')
+        with h5py.File(filename, 'w') as f:
+            f['gt'] = gt_data
+
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={gt: 'gt'},
+            array_specs={gt: ArraySpec(voxel_size=(1, 1, 1))},
+            buffer_pool=BufferPool())
+        overlap_cache = OverlapCache()
+        count_overlap = CountOverlap(gt, gt_overlap, overlap_cache=overlap_cache)
+        count_overlap.dims = 3
+
+        with build(source):
+
+            counts = []
+            for x in [0, 4]:
+                roi = Roi((0, 0, x), (4, 4, 4))
+                request = BatchRequest()
+                request[gt] = ArraySpec(roi=roi)
+                batch = source.request_batch(request)
+                request[gt_overlap] = ArraySpec(roi=roi)
+                count_overlap.process(batch, request)
+                counts.append(np.unique(batch[gt_overlap].data).tolist())
+                del batch
+
+        self.assertEqual(source.buffer_pool.reuses, 1)
+        self.assertEqual(counts, [[2], [1]])
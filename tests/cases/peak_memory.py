@@ -0,0 +1,87 @@
+from .provider_test import ProviderTest
+from neurolight.gunpowder import FusionAugment, Clip, CountOverlap, RemoveOverlap
+from neurolight.gunpowder.overlap import OverlapCache
+from gunpowder import ArrayKey, ArraySpec, Array, Batch, BatchRequest, Roi, Coordinate
+import numpy as np
+import tracemalloc
+
+
+class PeakMemoryTest(ProviderTest):
+
+    def _peak(self, node, batch, request):
+
+        tracemalloc.start()
+        node.process(batch, request)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return peak
+
+    def test_reference_pipeline(self):
+
+        raw_a, raw_b = ArrayKey('RAW_A'), ArrayKey('RAW_B')
+        labels_a, labels_b = ArrayKey('LABELS_A'), ArrayKey('LABELS_B')
+        fused, fused_labels = ArrayKey('FUSED'), ArrayKey('FUSED_LABELS')
+        gt = ArrayKey('GT')
+        gt_overlap, gt_cleaned = ArrayKey('GT_OVERLAP'), ArrayKey('GT_CLEANED')
+
+        shape = (64, 64, 64)
+        roi = Roi((0, 0, 0), shape)
+        inner = roi.grow(Coordinate((-8, -8, -8)), Coordinate((-8, -8, -8)))
+        voxel_size = Coordinate((1, 1, 1))
+
+        batch = Batch()
+        for i, (raw, labels) in enumerate([(raw_a, labels_a), (raw_b, labels_b)]):
+            labels_data = np.zeros(shape, dtype=np.int32)
+            labels_data[4 + i*16:12 + i*16, 8:-8, 8:-8] = i + 1
+            batch[labels] = Array(
+                labels_data,
+                ArraySpec(roi=roi, voxel_size=voxel_size, dtype=np.int32))
+            batch[raw] = Array(
+                np.random.random((3,) + shape).astype(np.float32),
+                ArraySpec(roi=roi, voxel_size=voxel_size, dtype=np.float32))
+
+        gt_data = (np.random.random((10,) + shape) > 0.9).astype(np.uint16)
+        batch[gt] = Array(
+            gt_data,
+            ArraySpec(roi=roi, voxel_size=voxel_size, dtype=np.uint16))
+
+        request = BatchRequest()
+        request[fused] = ArraySpec(roi=roi)
+        request[fused_labels] = ArraySpec(roi=inner, dtype=np.int32)
+        request[gt] = ArraySpec(roi=inner)
+        request[gt_overlap] = ArraySpec(roi=roi)
+        request[gt_cleaned] = ArraySpec(roi=roi)
+
+        raw_nbytes = batch[raw_a].data.nbytes
+        volume_nbytes = int(np.prod(shape))
+
+        # fused labels are cropped without copy
+        peak = self._peak(
+            FusionAugment(
+                raw_a, raw_b, labels_a, labels_b, fused, fused_labels,
+                in_place=True),
+            batch,
+            request)
+        self.assertLessEqual(peak, 2*raw_nbytes)
+        self.assertEqual(batch[fused_labels].spec.roi, inner)
+        self.assertFalse(batch[fused_labels].data.flags.owndata)
+
+        peak = self._peak(Clip(fused, 0.1, 0.9, in_place=True), batch, request)
+        self.assertLess(peak, 0.01*raw_nbytes)
+
+        overlap_cache = OverlapCache()
+        count_overlap = CountOverlap(gt, gt_overlap, overlap_cache=overlap_cache)
+        count_overlap.dims = 3
+        remove_overlap = RemoveOverlap(gt, gt_cleaned, overlap_cache=overlap_cache)
+        remove_overlap.dims = 3
+
+        # int32 count, narrow count and uint16 cleaned labels
+        peak = self._peak(count_overlap, batch, request)
+        self.assertLess(peak, 8*volume_nbytes)
+
+        # reuses the cleaned labels, crops gt without copy
+        peak = self._peak(remove_overlap, batch, request)
+        self.assertLess(peak, 0.1*volume_nbytes)
+        self.assertEqual(batch[gt].spec.roi, inner)
+        self.assertTrue(np.shares_memory(batch[gt].data, gt_data))
@@ -0,0 +1,62 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import h5py
+
+
+class PrefetchTest(TestWithTempFiles):
+
+    def test_read_ahead(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(2, 40, 30, 30), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f['raw'] = data
+
+        raw = ArrayKey('RAW')
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={raw: 'raw'},
+            channel_ids={raw: 1},
+            array_specs={raw: ArraySpec(voxel_size=(1, 1, 1))},
+            read_ahead=2)
+
+        def request_at(offset):
+            request = BatchRequest()
+            request[raw] = ArraySpec(roi=Roi(offset, (5, 10, 10)))
+            return request
+
+        with build(source):
+
+            # a scan along z, predicted after the second request
+            for z in range(0, 35, 5):
+                batch = source.request_batch(request_at((z, 3, 4)))
+                self.assertTrue(np.array_equal(
+                    batch[raw].data.reshape(5, 10, 10),
+                    data[1, z:z + 5, 3:13, 4:14]))
+                self.assertTrue(any(
+                    method == 'stall'
+                    for (_, method) in batch.profiling_stats.get_timing_summaries().keys()))
+
+            self.assertEqual(source.prefetcher.misses, 2)
+            self.assertEqual(source.prefetcher.hits, 5)
+
+            # hinted requests
+            source.hint(request_at((7, 11, 13)))
+            batch = source.request_batch(request_at((7, 11, 13)))
+            self.assertTrue(np.array_equal(
+                batch[raw].data.reshape(5, 10, 10),
+                data[1, 7:12, 11:21, 13:23]))
+            self.assertEqual(source.prefetcher.hits, 6)
+
+            # predictions do not drop hints
+            hints = [request_at((30, 0, 0)), request_at((30, 20, 20))]
+            for hint in hints:
+                source.hint(hint)
+            for y in range(0, 20, 5):
+                source.request_batch(request_at((0, y, 0)))
+            hits = source.prefetcher.hits
+            for hint in hints:
+                source.request_batch(hint)
+            self.assertEqual(source.prefetcher.hits, hits + 2)
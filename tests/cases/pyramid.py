@@ -0,0 +1,118 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.hdf5_pool import close_hdf5
+from neurolight.gunpowder.pyramid import build_pyramid, pyramid_levels
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import h5py
+
+
+class PyramidTest(TestWithTempFiles):
+
+    def test_build_pyramid(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(35, 34, 33, 2), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('volumes/raw/s0', data=data, chunks=(8, 8, 8, 2))
+            f['volumes/raw/s0'].attrs['resolution'] = (4, 2, 2)
+            f['volumes/raw/s0'].attrs['offset'] = (40, 20, 20)
+
+        # blocks smaller than the levels
+        build_pyramid(
+            filename,
+            'volumes/raw',
+            num_levels=2,
+            data_format='channels_last',
+            block_shape=(5, 6, 7))
+
+        expected = data[:34, :34, :32].reshape(17, 2, 17, 2, 16, 2, 2).mean(axis=(1, 3, 5))
+        expected = np.round(expected).astype(np.uint8)
+
+        # the offset of s1 is not on the grid of s2, the first voxel is skipped
+        expected_s2 = expected[1:17, 1:17, 1:15].reshape(8, 2, 8, 2, 7, 2, 2).mean(axis=(1, 3, 5))
+        expected_s2 = np.round(expected_s2).astype(np.uint8)
+
+        with h5py.File(filename, 'r') as f:
+            self.assertEqual(pyramid_levels(f['volumes/raw']), ['s0', 's1', 's2'])
+            self.assertTrue(np.array_equal(f['volumes/raw/s1'][:], expected))
+            self.assertEqual(list(f['volumes/raw/s1'].attrs['offset']), [40, 20, 20])
+            self.assertTrue(np.array_equal(f['volumes/raw/s2'][:], expected_s2))
+            self.assertEqual(list(f['volumes/raw/s2'].attrs['resolution']), [16, 8, 8])
+            self.assertEqual(list(f['volumes/raw/s2'].attrs['offset']), [48, 24, 24])
+
+        # levels in the source
+        raw = ArrayKey('RAW')
+        raw_s1 = ArrayKey('RAW_S1')
+        raw_s2 = ArrayKey('RAW_S2')
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={
+                raw: 'volumes/raw',
+                raw_s1: 'volumes/raw',
+                raw_s2: ['volumes/raw/s0', 'volumes/raw/s1', 'volumes/raw/s2']},
+            channel_ids={raw: 1, raw_s1: 1, raw_s2: 1},
+            data_format='channels_last',
+            array_specs={
+                raw_s1: ArraySpec(voxel_size=(8, 4, 4)),
+                raw_s2: ArraySpec(voxel_size=(16, 8, 8))})
+
+        with build(source):
+
+            self.assertEqual(source.datasets[raw], 'volumes/raw/s0')
+            self.assertEqual(source.datasets[raw_s1], 'volumes/raw/s1')
+            self.assertEqual(source.datasets[raw_s2], 'volumes/raw/s2')
+            self.assertEqual(source.spec[raw_s1].roi, Roi((40, 20, 20), (136, 68, 64)))
+            self.assertEqual(source.spec[raw_s2].roi, Roi((48, 24, 24), (128, 64, 56)))
+
+            request = BatchRequest()
+            request[raw] = ArraySpec(roi=Roi((56, 28, 36), (32, 16, 16)))
+            request[raw_s1] = ArraySpec(roi=Roi((56, 28, 36), (32, 16, 16)))
+            request[raw_s2] = ArraySpec(roi=Roi((64, 32, 40), (32, 16, 16)))
+            batch = source.request_batch(request)
+
+            self.assertTrue(np.array_equal(batch[raw].data, data[4:12, 4:12, 8:16, 1]))
+            self.assertTrue(np.array_equal(batch[raw_s1].data, expected[2:6, 2:6, 4:8, 1]))
+            self.assertTrue(np.array_equal(batch[raw_s2].data, expected_s2[1:3, 1:3, 2:4, 1]))
+
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={raw: 'volumes/raw'},
+            data_format='channels_last',
+            array_specs={raw: ArraySpec(voxel_size=(3, 3, 3))})
+
+        with self.assertRaises(RuntimeError):
+            source.setup()
+
+        # levels off the grid of their voxel size are rejected
+        close_hdf5(filename)
+        with h5py.File(filename, 'r+') as f:
+            f['volumes/raw/s2'].attrs['offset'] = (40, 20, 20)
+
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={raw_s2: 'volumes/raw'},
+            data_format='channels_last',
+            array_specs={raw_s2: ArraySpec(voxel_size=(16, 8, 8))})
+
+        with self.assertRaises(RuntimeError):
+            source.setup()
+
+    def test_downsample_modes(self):
+
+        filename = self.path_to('labels.hdf')
+        labels = np.zeros((2, 8, 8), dtype=np.uint64)
+        labels[0, :5, :3] = 7
+        labels[1, 2:, 2:] = 3
+        with h5py.File(filename, 'w') as f:
+            f['labels/s0'] = labels
+
+        build_pyramid(filename, 'labels', num_levels=1, downsample='nearest')
+        with h5py.File(filename, 'r') as f:
+            self.assertTrue(np.array_equal(f['labels/s1'][:], labels[:, ::2, ::2]))
+
+        build_pyramid(filename, 'labels', num_levels=1, downsample='max')
+        with h5py.File(filename, 'r') as f:
+            self.assertTrue(np.array_equal(
+                f['labels/s1'][:],
+                labels.reshape(2, 4, 2, 4, 2).max(axis=(2, 4))))
@@ -1,8 +1,8 @@
 from .provider_test import TestWithTempFiles
 from neurolight.gunpowder.swc_file_source import SwcFileSource, SwcPoint
-from neurolight.gunpowder.fusion_augment import FusionAugment
 from neurolight.gunpowder.rasterize_skeleton import RasterizeSkeleton
 from gunpowder import (
+    Batch,
     PointsKey,
     PointsSpec,
     ArrayKey,
@@ -15,7 +15,7 @@ from gunpowder import (
 )
 
 import numpy as np
-from spimagine import volshow
+from scipy.ndimage import distance_transform_edt
 
 from typing import Dict, List, Tuple, Optional
 from pathlib import Path
@@ -23,6 +23,14 @@ import time
 import unittest
 
 
+class SwcPoints(object):
+    # points as in gunpowder 1.0, newer versions convert Points into a Graph
+    # and drop the attributes of SwcPoint
+    def __init__(self, data, spec):
+        self.data = data
+        self.spec = spec
+
+
 class FusionAugmentTest(TestWithTempFiles):
     def setUp(self):
         super(FusionAugmentTest, self).setUp()
@@ -103,6 +111,56 @@ class FusionAugmentTest(TestWithTempFiles):
 
         return (intercepts, (slope_a, slope_b))
 
+    def test_radius(self):
+
+        # the distance transform limited to the bounding box of each skeleton
+        # equals the one of the whole volume
+        points = PointsKey("SWC")
+        labels = ArrayKey("LABELS")
+        voxel_size = Coordinate([2, 1, 1])
+        roi = Roi((0, 0, 0), (40, 30, 30))
+        radius = 3.5
+
+        swc_points = {
+            0: SwcPoint(0, 0, np.array([8, 5, 6]), 0, -1, label_id=1),
+            1: SwcPoint(1, 0, np.array([20, 12, 9]), 0, 0, label_id=1),
+            2: SwcPoint(2, 0, np.array([22, 14, 20]), 0, 1, label_id=1),
+            3: SwcPoint(3, 0, np.array([30, 25, 25]), 0, -1, label_id=2),
+            4: SwcPoint(4, 0, np.array([36, 27, 26]), 0, 3, label_id=2),
+        }
+
+        batch = Batch()
+        batch.points[points] = SwcPoints(swc_points, PointsSpec(roi=roi))
+        request = BatchRequest()
+        request[labels] = ArraySpec(roi=roi)
+
+        rasterize = RasterizeSkeleton(
+            points=points,
+            array=labels,
+            array_spec=ArraySpec(
+                interpolatable=False, dtype=np.uint32, voxel_size=voxel_size
+            ),
+            radius=radius,
+        )
+        rasterize.process(batch, request)
+
+        shape = roi.get_shape() / voxel_size
+        expected = np.zeros(shape, dtype=np.uint32)
+        for label, segments in [(1, [(0, 1), (1, 2)]), (2, [(3, 4)])]:
+            skeleton = np.zeros(shape, dtype=bool)
+            for a, b in segments:
+                skeleton = rasterize._rasterize_line_segment(
+                    (swc_points[b].location / voxel_size).astype(int),
+                    (swc_points[a].location / voxel_size).astype(int),
+                    skeleton,
+                )
+            dt = distance_transform_edt(np.logical_not(skeleton), sampling=voxel_size)
+            expected[dt <= radius] = label
+
+        self.assertGreater(np.count_nonzero(expected == 1), 0)
+        self.assertGreater(np.count_nonzero(expected == 2), 0)
+        self.assertTrue(np.array_equal(batch[labels].data, expected))
+
     @unittest.expectedFailure
     def test_rasterize_speed(self):
         # This is worryingly slow for such a small volume (256**3) and only 2
@@ -0,0 +1,115 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.buffer_pool import BufferPool
+from neurolight.gunpowder.reader_pool import ReaderPool, _slabs
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import h5py
+import gc
+import os
+
+
+class ReaderPoolTest(TestWithTempFiles):
+
+    def test_slabs(self):
+
+        # split z of a single channel, at chunk boundaries
+        parts, shape = _slabs((slice(1, 2), slice(3, 30), slice(0, 5)), (2, 40, 10), (1, 8, 5), 3)
+        self.assertEqual(shape, (1, 27, 5))
+        self.assertEqual(
+            [p[0][1] for p in parts],
+            [slice(3, 16), slice(16, 30)])
+        self.assertEqual(
+            [p[1] for p in parts],
+            [(slice(None), slice(0, 13)), (slice(None), slice(13, 27))])
+
+        parts, shape = _slabs((0, slice(2, 3)), (2, 40), None, 4)
+        self.assertEqual(parts, [((0, slice(2, 3)), None)])
+        self.assertEqual(shape, (1,))
+
+    def test_read(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(3, 30, 20, 20), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw', data=data, chunks=(1, 4, 10, 10), compression='gzip')
+            f.create_dataset('raw_last', data=np.moveaxis(data, 0, -1), chunks=(4, 10, 10, 3))
+
+        raw = ArrayKey('RAW')
+        raw_last = ArrayKey('RAW_LAST')
+        channels = ArrayKey('CHANNELS')
+        source = Hdf5ChannelSource(
+            filename,
+            datasets={raw: 'raw', channels: 'raw'},
+            channel_ids={raw: 1, channels: [2, 0]},
+            array_specs={
+                raw: ArraySpec(voxel_size=(1, 1, 1)),
+                channels: ArraySpec(voxel_size=(1, 1, 1))},
+            reader_processes=2)
+        source_last = Hdf5ChannelSource(
+            filename,
+            datasets={raw_last: 'raw_last'},
+            data_format='channels_last',
+            array_specs={raw_last: ArraySpec(voxel_size=(1, 1, 1))},
+            chunk_aligned=False,
+            reader_processes=2)
+
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=Roi((3, 4, 5), (21, 10, 12)))
+        request[channels] = ArraySpec(roi=Roi((0, 0, 0), (30, 20, 20)))
+
+        with build(source):
+            batch = source.request_batch(request)
+            self.assertTrue(np.array_equal(batch[raw].data, data[1:2, 3:24, 4:14, 5:17]))
+            self.assertTrue(np.array_equal(batch[channels].data, data[[2, 0]]))
+
+            # the shared memory is removed with the batch
+            del batch
+            gc.collect()
+            if os.path.isdir('/dev/shm'):
+                self.assertFalse(any(name.startswith('neurolight-') for name in os.listdir('/dev/shm')))
+
+        request = BatchRequest()
+        request[raw_last] = ArraySpec(roi=Roi((3, 4, 5), (21, 10, 12)))
+
+        with build(source_last):
+            batch = source_last.request_batch(request)
+            self.assertTrue(np.array_equal(batch[raw_last].data, data[:, 3:24, 4:14, 5:17]))
+
+    def test_read_into(self):
+
+        filename = self.path_to('raw.hdf')
+        data = np.random.randint(0, 255, size=(2, 30, 20, 20), dtype=np.uint8)
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw', data=data, chunks=(1, 4, 10, 10))
+
+        pool = ReaderPool(filename, 2)
+        selection = (slice(None), slice(3, 24), slice(4, 14), slice(5, 17))
+        expected = data[selection]
+
+        with h5py.File(filename, 'r') as f:
+
+            # into shared memory, part of a larger array
+            out = pool.allocate((3,) + expected.shape, np.uint8)
+            out[...] = 0
+            view = out[1]
+            self.assertTrue(pool.read(f['raw'], selection, out=view) is view)
+            self.assertTrue(np.array_equal(out[1], expected))
+            self.assertEqual(np.count_nonzero(out[0]), 0)
+            self.assertEqual(np.count_nonzero(out[2]), 0)
+
+            # into other arrays, copied
+            out = np.zeros(expected.shape, dtype=np.uint8)
+            self.assertTrue(pool.read(f['raw'], selection, out=out) is out)
+            self.assertTrue(np.array_equal(out, expected))
+
+            # from a buffer pool in shared memory
+            buffers = BufferPool()
+            buffer, _ = buffers.get(expected.shape, np.uint8, pool.allocate)
+            pool.read(f['raw'], selection, out=buffer)
+            self.assertTrue(np.array_equal(buffer, expected))
+            del buffer
+            buffer, reused = buffers.get(expected.shape, np.uint8, pool.allocate)
+            self.assertTrue(reused)
+
+        pool.shutdown()
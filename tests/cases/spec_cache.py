@@ -0,0 +1,89 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import Hdf5ChannelSource
+from neurolight.gunpowder.hdf5_pool import close_hdf5
+from neurolight.gunpowder.spec_cache import discover_specs
+from gunpowder import ArrayKey, ArraySpec, Roi
+import numpy as np
+import h5py
+import os
+
+
+def _no_file(filename):
+    raise AssertionError("%s opened" % filename)
+
+
+class SpecCacheTest(TestWithTempFiles):
+
+    def test_sidecar(self):
+
+        filename = self.path_to('raw.hdf')
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('raw', data=np.zeros((2, 10, 20, 30), dtype=np.uint8), chunks=(1, 5, 5, 5))
+            f['raw'].attrs['resolution'] = (4, 2, 2)
+            f['raw'].attrs['offset'] = (8, 0, 4)
+            f['labels/s0'] = np.zeros((10, 20, 30), dtype=np.uint64)
+            f['labels/s1'] = np.zeros((5, 10, 15), dtype=np.uint64)
+
+        raw = ArrayKey('RAW')
+        labels = ArrayKey('LABELS')
+
+        def source():
+            return Hdf5ChannelSource(
+                filename,
+                datasets={raw: 'raw', labels: 'labels'},
+                channel_ids={raw: 1},
+                array_specs={labels: ArraySpec(voxel_size=(2, 2, 2))},
+                spec_cache=True)
+
+        first = source()
+        first.setup()
+        self.assertTrue(os.path.exists(filename + '.specs.json'))
+
+        # from the sidecar, without opening the file
+        second = source()
+        second._open_file = _no_file
+        second.setup()
+        for key in [raw, labels]:
+            self.assertEqual(second.spec[key], first.spec[key])
+        self.assertEqual(second.spec[raw].roi, Roi((8, 0, 4), (40, 40, 60)))
+        self.assertEqual(second.spec[raw].dtype, np.uint8)
+        self.assertEqual(second.datasets[labels], 'labels/s1')
+
+        # changed files are read again
+        close_hdf5(filename)
+        with h5py.File(filename, 'r+') as f:
+            del f['raw']
+            f['raw'] = np.zeros((2, 12, 20, 30), dtype=np.float32)
+            f['raw'].attrs['resolution'] = (4, 2, 2)
+
+        third = source()
+        third.setup()
+        self.assertEqual(third.spec[raw].roi, Roi((0, 0, 0), (48, 40, 60)))
+        self.assertEqual(third.spec[raw].dtype, np.float32)
+
+    def test_discover_specs(self):
+
+        raw = ArrayKey('RAW')
+        cache = self.path_to('specs')
+
+        def sources():
+            return [
+                Hdf5ChannelSource(
+                    self.path_to('sample_%d.hdf' % i),
+                    datasets={raw: 'raw'},
+                    array_specs={raw: ArraySpec(voxel_size=(1, 1, 1))},
+                    spec_cache=cache)
+                for i in range(6)
+            ]
+
+        for i in range(6):
+            with h5py.File(self.path_to('sample_%d.hdf' % i), 'w') as f:
+                f['raw'] = np.zeros((1, 10 + i, 10, 10), dtype=np.uint8)
+
+        discover_specs(sources(), num_workers=3)
+        self.assertEqual(len(os.listdir(cache)), 6)
+
+        for i, source in enumerate(sources()):
+            source._open_file = _no_file
+            source.setup()
+            self.assertEqual(source.spec[raw].roi, Roi((0, 0, 0), (10 + i, 10, 10)))
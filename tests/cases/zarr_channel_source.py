@@ -0,0 +1,69 @@
+from .provider_test import TestWithTempFiles
+from neurolight.gunpowder import ZarrChannelSource
+from gunpowder import ArrayKey, ArraySpec, BatchRequest, Roi, build
+import numpy as np
+import unittest
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+@unittest.skipIf(zarr is None, "zarr is not installed")
+class ZarrChannelSourceTest(TestWithTempFiles):
+
+    def test_read(self):
+
+        data = np.random.randint(0, 255, size=(3, 20, 30, 40), dtype=np.uint8)
+        keys = {
+            ArrayKey('RED'): 0,
+            ArrayKey('BLUE'): 2,
+            ArrayKey('ALL'): None,
+            ArrayKey('SOME'): [2, 1],
+        }
+
+        for extension in ['zarr', 'n5']:
+            for data_format in ['channels_first', 'channels_last']:
+
+                filename = self.path_to('raw_%s.%s' % (data_format, extension))
+                if extension == 'n5':
+                    root = zarr.open(zarr.N5Store(filename), mode='w')
+                    resolution = [2, 1, 1]
+                else:
+                    root = zarr.open(filename, mode='w')
+                    resolution = [1, 1, 2]
+
+                if data_format == 'channels_first':
+                    root.create_dataset('raw', data=data, chunks=(1, 7, 8, 9))
+                else:
+                    root.create_dataset('raw', data=np.moveaxis(data, 0, -1), chunks=(7, 8, 9, 3))
+                root['raw'].attrs['resolution'] = resolution
+                root['raw'].attrs['offset'] = [0, 0, 0]
+
+                source = ZarrChannelSource(
+                    filename,
+                    datasets={key: 'raw' for key in keys},
+                    channel_ids=keys,
+                    data_format=data_format,
+                    num_threads=4)
+
+                roi = Roi((3, 5, 14), (9, 10, 22))
+                slices = (slice(3, 12), slice(5, 15), slice(7, 18))
+
+                request = BatchRequest()
+                for key in keys:
+                    request[key] = ArraySpec(roi=roi)
+
+                with build(source):
+                    self.assertEqual(source.spec[ArrayKey('RED')].voxel_size, (1, 1, 2))
+                    batch = source.request_batch(request)
+
+                for key, channel_id in keys.items():
+                    if channel_id is None:
+                        expected = data[(slice(None),) + slices]
+                    else:
+                        expected = data[(channel_id,) + slices]
+                    self.assertTrue(np.array_equal(
+                        batch[key].data.reshape(expected.shape),
+                        expected))